@@ -0,0 +1,380 @@
+import argparse
+import glob
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PC_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "..", "PC")
+PI_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "..", "RaspberryPI")
+sys.path.insert(0, PC_DIRECTORY)
+
+import shared_modules
+import codec
+from Client import Client
+from latency import LatencyHistogram
+
+# Commands clients can send, mix is given as weights, e.g. set=70,status=20,ON=5,OFF=5
+COMMAND_MIX = "set=70,status=20,ON=5,OFF=5"
+# PI script waits for Arduinos to boot and handshakes before it connects to broker
+STARTUP_TIMEOUT = 60.0
+READY_POLL_INTERVAL = 0.5
+# Commands sent after load stopped still get this long to be acknowledged before they count as dropped
+DRAIN_TIME = 5.0
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        command, _, weight = part.partition("=")
+        if command not in ("set", "status", "ON", "OFF"):
+            raise ValueError(f"Unknown command in mix: {command}")
+        mix[command] = float(weight)
+    return mix
+
+
+def process_usage(pid):
+    # (CPU seconds, RSS in kB, peak RSS in kB) of process from /proc
+    with open(f"/proc/{pid}/stat") as file:
+        # Fields after command name (which may hold spaces) start with state
+        fields = file.read().rpartition(")")[2].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    memory = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                memory[name] = int(value.split()[0])
+    return cpu_seconds, memory.get("VmRSS", 0), memory.get("VmHWM", 0)
+
+
+def start_process(command, cwd, log_path):
+    # Output lines are collected by a thread, so process never blocks on a full pipe
+    log = open(log_path, "w")
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE, stderr=log, text=True, bufsize=1)
+    process.lines = queue.Queue()
+    process.reader = threading.Thread(target=lambda: [process.lines.put(line) for line in process.stdout], daemon=True)
+    process.reader.start()
+    return process
+
+
+def wait_for_line(process, prefix, timeout):
+    # Returns first line of process output starting with prefix. Lines before it are dropped
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            line = process.lines.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            raise RuntimeError(f"{os.path.basename(process.args[1])} did not print '{prefix}'")
+        if line.startswith(prefix):
+            return line.strip()
+
+
+class BenchmarkClient:
+    # One PC Client sending a random command mix at given rate and counting what comes back
+    def __init__(self, index, client_count, port, protocol, mix, panels, rate, seed):
+        self.client = Client(f"benchmark_{index}", "benchmark", "benchmark", protocol)
+        # All clients see every ack on pi_to_pc, so every client numbers its messages in its own range (long enough
+        # for any sensible run)
+        self.sequence_range = codec.SEQUENCE_MODULO // client_count
+        self.first_sequence = index * self.sequence_range
+        self.client.sequence = itertools.count(self.first_sequence)
+        self.port = port
+        self.mix = mix
+        self.panels = panels
+        self.interval = 1.0 / rate
+        self.random = random.Random(seed + index)
+
+        self.lock = threading.Lock()
+        self.counters = {"sent": 0, "acked": 0, "nacked": 0, "pi_errors": 0, "decode_errors": 0, "status": 0,
+                         "traces": 0}
+        self.commands = {command: 0 for command in mix}
+        self.running = False
+        self.thread = None
+
+    def own(self, sequence):
+        return self.first_sequence <= sequence < self.first_sequence + self.sequence_range
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def on_message(self, client, userdata, message):
+        try:
+            command, content, sequence = codec.decode("pi_to_pc", message.payload)
+        except codec.CodecError:
+            self.count("decode_errors")
+            return
+        if command == "ack" and self.own(content[0]):
+            if self.client.acknowledge(content[0]) is not None:
+                self.count("acked" if content[1] == codec.ACK_OK else "nacked")
+        elif command == "trace" and self.own(content[0]):
+            self.client.latency.traced(*content[:5])
+            self.count("traces")
+        elif command == "error":
+            # PI could not check hash (or CRC) of one of our messages. Every client sees it, only first one counts
+            if self.first_sequence == 0:
+                self.count("pi_errors")
+        elif command == "status":
+            self.count("status")
+
+    def connect(self):
+        self.client.client.message_callback_add("pi_to_pc", self.on_message)
+        if not self.client.connect("127.0.0.1", self.port):
+            return False
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not self.client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.client.subscribe_to_topic("pi_to_pc")
+        return self.client.is_connected()
+
+    def wait_until_answered(self, timeout):
+        # PI is ready once it acknowledges a status request
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.client.publish_command("pc_to_pi", "status", [self.panels[0]])
+            time.sleep(READY_POLL_INTERVAL)
+            with self.lock:
+                if self.counters["acked"]:
+                    return True
+        return False
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict.fromkeys(self.counters, 0)
+            self.commands = dict.fromkeys(self.commands, 0)
+        self.client.latency.reset()
+
+    def fields(self, command):
+        panel_number = self.random.choice(self.panels)
+        if command == "set":
+            return [panel_number] + [self.random.randint(0, 100) for _ in range(4)]
+        if command == "ON":
+            # One slot around now, so engine acts on it right away. Stop must come after start, at 23:59 slot is a
+            # minute earlier
+            now = time.localtime()
+            start = min(now.tm_hour * 60 + now.tm_min, 1438)
+            slot = (start, start + 1, *(self.random.randint(0, 100) for _ in range(4)), 0, 0)
+            return [panel_number, slot]
+        return [panel_number]
+
+    def run(self, duration):
+        commands = list(self.mix)
+        weights = [self.mix[command] for command in commands]
+        started = time.monotonic()
+        # Sends are scheduled from start, so a slow publish does not lower the rate
+        for sent in itertools.count():
+            if not self.running:
+                break
+            due = started + sent * self.interval
+            if due - started >= duration:
+                break
+            time.sleep(max(due - time.monotonic(), 0))
+            command = self.random.choices(commands, weights)[0]
+            if self.client.publish_command("pc_to_pi", command, self.fields(command)) is not None:
+                with self.lock:
+                    self.counters["sent"] += 1
+                    self.commands[command] += 1
+
+    def start(self, duration):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(duration,))
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def stop(self):
+        self.running = False
+        self.client.purpose_disconnect()
+
+
+def run_benchmark(args):
+    mix = parse_mix(args.mix)
+    panels = list(range(1, args.panels + 1))
+    work_directory = tempfile.mkdtemp(prefix="benchmark_")
+    processes = {}
+    clients = []
+    try:
+        # PI script writes state next to itself, so it runs from a copy like on PI, with shared modules next to it
+        pi_directory = os.path.join(work_directory, "pi")
+        os.mkdir(pi_directory)
+        for path in glob.glob(os.path.join(PI_DIRECTORY, "*.py")):
+            shutil.copy(path, pi_directory)
+        for module_name in shared_modules.SHARED_MODULES:
+            shutil.copy(os.path.join(shared_modules.SHARED_DIRECTORY, module_name), pi_directory)
+
+        processes["broker"] = start_process([sys.executable, os.path.join(BENCHMARK_DIRECTORY, "broker.py"),
+                                             "--port", "0"], work_directory,
+                                            os.path.join(work_directory, "broker.log"))
+        port = int(wait_for_line(processes["broker"], "Broker listening", 10).split()[-1])
+
+        processes["arduinos"] = start_process(
+            [sys.executable, os.path.join(pi_directory, "arduino_simulator.py"), "--panels", str(args.panels),
+             "--conversion-time", str(args.conversion_time), "--temperature", args.temperature],
+            work_directory, os.path.join(work_directory, "arduinos.log"))
+        ports = wait_for_line(processes["arduinos"], "--ports", 10).split()[1:]
+
+        pi_command = [sys.executable, os.path.join(pi_directory, "ForRaspberryPI.py"), "--ports", *ports,
+                      "--mqtt-port", str(port), "--protocol", args.protocol]
+        if args.trace:
+            pi_command.append("--trace")
+        if args.asyncio:
+            pi_command.append("--asyncio")
+        processes["pi"] = start_process(pi_command, pi_directory, os.path.join(work_directory, "pi.log"))
+
+        clients = [BenchmarkClient(index, args.clients, port, args.protocol, mix, panels, args.rate / args.clients,
+                                   args.seed)
+                   for index in range(args.clients)]
+        for client in clients:
+            if not client.connect():
+                raise RuntimeError("Benchmark client could not connect to broker")
+        if not clients[0].wait_until_answered(STARTUP_TIMEOUT):
+            raise RuntimeError(f"PI script did not answer, see {work_directory}")
+
+        time.sleep(args.warmup)
+        for client in clients:
+            client.reset()
+
+        pids = {name: process.pid for name, process in processes.items()}
+        pids["clients"] = os.getpid()
+        usage_before = {name: process_usage(pid) for name, pid in pids.items()}
+        started = time.monotonic()
+        for client in clients:
+            client.start(args.duration)
+        for client in clients:
+            client.join()
+        elapsed = time.monotonic() - started
+        usage_after = {name: process_usage(pid) for name, pid in pids.items()}
+        time.sleep(args.drain)
+
+        return collect_results(args, clients, elapsed, usage_before, usage_after, processes)
+    finally:
+        for client in clients:
+            client.stop()
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not args.keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+        else:
+            print(f"Logs and PI state kept in {work_directory}")
+
+
+def collect_results(args, clients, elapsed, usage_before, usage_after, processes):
+    counters = {}
+    commands = {}
+    for client in clients:
+        with client.lock:
+            for name, value in client.counters.items():
+                counters[name] = counters.get(name, 0) + value
+            for command, value in client.commands.items():
+                commands[command] = commands.get(command, 0) + value
+    counters["dropped"] = max(counters["sent"] - counters["acked"] - counters["nacked"], 0)
+
+    # Histograms of all clients are merged hop by hop
+    latency = {}
+    for client in clients:
+        for hop, histogram in client.client.latency.histograms.items():
+            merged = latency.setdefault(hop, LatencyHistogram())
+            with client.client.latency.lock:
+                for index, count in enumerate(histogram.counts):
+                    merged.counts[index] += count
+                merged.count += histogram.count
+                merged.total += histogram.total
+                merged.maximum = max(merged.maximum, histogram.maximum)
+
+    components = {}
+    for name, (cpu_before, _, _) in usage_before.items():
+        cpu_after, rss, peak_rss = usage_after[name]
+        components[name] = {"cpu_seconds": round(cpu_after - cpu_before, 3),
+                            "cpu_percent": round((cpu_after - cpu_before) / elapsed * 100, 1),
+                            "rss_kb": rss, "peak_rss_kb": peak_rss}
+
+    return {
+        "time": time.time(),
+        "version": git_version(),
+        "config": vars(args),
+        "duration": round(elapsed, 3),
+        "messages_per_second": {"sent": round(counters["sent"] / elapsed, 2),
+                                "acked": round(counters["acked"] / elapsed, 2)},
+        "messages": counters,
+        "commands": commands,
+        "latency_ms": {hop: histogram.summary() for hop, histogram in latency.items()},
+        "components": components,
+        "broker": broker_stats(processes["broker"]),
+    }
+
+
+def broker_stats(process):
+    # Broker prints its counters as last line when terminated
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        return None
+    process.reader.join(1)
+    last_line = None
+    while not process.lines.empty():
+        last_line = process.lines.get()
+    try:
+        return json.loads(last_line)
+    except (TypeError, ValueError):
+        return None
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BENCHMARK_DIRECTORY,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs PI script against virtual Arduinos and a local broker, drives "
+                                                 "it with PC clients and writes results as JSON")
+    parser.add_argument("--panels", type=int, default=3, help="Number of virtual Arduinos")
+    parser.add_argument("--clients", type=int, default=1, help="Number of PC clients")
+    parser.add_argument("--rate", type=float, default=10.0, help="Commands per second of all clients together")
+    parser.add_argument("--mix", default=COMMAND_MIX, help="Weights of commands, e.g. set=70,status=20,ON=5,OFF=5")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds to wait after PI answered first time")
+    parser.add_argument("--drain", type=float, default=DRAIN_TIME,
+                        help="Seconds to wait for acks after load stopped")
+    parser.add_argument("--protocol", choices=(codec.PROTOCOL_TEXT, codec.PROTOCOL_BINARY), default="text")
+    parser.add_argument("--trace", action="store_true", help="Measure per hop latency (PI script --trace)")
+    parser.add_argument("--asyncio", action="store_true", help="Run PI script with --asyncio")
+    parser.add_argument("--conversion-time", type=float, default=0.75,
+                        help="Seconds virtual Arduino spends reading temperature, 0 for fastest possible Arduinos")
+    parser.add_argument("--temperature", default="constant", help="Temperature curve of virtual Arduinos")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of command mix")
+    parser.add_argument("--output", help="JSON file for results, printed if not given")
+    parser.add_argument("--keep", action="store_true", help="Keep logs and PI state of run")
+    args = parser.parse_args()
+
+    # Client logs every message on NOTICE, which would cost more than sending it
+    logging.NOTICE = 25
+    logging.addLevelName(logging.NOTICE, "NOTICE")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,195 @@
+import argparse
+import asyncio
+import json
+import signal
+import struct
+
+# Minimal MQTT 3.1.1 broker, just enough for the PI script and PC clients in benchmarks: connect (any credentials),
+# subscribe with + and # wildcards, publish with QoS 0-2 and retained messages. Everything is delivered with QoS 0.
+# Not meant for real use, run mosquitto on PI for that
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+PACKET_ID = struct.Struct("!H")
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def read_string(body, offset):
+    (length,) = PACKET_ID.unpack_from(body, offset)
+    offset += PACKET_ID.size
+    return body[offset:offset + length].decode(errors="replace"), offset + length
+
+
+class Broker:
+    def __init__(self):
+        self.sessions = set()
+        self.connections = set()
+        self.retained = {}
+        # Counters printed as JSON on exit
+        self.stats = {"connections": 0, "received": 0, "received_bytes": 0, "delivered": 0, "delivered_bytes": 0,
+                      "topics": {}}
+
+    def publish(self, topic, payload, retain):
+        self.stats["received"] += 1
+        self.stats["received_bytes"] += len(payload)
+        self.stats["topics"][topic] = self.stats["topics"].get(topic, 0) + 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for session in list(self.sessions):
+            if any(topic_matches(topic_filter, topic) for topic_filter in session.subscriptions):
+                session.send_publish(topic, payload, False)
+
+    async def handle(self, reader, writer):
+        session = Session(self, writer)
+        self.connections.add(session)
+        self.stats["connections"] += 1
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                while True:
+                    (byte,) = await reader.readexactly(1)
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                if not session.handle(header[0] >> 4, header[0] & 0x0F, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            self.connections.discard(session)
+            writer.close()
+
+    async def close(self):
+        for session in list(self.connections):
+            session.writer.close()
+        while self.connections:
+            await asyncio.sleep(0.01)
+
+
+class Session:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.subscriptions = set()
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def send_publish(self, topic, payload, retain):
+        topic = topic.encode()
+        self.broker.stats["delivered"] += 1
+        self.broker.stats["delivered_bytes"] += len(payload)
+        self.send(packet(PUBLISH, 1 if retain else 0, PACKET_ID.pack(len(topic)) + topic + payload))
+
+    def handle(self, packet_type, flags, body):
+        # Returns False if connection should be closed
+        if packet_type == CONNECT:
+            self.broker.sessions.add(self)
+            self.send(packet(CONNACK, 0, b"\x00\x00"))
+        elif packet_type == PUBLISH:
+            qos = flags >> 1 & 0x03
+            topic, offset = read_string(body, 0)
+            packet_id = body[offset:offset + PACKET_ID.size]
+            if qos:
+                offset += PACKET_ID.size
+            self.broker.publish(topic, body[offset:], flags & 0x01)
+            if qos == 1:
+                self.send(packet(PUBACK, 0, packet_id))
+            elif qos == 2:
+                self.send(packet(PUBREC, 0, packet_id))
+        elif packet_type == PUBREL:
+            self.send(packet(PUBCOMP, 0, body[:PACKET_ID.size]))
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:PACKET_ID.size]
+            offset = PACKET_ID.size
+            topic_filters = []
+            while offset < len(body):
+                topic_filter, offset = read_string(body, offset)
+                offset += 1
+                topic_filters.append(topic_filter)
+            self.subscriptions.update(topic_filters)
+            self.send(packet(SUBACK, 0, packet_id + bytes(len(topic_filters))))
+            for topic, payload in list(self.broker.retained.items()):
+                if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                    self.send_publish(topic, payload, True)
+        elif packet_type == UNSUBSCRIBE:
+            offset = PACKET_ID.size
+            while offset < len(body):
+                topic_filter, offset = read_string(body, offset)
+                self.subscriptions.discard(topic_filter)
+            self.send(packet(UNSUBACK, 0, body[:PACKET_ID.size]))
+        elif packet_type == PINGREQ:
+            self.send(packet(PINGRESP, 0, b""))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+
+async def serve(port, stop):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, "127.0.0.1", port)
+    print(f"Broker listening on port {server.sockets[0].getsockname()[1]}", flush=True)
+    async with server:
+        await stop.wait()
+        await broker.close()
+    return broker.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal MQTT broker for benchmarks. Prints its counters as JSON on "
+                                                 "SIGTERM or Ctrl+C")
+    parser.add_argument("--port", type=int, default=1883, help="Port to listen on, 0 picks a free one")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stop.set)
+    stats = loop.run_until_complete(serve(args.port, stop))
+    print(json.dumps(stats), flush=True)
@@ -0,0 +1,238 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+PC_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "..", "PC")
+PI_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "..", "RaspberryPI")
+sys.path.insert(0, PC_DIRECTORY)
+sys.path.insert(1, PI_DIRECTORY)
+
+# codec.py and transport.py come from Shared directory for both sides
+import shared_modules
+import codec
+from Client import Client
+from transport import LoopbackBroker, TRANSPORT_LOOPBACK
+from ForRaspberryPI import PIController, parse_arguments, SCENE_OK, SCENE_UNKNOWN
+from schedule_engine import SCHEDULE_OK, SCHEDULE_STALE
+
+# Seconds every answer of PI is waited for
+ANSWER_TIMEOUT = 5.0
+# Panel used when PI runs without Arduinos
+DEFAULT_PANEL = 1
+
+
+class HarnessPC:
+    # PC side of the harness: Client on the loopback broker. Everything PI sends is kept until a check takes it, so
+    # checks can wait for messages in any order (schedule_ack comes before ack of its command...)
+    def __init__(self, broker, protocol):
+        self.client = Client("harness_pc", None, None, protocol, TRANSPORT_LOOPBACK, broker)
+        self.condition = threading.Condition()
+        self.received = []
+
+    def connect(self):
+        self.client.client.message_callback_add(codec.PI_TO_PC, self.on_message)
+        if not self.client.connect("localhost"):
+            return False
+        deadline = time.monotonic() + ANSWER_TIMEOUT
+        while not self.client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.client.subscribe_to_topic(codec.PI_TO_PC)
+        return self.client.is_connected()
+
+    def on_message(self, client, userdata, message):
+        try:
+            command, content, sequence = codec.decode(codec.PI_TO_PC, message.payload)
+        except codec.CodecError:
+            command, content = "damaged", [message.payload]
+        if command == "ack":
+            self.client.acknowledge(content[0])
+        with self.condition:
+            self.received.append((command, list(content)))
+            self.condition.notify_all()
+
+    def send(self, command, fields):
+        return self.client.publish_command(codec.PC_TO_PI, command, fields)
+
+    def wait_for(self, command, match=None, timeout=ANSWER_TIMEOUT):
+        # Takes first message of given command whose content passes match. Returns its content or None on timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for index, (received_command, content) in enumerate(self.received):
+                    if received_command == command and (match is None or match(content)):
+                        del self.received[index]
+                        return content
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def ack_of(self, sequence):
+        # Result code PI acknowledged message with or None
+        content = self.wait_for("ack", lambda content: content[0] == sequence)
+        return None if content is None else content[1]
+
+    def clear(self):
+        with self.condition:
+            self.received = []
+
+    def disconnect(self):
+        self.client.purpose_disconnect()
+        self.client.client.disconnect()
+
+
+def run_checks(pc, panel_number, has_arduinos):
+    # One exchange of every kind PC has with PI. Returns number of failed checks
+    failed = []
+
+    def check(name, passed):
+        print(f"{name:<48}{'ok' if passed else 'FAILED'}")
+        if not passed:
+            failed.append(name)
+
+    sequence = pc.send("set", [panel_number, 10, 20, 30, 40])
+    check("set is acknowledged", pc.ack_of(sequence) == codec.ACK_OK)
+    if has_arduinos:
+        status = pc.wait_for("status", lambda content: content[0] == panel_number and content[1:5] == [10, 20, 30, 40])
+        check("Arduino answers set with its status", status is not None)
+
+    sequence = pc.send("status", [panel_number])
+    check("status is acknowledged", pc.ack_of(sequence) == codec.ACK_OK)
+
+    slot = (600, 660, 50, 50, 50, 50, 0, 0)
+    sequence = pc.send("ON", [panel_number, slot])
+    schedule_ack = pc.wait_for("schedule_ack", lambda content: content[0] == panel_number)
+    check("ON is acknowledged", pc.ack_of(sequence) == codec.ACK_OK)
+    check("schedule is accepted", schedule_ack is not None and schedule_ack[1] == SCHEDULE_OK)
+    version = schedule_ack[2] if schedule_ack is not None else 0
+
+    pc.send("slot_add", [panel_number, version - 1, (700, 760, 1, 2, 3, 4, 0, 0)])
+    schedule_ack = pc.wait_for("schedule_ack", lambda content: content[0] == panel_number)
+    check("change against old version is stale", schedule_ack is not None and schedule_ack[1] == SCHEDULE_STALE)
+
+    pc.send("slot_replace", [panel_number, version, 600, (600, 700, 60, 60, 60, 60, 30, 30)])
+    schedule_ack = pc.wait_for("schedule_ack", lambda content: content[0] == panel_number)
+    check("slot is replaced in place",
+          schedule_ack is not None and schedule_ack[1] == SCHEDULE_OK and schedule_ack[2] == version + 1)
+
+    sequence = pc.send("slot_add", [panel_number, version + 1, (1400, 1440, 1, 1, 1, 1, 0, 0)])
+    schedule_ack = pc.wait_for("schedule_ack", lambda content: content[0] == panel_number)
+    check("slot past end of day is rejected", schedule_ack is not None and schedule_ack[1] != SCHEDULE_OK)
+    pc.ack_of(sequence)
+
+    pc.send("OFF", [panel_number])
+    schedule_ack = pc.wait_for("schedule_ack", lambda content: content[0] == panel_number)
+    check("OFF clears schedule", schedule_ack is not None and schedule_ack[1] == SCHEDULE_OK)
+
+    pc.send("scene_save", ["harness", (panel_number, 1, 2, 3, 4)])
+    check("scene is saved", pc.wait_for("scene_ack") == [SCENE_OK, 1, "harness"])
+    pc.send("scene_recall", ["harness"])
+    check("scene is recalled", pc.wait_for("scene_ack") == [SCENE_OK, 1, "harness"])
+    pc.send("scene_delete", ["harness"])
+    check("scene is deleted", pc.wait_for("scene_ack") == [SCENE_OK, 0, "harness"])
+    sequence = pc.send("scene_recall", ["harness"])
+    check("deleted scene is unknown", pc.wait_for("scene_ack") == [SCENE_UNKNOWN, 0, "harness"])
+    check("recall of unknown scene is nacked", pc.ack_of(sequence) == codec.ACK_FAILED)
+
+    now = int(time.time())
+    pc.send("history", [panel_number, now - 60, now + 1, 1])
+    check("history is answered", pc.wait_for("history", lambda content: content[0] == panel_number) is not None)
+
+    pc.client.client.publish(codec.PC_TO_PI, b"<damaged>")
+    check("damaged message is reported", pc.wait_for("error") is not None)
+
+    return failed
+
+
+def run_round_trips(pc, panel_number, count):
+    # Status requests one after another, each waits for its ack. Measures PC -> PI -> PC without broker or sockets
+    pc.client.latency.reset()
+    started = time.monotonic()
+    for _ in range(count):
+        sequence = pc.send("status", [panel_number])
+        if pc.ack_of(sequence) is None:
+            print(f"Status request #{sequence} was not acknowledged")
+            break
+    elapsed = time.monotonic() - started
+    print(f"\n{count} round trips in {elapsed:.2f} s ({count / elapsed:.0f}/s)")
+    print(pc.client.latency.report())
+
+
+def run_harness(args):
+    state_directory = tempfile.mkdtemp(prefix="loopback_harness_")
+    broker = LoopbackBroker()
+    arduinos = []
+    pi = None
+    pc = None
+    try:
+        if args.panels:
+            # Imported here, PI without Arduinos needs neither simulator nor pyserial
+            from arduino_simulator import TemperatureCurve, start_simulators
+            curves = {panel_number: TemperatureCurve("constant", 22.0, 0.5, 120.0, 30.0, 600.0)
+                      for panel_number in range(1, args.panels + 1)}
+            arduinos = start_simulators(sorted(curves), curves, args.conversion_time)
+
+        # PI runs like with its command line, on its own loopback broker and with state in a temporary directory
+        pi_arguments = ["--transport", TRANSPORT_LOOPBACK, "--protocol", args.protocol, "--state-directory",
+                        state_directory, "--metrics-port", "0", "--metrics-interval", "0",
+                        "--ports", *(arduino.device for arduino in arduinos)]
+        if args.trace:
+            pi_arguments.append("--trace")
+        pi = PIController(parse_arguments(pi_arguments), broker)
+        pi.start_up()
+        pi.start()
+        pi.client.loop_start()
+
+        pc = HarnessPC(broker, args.protocol)
+        if not pc.connect():
+            print("PC could not connect to loopback broker")
+            return 1
+        # PI pings on start, that and status from start up are not part of any check
+        time.sleep(0.1)
+        pc.clear()
+
+        panel_number = 1 if arduinos else DEFAULT_PANEL
+        failed = run_checks(pc, panel_number, bool(arduinos))
+        if args.round_trips:
+            run_round_trips(pc, panel_number, args.round_trips)
+        if failed:
+            print(f"\n{len(failed)} checks failed: {', '.join(failed)}")
+            return 1
+        print("\nAll checks passed")
+        return 0
+    finally:
+        if pc is not None:
+            pc.disconnect()
+        if pi is not None:
+            pi.stop()
+            pi.client.loop_stop()
+        for arduino in arduinos:
+            arduino.stop()
+        shutil.rmtree(state_directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs PC client and PI logic in one process over the loopback "
+                                                 "transport, checks every kind of exchange and measures round trips")
+    parser.add_argument("--panels", type=int, default=0,
+                        help="Number of virtual Arduinos (PI then needs pyserial), 0 runs PI without serial ports")
+    parser.add_argument("--conversion-time", type=float, default=0.75,
+                        help="Seconds virtual Arduino spends reading temperature")
+    parser.add_argument("--protocol", choices=(codec.PROTOCOL_TEXT, codec.PROTOCOL_BINARY), default="text")
+    parser.add_argument("--trace", action="store_true", help="Run PI logic with --trace")
+    parser.add_argument("--round-trips", type=int, default=1000,
+                        help="Status requests timed after checks, 0 skips the measurement")
+    args = parser.parse_args()
+
+    # Client logs every message on NOTICE, which would cost more than sending it
+    logging.NOTICE = 25
+    logging.addLevelName(logging.NOTICE, "NOTICE")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    sys.exit(run_harness(args))
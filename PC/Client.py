@@ -1,13 +1,23 @@
-import paho.mqtt.client as mqtt
 import logging
-import hashlib
+import itertools
+import threading
+import codec
+from latency import LatencyTracker
+from transport import create_client, CONNACK_ACCEPTED, TRANSPORT_MQTT
 # Basic functionality implemented, however callback functions are not since they depend on per client basis
 
+# Messages still waiting for ack. When PI does not answer the oldest ones are forgotten
+MAX_PENDING = 256
+
 
 class Client:
-    def __init__(self, mqtt_name, username, password):
+    def __init__(self, mqtt_name, username, password, protocol=codec.PROTOCOL_TEXT, transport=TRANSPORT_MQTT,
+                 broker=None, namespace=""):
+        # transport and broker, see transport.create_client. Default is paho client and real broker
+        # Namespace prefixes topics of PI started with --namespace, see codec.device_topic
         self.client_id = mqtt_name
-        self.client = mqtt.Client(mqtt_name)
+        self.namespace = namespace
+        self.client = create_client(mqtt_name, transport, broker)
         self.client.username_pw_set(username, password)
 
         self.client.on_connect = self.on_connect
@@ -15,13 +25,24 @@ class Client:
 
         self.connected = False
         self.lost_connection = False
+        # Called from network thread after every successful (re)connect
+        self.on_connected = None
+
+        # Wire format of published messages, see codec
+        self.protocol = protocol
+        self.sequence = itertools.count()
+        # sequence -> command of messages not acknowledged yet
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        # Round trip and per hop latency of commands, correlated by sequence number
+        self.latency = LatencyTracker()
 
         self.logger = logging.getLogger()
 
-    def connect(self, rp_ip):
+    def connect(self, rp_ip, port=1883):
         self.log_message("NOTICE", f"{self.client_id} is connecting to MQTT broker on RP...")
-        result_code = self.client.connect(rp_ip, 1883, 20)
-        if result_code != mqtt.CONNACK_ACCEPTED:
+        result_code = self.client.connect(rp_ip, port, 20)
+        if result_code != CONNACK_ACCEPTED:
             self.log_message("ERROR", f"{self.client_id} failed MQTT connection with result code {result_code}.")
             self.log_message("ERROR", "Make sure MQTT broker is running on PI!")
             return False
@@ -32,20 +53,43 @@ class Client:
         if rc == 0:
             self.log_message("NOTICE", f"{self.client_id} successfully connected to broker!")
             self.connected = True
+            if self.on_connected is not None:
+                self.on_connected()
         else:
             self.log_message("ERROR", f"{self.client_id} failed to connect to broker. Retrying...")
 
-    def publish_message(self, topic, message):
-        if self.connected:
-            self.client.publish(topic, message + self.generate_hash(message))
-            self.log_message("NOTICE", f"{self.client_id} published message: {message}")
-        else:
+    def publish_command(self, topic, command, fields):
+        # Returns sequence number of published message or None if not connected
+        if not self.connected:
             self.log_message("ERROR", f"{self.client_id} is not connected to broker!")
+            return None
+        sequence = next(self.sequence) % codec.SEQUENCE_MODULO
+        with self.pending_lock:
+            self.pending[sequence] = command
+            if len(self.pending) > MAX_PENDING:
+                del self.pending[next(iter(self.pending))]
+        payload = codec.encode(topic, command, fields, self.protocol, sequence)
+        self.latency.sent(sequence)
+        self.client.publish(codec.device_topic(self.namespace, topic), payload)
+        self.log_message("NOTICE", f"{self.client_id} published message #{sequence}: {command} {fields}")
+        return sequence
+
+    def acknowledge(self, sequence):
+        # Returns command of acknowledged message or None if it is not known (too old or sent before restart)
+        self.latency.acknowledged(sequence)
+        with self.pending_lock:
+            return self.pending.pop(sequence, None)
 
     def subscribe_to_topic(self, topic):
+        topic = codec.device_topic(self.namespace, topic)
         self.client.subscribe(topic)
         self.log_message("NOTICE", f"{self.client_id} subscribed to topic: {topic}")
 
+    def add_topic_callback(self, topic, callback):
+        # Subscribes and routes messages of topic (and its wildcards) to callback(client, userdata, message)
+        self.subscribe_to_topic(topic)
+        self.client.message_callback_add(codec.device_topic(self.namespace, topic), callback)
+
     def on_disconnect(self, client, userdata, rc):
         self.connected = False
         self.lost_connection = True
@@ -70,8 +114,3 @@ class Client:
             self.logger.log(logging.ERROR, message_to_log)
         elif log_level == 'CRITICAL':
             self.logger.log(logging.CRITICAL, message_to_log)
-
-    @staticmethod
-    def generate_hash(message_to_hash):
-        hash_object = hashlib.sha256(message_to_hash.encode())
-        return hash_object.hexdigest()
@@ -1,11 +1,18 @@
 import tkinter as tk
+from tkinter import filedialog
 import PI_handler
 import Client
-from project_config import MQTT_PASSWORD, MQTT_USERNAME
+from project_config import MQTT_PASSWORD, MQTT_USERNAME, MQTT_PROTOCOL, PANELS, PANEL_COLUMNS
 import logging
 import time
 from scheduler import Scheduler
-import hashlib
+import codec
+from profiling import Profiler
+from panels import PanelRegistry
+from panel_view import PanelView
+
+# Channels of every row of panel history, each as min, max and mean
+HISTORY_CHANNELS = ("fir", "nir", "vis", "uv", "temp1", "temp2", "temp3")
 
 
 class GUI:
@@ -13,7 +20,7 @@ class GUI:
         # Initial setup
         self.master = master
         master.title("Light Controller")
-        master.geometry("950x800")
+        master.geometry("1000x800")
 
         self.logger = logging.getLogger()
 
@@ -25,12 +32,16 @@ class GUI:
         self.rp_script = rp_script
 
         # Setup PC client
-        self.pc_client = Client.Client(mqtt_name, MQTT_USERNAME, MQTT_PASSWORD)
+        self.pc_client = Client.Client(mqtt_name, MQTT_USERNAME, MQTT_PASSWORD, MQTT_PROTOCOL)
+        self.pc_client.on_connected = lambda: PI_handler.start_status_stream(self.pc_client)
+
+        # Profiling of PC's message handler, started and stopped together with PI's
+        self.profiler = Profiler(".", "pc_profile")
+        self.timed_message_handler = self.profiler.wrap("on_message_received_from_PI", self.on_message_received_from_PI)
 
-        # Button variables
-        self.l1_switch_state = False
-        self.l2_switch_state = False
-        self.l3_switch_state = False
+        # Panels and their widgets, one PanelView per registered panel
+        self.panels = PanelRegistry(PANELS)
+        self.panel_views = {}
 
         # Handle UI elements
         self.set_up_UI_elements()
@@ -38,11 +49,6 @@ class GUI:
         # Error handling
         self.error_code = 0
 
-        # Scheduler
-        self.slots_light1 = []
-        self.slots_light2 = []
-        self.slots_light3 = []
-
         # Timer to keep connection alive
         self.timer = 0
 
@@ -63,7 +69,8 @@ class GUI:
     def start_and_setup_PI(self):
         # Terminate all active scripts and start RP script
         return PI_handler.stop_PI_scripts(self.rp_ip, self.rp_username, self.rp_password, self.rp_script) and \
-               PI_handler.run_PI_script(self.rp_ip, self.rp_username, self.rp_password, self.rp_script)
+               PI_handler.run_PI_script(self.rp_ip, self.rp_username, self.rp_password, self.rp_script,
+                                        PI_handler.get_script_args())
 
     def connect_clicked(self):
         # User can keep clicking button and nothing happens
@@ -88,7 +95,12 @@ class GUI:
 
         # Subscribe on channel pi-to-pc and bind callback function
         self.pc_client.subscribe_to_topic("pi_to_pc")
-        self.pc_client.client.message_callback_add("pi_to_pc", self.on_message_received_from_PI)
+        self.pc_client.client.message_callback_add("pi_to_pc", self.timed_message_handler)
+
+        # Streamed status of every panel comes on its own topic, handled same as status on pi-to-pc
+        panel_topics = codec.PANEL_TOPIC.format("+")
+        self.pc_client.subscribe_to_topic(panel_topics)
+        self.pc_client.client.message_callback_add(panel_topics, self.timed_message_handler)
 
         # Button handling:
         self.change_button_state_to_all_buttons("normal")
@@ -168,7 +180,7 @@ class GUI:
 
         if error_num == 3:
             # PI is not operational, resetting in effect
-            # NOTE all scheduler content is LOST
+            # Schedules and last setpoints are restored by PI itself from its state store
             self.log_message("CRITICAL", "Script cannot be run. Restarting PI!")
             PI_handler.reset_PI(self.rp_ip, self.rp_username, self.rp_password)
             time.sleep(30)
@@ -177,57 +189,63 @@ class GUI:
         self.connect_clicked()
 
     def change_button_state_to_all_buttons(self, new_state):
-        self.change_button_state(self.button3, new_state)
-        self.change_button_state(self.button4, new_state)
-        self.change_button_state(self.button5, new_state)
-
-        self.change_button_state(self.button6, new_state)
-        self.change_button_state(self.button7, new_state)
-        self.change_button_state(self.button8, new_state)
+        for view in self.panel_views.values():
+            view.set_state(new_state)
 
-        self.change_button_state(self.l1_switch, new_state)
-        self.change_button_state(self.l2_switch, new_state)
-        self.change_button_state(self.l3_switch, new_state)
+        self.change_button_state(self.button_confirm_all, new_state)
+        self.change_button_state(self.button_save_scene, new_state)
+        self.change_button_state(self.button_recall_scene, new_state)
+        self.change_button_state(self.button_history, new_state)
+        self.change_button_state(self.button_profile, new_state)
 
     def change_button_state(self, button, new_state):
         button.config(state=new_state)
 
-    def update_label(self, label, type_, value):
-        label.config(text=f"{type_}: {value}%")
-
-    def update_label_temp(self, label, value):
-        label.config(text=f"{value}°C")
+    def get_set_values(self, panel_number):
+        # Fields of set message for given panel as read from sliders, None if panel does not exist. Channels go in
+        # codec's order (panel, fir, nir, vis, uv) like everywhere else, fleet GUI sends the same fields
+        view = self.panel_views.get(panel_number)
+        if view is None:
+            return None
+        return [panel_number] + view.get_values()
 
     def confirm_clicked(self, panel_number):
         # If not connected do not send anything
         if not self.pc_client.is_connected():
             return
 
-        if panel_number == 1:
-            nir = self.scale_panel_1_NIR.get()
-            fir = self.scale_panel_1_FIR.get()
-            vis = self.scale_panel_1_VIS.get()
-            uv = self.scale_panel_1_UV.get()
-        elif panel_number == 2:
-            nir = self.scale_panel_2_NIR.get()
-            fir = self.scale_panel_2_FIR.get()
-            vis = self.scale_panel_2_VIS.get()
-            uv = self.scale_panel_2_UV.get()
-        elif panel_number == 3:
-            nir = self.scale_panel_3_NIR.get()
-            fir = self.scale_panel_3_FIR.get()
-            vis = self.scale_panel_3_VIS.get()
-            uv = self.scale_panel_3_UV.get()
-        else:
+        values = self.get_set_values(panel_number)
+        if values is None:
             print("Internal error!")
             return
 
-        self.pc_client.publish_message("pc_to_pi", f"set,{panel_number},{nir},{fir},{vis},{uv},")
+        self.pc_client.publish_command("pc_to_pi", "set", values)
+
+    def confirm_all_clicked(self):
+        # All panels are set with one message and change at the same time
+        if not self.pc_client.is_connected():
+            return
+        entries = [tuple(self.get_set_values(panel_number)) for panel_number in self.panels.numbers()]
+        self.pc_client.publish_command("pc_to_pi", "scene", entries)
+
+    def save_scene_clicked(self):
+        # Store current slider values of all panels on PI under given name
+        name = self.scene_name.get().strip()
+        if not self.pc_client.is_connected() or not name:
+            return
+        entries = [tuple(self.get_set_values(panel_number)) for panel_number in self.panels.numbers()]
+        self.pc_client.publish_command("pc_to_pi", "scene_save", [name] + entries)
+
+    def recall_scene_clicked(self):
+        name = self.scene_name.get().strip()
+        if not self.pc_client.is_connected() or not name:
+            return
+        self.pc_client.publish_command("pc_to_pi", "scene_recall", [name])
 
     def status_clicked(self, panel_number):
         if not self.pc_client.is_connected():
             return
-        self.pc_client.publish_message("pc_to_pi", f"status,{panel_number},")
+        self.pc_client.publish_command("pc_to_pi", "status", [panel_number])
 
     def update_timer(self):
         self.timer += 1
@@ -242,178 +260,318 @@ class GUI:
     def restart_timer(self):
         self.timer = 0
 
-    def validate_message(self, components):
+    def validate_message(self, payload):
+        # Returns (command, content, sequence) or None if message should not be processed
         # No matter what restart timer as connection seems to be alive
         self.restart_timer()
-        if components[0] == "echo":
-            # It is just echo we don't need to process the message
-            return False
-        # Recreate sent message and compare hashes
-        received_hash = components[-1]
-        original_message = ','.join(components[:-1]) + ','
-        generated_hash = self.generate_hash(original_message)
-
-        if received_hash != generated_hash:
+        try:
+            decoded = codec.decode("pi_to_pc", payload)
+        except codec.CodecError:
             # TODO: Hash mismatch handling. For now we don't do anything and disregard message
             self.log_message("CRITICAL", "Hashes do not match, therefore received message was not received properly. "
                                          "Likely lost data. Disregarding message...")
-            return False
-        return True
+            return None
+        if decoded[0] == "echo":
+            # It is just echo (PI runs in debug mode) we don't need to process the message
+            return None
+        return decoded
 
     def on_message_received_from_PI(self, client, userdata, message):
-        # 1.Decode message
-        message = message.payload.decode()
+        # 1. Take raw message, text and binary frames are told apart by codec
+        payload = message.payload
 
         # 2. Log the message regardless of what happens
-        self.log_message("NOTICE", "Received message on PC: " + message)
-
-        # 3. Split message by comma
-        components = message.split(",")
+        self.log_message("NOTICE", "Received message on PC: " + codec.to_log_string(payload))
 
-        # 4. Check message validity
-        if not self.validate_message(components):
+        # 3. Check message validity
+        decoded = self.validate_message(payload)
+        if decoded is None:
             return
 
-        # 5. Hashes match so we can now decide what do to
-        content = components[1:-1]
+        # 4. Message is valid so we can now decide what do to
+        command, content, sequence = decoded
 
-        if "check" in message:
+        if command == "check":
             self.restart_timer()
 
-        elif "status" in message:
+        elif command == "status":
             try:
-                integers = [int(c) for c in content]
-                self.set_status_labels(integers[0], integers[1], integers[2], integers[3], integers[4],
-                                       integers[5], integers[6], integers[7])
+                panel_number = content[0]
+                if panel_number in self.panels:
+                    self.set_status_labels(*content[:8])
+                elif panel_number >= 1:
+                    # Panel that is not configured, its widgets are built on tkinter's thread
+                    self.master.after(0, self.add_panel, *content[:8])
             except:
                 pass
 
-    def set_status_labels(self, panel_number, fir, nir, vis, uv, temp1, temp2, temp3):
-        self.update_label(self.panel_labels[panel_number-1][0], "F-IR", fir)
-        self.update_label(self.panel_labels[panel_number - 1][1], "N-IR", nir)
-        self.update_label(self.panel_labels[panel_number-1][2], "VIS", vis)
-        self.update_label(self.panel_labels[panel_number-1][3], "UV", uv)
-        self.update_label_temp(self.panel_labels[panel_number-1][4], temp1)
-        self.update_label_temp(self.panel_labels[panel_number - 1][5], temp2)
-        self.update_label_temp(self.panel_labels[panel_number - 1][6], temp3)
-
-    # Scheduler code
+        elif command == "ack":
+            try:
+                acked_sequence, result = content[:2]
+                acked_command = self.pc_client.acknowledge(acked_sequence)
+                if result != codec.ACK_OK:
+                    self.log_message("ERROR", f"PI rejected message #{acked_sequence} ({acked_command}) "
+                                              f"with code {result}")
+            except:
+                pass
 
-    def toggle(self, panel_number):
-        if not self.pc_client.is_connected():
-            return
+        elif command == "trace":
+            try:
+                self.pc_client.latency.traced(*content[:5])
+            except:
+                pass
 
-        # TODO: add read from file
+        elif command == "history":
+            try:
+                self.save_history(content[0], content[1], content[2:])
+            except:
+                pass
 
-        contents = self.get_scheduler_contents(panel_number)
+        elif command == "alarm":
+            try:
+                panel_number, level, temperature = content[:3]
+                if level == 2:
+                    self.log_message("CRITICAL", f"Panel {panel_number} overheated ({temperature} C), PWM cut by PI!")
+                elif level == 1:
+                    self.log_message("WARNING", f"Panel {panel_number} is hot ({temperature} C), PWM derated by PI")
+                else:
+                    self.log_message("NOTICE", f"Panel {panel_number} cooled down ({temperature} C), PWM restored")
+            except:
+                pass
 
-        if panel_number == 1:
-            self.l1_switch_state = not self.l1_switch_state
+        elif command == "schedule_ack":
+            try:
+                self.on_schedule_ack(*content[:3])
+            except:
+                pass
 
-            if self.l1_switch_state:
-                self.label_light_1.config(foreground="green", text="ACTIVE")
-                self.change_button_state(self.button3, "disabled")
-                # self.change_button_state(self.button_sch_1, "disabled")
+        elif command == "text":
+            self.log_message("NOTICE", f"PI: {content[0]}")
 
-                self.pc_client.publish_message("pc_to_pi", f"ON,{panel_number},{contents}")
+        elif command == "scene_ack":
+            result, panel_count, name = content[:3]
+            if result == 0:
+                self.log_message("NOTICE", f"Scene {name} applied/stored on PI ({panel_count} panels)")
             else:
-                self.label_light_1.config(foreground="red", text="INACTIVE")
-                self.change_button_state(self.button3, "normal")
-                self.change_button_state(self.button_sch_1, "normal")
+                self.log_message("ERROR", f"Scene {name} was rejected by PI with code {result}")
 
-                self.pc_client.publish_message("pc_to_pi", f"OFF,{panel_number},")
+    def set_status_labels(self, panel_number, fir, nir, vis, uv, temp1, temp2, temp3):
+        self.panel_views[panel_number].set_status(fir, nir, vis, uv, temp1, temp2, temp3)
+
+    def add_panel(self, panel_number, *status):
+        # Registers panel and shows its widgets, all panels are laid out again so they stay in order
+        if panel_number not in self.panels:
+            self.panels.add(panel_number)
+            view = PanelView(self.panels_frame, panel_number, self)
+            self.panel_views[panel_number] = view
+            if self.pc_client.is_connected():
+                view.set_state("normal")
+            self.layout_panels()
+            self.log_message("NOTICE", f"Panel {panel_number} added")
+        if status:
+            self.set_status_labels(panel_number, *status)
 
-        elif panel_number == 2:
-            self.l2_switch_state = not self.l2_switch_state
+    def layout_panels(self):
+        for index, panel_number in enumerate(self.panels.numbers()):
+            self.panel_views[panel_number].grid(index // PANEL_COLUMNS, index % PANEL_COLUMNS)
 
-            if self.l2_switch_state:
-                self.label_light_2.config(foreground="green", text="ACTIVE")
-                self.change_button_state(self.button4, "disabled")
-                # self.change_button_state(self.button_sch_2, "disabled")
+    # Scheduler code
 
-                self.pc_client.publish_message("pc_to_pi", f"ON,{panel_number},{contents}")
-            else:
-                self.label_light_2.config(foreground="red", text="INACTIVE")
-                self.change_button_state(self.button4, "normal")
-                self.change_button_state(self.button_sch_2, "normal")
+    def toggle(self, panel_number):
+        if not self.pc_client.is_connected():
+            return
 
-                self.pc_client.publish_message("pc_to_pi", f"OFF,{panel_number},")
+        # TODO: add read from file
 
-        elif panel_number == 3:
-            self.l3_switch_state = not self.l3_switch_state
+        panel = self.panels.get(panel_number)
+        if panel is None:
+            return
+        panel.schedule_active = not panel.schedule_active
+        panel.schedule_version = None
+        panel.resync_version = None
+        self.panel_views[panel_number].set_schedule_active(panel.schedule_active)
 
-            if self.l3_switch_state:
-                self.label_light_3.config(foreground="green", text="ACTIVE")
-                self.change_button_state(self.button5, "disabled")
-                # self.change_button_state(self.button_sch_3, "disabled")
+        if panel.schedule_active:
+            self.pc_client.publish_command("pc_to_pi", "ON", [panel_number] + self.get_scheduler_contents(panel_number))
+        else:
+            self.pc_client.publish_command("pc_to_pi", "OFF", [panel_number])
+
+    def get_switch_state(self, panel_number):
+        panel = self.panels.get(panel_number)
+        return panel is not None and panel.schedule_active
+
+    def send_schedule_changes(self, panel_number, old_slots, new_slots):
+        panel = self.panels.get(panel_number)
+        version = panel.schedule_version
+        if version is None:
+            # We don't know schedule version on PI, upload everything
+            self.pc_client.publish_command("pc_to_pi", "ON",
+                                           [panel_number] + self.get_scheduler_contents(panel_number))
+            return
 
-                self.pc_client.publish_message("pc_to_pi", f"ON,{panel_number},{contents}")
-            else:
-                self.label_light_3.config(foreground="red", text="INACTIVE")
-                self.change_button_state(self.button5, "normal")
-                self.change_button_state(self.button_sch_3, "normal")
+        old = {slot[0]: (slot[0], slot[1], *slot[2]) for slot in old_slots}
+        new = {slot[0]: (slot[0], slot[1], *slot[2]) for slot in new_slots}
+
+        # Removes go first so they never collide with added or moved slots. Every change is made against version
+        # that previous one produces, if any is rejected PI answers with error and we upload everything
+        changes = []
+        for start in old:
+            if start not in new:
+                changes.append(("slot_remove", [start]))
+        for start, slot in new.items():
+            if start not in old:
+                changes.append(("slot_add", [slot]))
+            elif old[start] != slot:
+                changes.append(("slot_replace", [start, slot]))
+
+        for command, fields in changes:
+            self.pc_client.publish_command("pc_to_pi", command, [panel_number, version] + fields)
+            version += 1
+        panel.schedule_version = version
+
+    def on_schedule_ack(self, panel_number, result, version):
+        panel = self.panels.get(panel_number)
+        if panel is None:
+            return
+        if panel.resync_version is not None:
+            # Every change chained after a rejected one is rejected with same PI version. Those and acks of changes sent
+            # before the upload are ignored, upload's own ack carries a newer version
+            if version <= panel.resync_version:
+                return
+            panel.resync_version = None
+        if result == 0:
+            # Acks of chained changes arrive in order, never go back to older version
+            if panel.schedule_version is None or version > panel.schedule_version:
+                panel.schedule_version = version
+            return
 
-                self.pc_client.publish_message("pc_to_pi", f"OFF,{panel_number},")
+        self.log_message("WARNING", f"Schedule change for panel {panel_number} rejected by PI with code {result}. "
+                                    f"Uploading whole schedule.")
+        panel.schedule_version = None
+        if panel.schedule_active:
+            panel.resync_version = version
+            self.pc_client.publish_command("pc_to_pi", "ON",
+                                           [panel_number] + self.get_scheduler_contents(panel_number))
 
     def get_scheduler_contents(self, panel_number):
-        string_representation = ""
-        if panel_number == 1:
-            for slot in self.slots_light1:
-                string_representation += f"{slot[0]};{slot[1]};{';'.join(str(i) for i in slot[2])},"
-        elif panel_number == 2:
-            for slot in self.slots_light2:
-                string_representation += f"{slot[0]};{slot[1]};{';'.join(str(i) for i in slot[2])},"
-        elif panel_number == 3:
-            for slot in self.slots_light3:
-                string_representation += f"{slot[0]};{slot[1]};{';'.join(str(i) for i in slot[2])},"
-        return string_representation
+        # Slots as (start, stop, fir, nir, vis, uv, ramp in, ramp out), codec takes care of wire format
+        panel = self.panels.get(panel_number)
+        slots = panel.slots if panel is not None else []
+        return [(slot[0], slot[1], *slot[2]) for slot in slots]
 
     def clear_log(self):
         with open("log.log", "w"):
             pass
 
-    def open_scheduler(self, panel_number):
-        # Disable scheduler button
-        current_slots = []
-        if panel_number == 1:
-            self.change_button_state(self.button_sch_1, "disabled")
-            self.change_button_state(self.l1_switch, "disabled")
-
-            current_slots = self.slots_light1
-        elif panel_number == 2:
-            self.change_button_state(self.button_sch_2, "disabled")
-            self.change_button_state(self.l2_switch, "disabled")
-
-            current_slots = self.slots_light2
-        elif panel_number == 3:
-            self.change_button_state(self.button_sch_3, "disabled")
-            self.change_button_state(self.l3_switch, "disabled")
+    def latency_clicked(self):
+        popup = tk.Toplevel()
+        popup.title("Latency")
+        report = tk.Text(popup, width=75, height=9, font=("Courier", 10))
+        report.pack(padx=10, pady=10)
+        self.show_latency(report)
+
+        tk.Button(popup, text="Refresh", command=lambda: self.show_latency(report)).pack(side=tk.LEFT, padx=10, pady=5)
+        tk.Button(popup, text="Save to file", command=self.save_latency_clicked).pack(side=tk.LEFT, padx=10, pady=5)
+        tk.Button(popup, text="Reset", command=lambda: self.reset_latency(report)).pack(side=tk.LEFT, padx=10, pady=5)
+
+    def show_latency(self, report):
+        report.delete("1.0", tk.END)
+        report.insert(tk.END, self.pc_client.latency.report())
+
+    def reset_latency(self, report):
+        self.pc_client.latency.reset()
+        self.show_latency(report)
+
+    def save_latency_clicked(self):
+        path = filedialog.asksaveasfilename(defaultextension=".json", initialfile="latency.json")
+        if not path:
+            return
+        try:
+            self.pc_client.latency.dump(path)
+            self.log_message("NOTICE", f"Latency histograms saved to {path}")
+        except OSError as e:
+            self.log_message("ERROR", f"Could not save latency histograms: {e}")
+
+    def profile_clicked(self):
+        # PI sends its timings as text once stopped, its stacks stay on PI
+        if not self.pc_client.is_connected():
+            return
+        if not self.profiler.is_running():
+            self.profiler.start()
+            self.pc_client.publish_command("pc_to_pi", "profile", [1, 0])
+            self.button_profile.config(text="Stop")
+            return
+        self.pc_client.publish_command("pc_to_pi", "profile", [0, 0])
+        self.button_profile.config(text="Profile")
+        try:
+            path = self.profiler.stop()
+            self.log_message("NOTICE", f"PC profile:\n{self.profiler.report()}\nStacks written to {path}")
+        except OSError as e:
+            self.log_message("ERROR", f"Could not write PC profile: {e}")
+
+    def history_clicked(self):
+        popup = tk.Toplevel()
+        popup.title("History")
+        tk.Label(popup, text="Panel:").grid(row=0, column=0, padx=10, pady=5, sticky="w")
+        panel_entry = tk.Entry(popup, width=10)
+        panel_entry.insert(0, "1")
+        panel_entry.grid(row=0, column=1, padx=10, pady=5)
+        tk.Label(popup, text="Last minutes:").grid(row=1, column=0, padx=10, pady=5, sticky="w")
+        minutes_entry = tk.Entry(popup, width=10)
+        minutes_entry.insert(0, "60")
+        minutes_entry.grid(row=1, column=1, padx=10, pady=5)
+        tk.Label(popup, text="Resolution (s):").grid(row=2, column=0, padx=10, pady=5, sticky="w")
+        resolution_entry = tk.Entry(popup, width=10)
+        resolution_entry.insert(0, "60")
+        resolution_entry.grid(row=2, column=1, padx=10, pady=5)
+        tk.Button(popup, text="Request",
+                  command=lambda: self.request_history(panel_entry.get(), minutes_entry.get(),
+                                                       resolution_entry.get())).grid(row=3, column=0, columnspan=2,
+                                                                                     pady=10)
+
+    def request_history(self, panel_number, minutes, resolution):
+        if not self.pc_client.is_connected():
+            return
+        try:
+            panel_number, minutes, resolution = int(panel_number), int(minutes), int(resolution)
+        except ValueError:
+            self.log_message("ERROR", "History request needs whole numbers!")
+            return
+        stop = int(time.time())
+        # PI answers with history message, saved by save_history
+        self.pc_client.publish_command("pc_to_pi", "history", [panel_number, stop - minutes * 60, stop, resolution])
+
+    def save_history(self, panel_number, resolution, rows):
+        path = f"history_panel{panel_number}.csv"
+        header = ["time", "samples"] + [f"{channel}_{kind}" for channel in HISTORY_CHANNELS
+                                        for kind in ("min", "max", "mean")]
+        with open(path, "w") as file:
+            file.write(",".join(header) + "\n")
+            for row in rows:
+                file.write(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row[0])) + "," +
+                           ",".join(str(value) for value in row[1:]) + "\n")
+        self.log_message("NOTICE", f"History of panel {panel_number} ({len(rows)} rows, {resolution} s) saved to {path}")
 
-            current_slots = self.slots_light3
+    def open_scheduler(self, panel_number):
+        # Disable scheduler button and switch while schedule is edited
+        panel = self.panels.get(panel_number)
+        if panel is None:
+            return
+        self.panel_views[panel_number].set_scheduler_open(True, self.pc_client.is_connected())
 
         popup = tk.Toplevel()
-        scheduler = Scheduler(popup, current_slots)
+        scheduler = Scheduler(popup, panel.slots, f"Scheduler - panel {panel_number}")
         popup.wm_protocol("WM_DELETE_WINDOW", lambda: self.on_popup_close(scheduler, popup, panel_number))
 
     def on_popup_close(self, scheduler, popup, panel_number):
-        if panel_number == 1:
-            self.change_button_state(self.button_sch_1, "normal")
-            if self.pc_client.is_connected():
-                self.change_button_state(self.l1_switch, "normal")
+        panel = self.panels.get(panel_number)
+        self.panel_views[panel_number].set_scheduler_open(False, self.pc_client.is_connected())
+        old_slots = panel.slots
+        panel.slots = scheduler.get_slots()
 
-            self.slots_light1 = scheduler.get_slots()
-        elif panel_number == 2:
-            self.change_button_state(self.button_sch_2, "normal")
-            if self.pc_client.is_connected():
-                self.change_button_state(self.l2_switch, "normal")
-
-            self.slots_light2 = scheduler.get_slots()
-        elif panel_number == 3:
-            self.change_button_state(self.button_sch_3, "normal")
-            if self.pc_client.is_connected():
-                self.change_button_state(self.l3_switch, "normal")
-
-            self.slots_light3 = scheduler.get_slots()
+        # Active schedule on PI is updated in place with only what changed
+        if self.pc_client.is_connected() and panel.schedule_active:
+            self.send_schedule_changes(panel_number, old_slots, scheduler.get_slots())
 
         # Garbage collection
         for child_popup in scheduler.get_child_popups():
@@ -435,227 +593,57 @@ class GUI:
         self.exit_button.place(x=60+80, y=70)
 
         padding = 20
-        down = 50
-
-        # Frames ------------------------------------------------------------
-        tk.Frame(self.master, width=295, height=580, relief='solid', borderwidth=3).place(x=padding, y=150)
-        tk.Frame(self.master, width=295, height=580, relief='solid', borderwidth=3).place(x=2*padding+240+45, y=150)
-        tk.Frame(self.master, width=295, height=580, relief='solid', borderwidth=3).place(x=3*padding+480+2*45, y=150)
-
-        # Frames labels -----------------------------------------------------
-        tk.Label(self.master, text="PANEL 1:", font=("Arial", 20)).place(x=padding, y=110)
-        tk.Label(self.master, text="PANEL 2:", font=("Arial", 20)).place(x=2 * padding + 240 + 45, y=110)
-        tk.Label(self.master, text="PANEL 3:", font=("Arial", 20)).place(x=3 * padding + 480 + 2 * 45, y=110)
-
-        # Sliders for panels ------------------------------------------------
-        tk.Label(self.master, text="F-IR:", font=("Arial", 18)).place(x=padding + 20, y=150 + 22)
-        self.scale_panel_1_FIR = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_1_FIR.place(x=padding + 90, y=150+10)
-
-        tk.Label(self.master, text="N-IR:", font=("Arial", 18)).place(x=padding + 20, y=150 + 22 + down)
-        self.scale_panel_1_NIR = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_1_NIR.place(x=padding + 90, y=150 + 10 + down)
-
-        tk.Label(self.master, text="VIS:", font=("Arial", 18)).place(x=padding + 20, y=150 + 22 + 2*down)
-        self.scale_panel_1_VIS = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_1_VIS.place(x=padding + 90, y=150 + 10 + 2*down)
-
-        tk.Label(self.master, text="UV:", font=("Arial", 18)).place(x=padding + 20, y=150 + 22 + 3*down)
-        self.scale_panel_1_UV = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_1_UV.place(x=padding + 90, y=150 + 10 + 3*down)
-
-        # ------------------------------------------
-        tk.Label(self.master, text="F-IR:", font=("Arial", 18)).place(x=2*padding+240+20 + 45, y=150 + 22)
-        self.scale_panel_2_FIR = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_2_FIR.place(x=2*padding+240+90+ 45, y=150 + 10)
-
-        tk.Label(self.master, text="N-IR:", font=("Arial", 18)).place(x=2 * padding + 240 + 20+ 45, y=150 + 22 + down)
-        self.scale_panel_2_NIR = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_2_NIR.place(x=2 * padding + 240 + 90+ 45, y=150 + 10 + down)
-
-        tk.Label(self.master, text="VIS:", font=("Arial", 18)).place(x=2*padding+240+20+ 45, y=150 + 22 + 2*down)
-        self.scale_panel_2_VIS = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_2_VIS.place(x=2*padding+240+90+ 45, y=150 + 10 + 2*down)
-
-        tk.Label(self.master, text="UV:", font=("Arial", 18)).place(x=2*padding+240+20+ 45, y=150 + 22 + 3 * down)
-        self.scale_panel_2_UV = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_2_UV.place(x=2*padding+240+90+ 45, y=150 + 10 + 3 * down)
-
-        # ------------------------------------------
-        tk.Label(self.master, text="F-IR:", font=("Arial", 18)).place(x=3 * padding + 2*240 + 20 + 2 * 45, y=150 + 22)
-        self.scale_panel_3_FIR = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_3_FIR.place(x=3 * padding + 2*240 + 90+ 2 * 45, y=150 + 10)
-
-        tk.Label(self.master, text="N-IR:", font=("Arial", 18)).place(x=3 * padding + 2 * 240 + 20+ 2 * 45, y=150 + 22+down)
-        self.scale_panel_3_NIR = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_3_NIR.place(x=3 * padding + 2 * 240 + 90+ 2 * 45, y=150 + 10+down)
-
-        tk.Label(self.master, text="VIS:", font=("Arial", 18)).place(x=3 * padding + 2*240 + 20+ 2 * 45, y=150 + 22 + 2*down)
-        self.scale_panel_3_VIS = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_3_VIS.place(x=3 * padding + 2*240 + 90+ 2 * 45, y=150 + 10 + 2*down)
-
-        tk.Label(self.master, text="UV:", font=("Arial", 18)).place(x=3 * padding + 2*240 + 20+ 2 * 45, y=150 + 22 + 3 * down)
-        self.scale_panel_3_UV = tk.Scale(self.master, from_=0, to=100, orient="horizontal", length=170)
-        self.scale_panel_3_UV.place(x=3 * padding + 2*240 + 90+ 2 * 45, y=150 + 10 + 3 * down)
-
-        # Buttons for panels ------------------------------------------------
-        self.button3 = tk.Button(self.master, text="Confirm", command=lambda: self.confirm_clicked(1))
-        self.button3.place(x=padding + 80+10 +30, y=150 + 30 + 3.65 * down)
-        self.change_button_state(self.button3, "disabled")
-
-        self.button4 = tk.Button(self.master, text="Confirm", command=lambda: self.confirm_clicked(2))
-        self.button4.place(x=2*padding + 240+80+10+75, y=150 + 30 + 3.65 * down)
-        self.change_button_state(self.button4, "disabled")
-
-        self.button5 = tk.Button(self.master, text="Confirm", command=lambda: self.confirm_clicked(3))
-        self.button5.place(x=3*padding + 2*240+80+130, y=150 + 30 + 3.65 * down)
-        self.change_button_state(self.button5, "disabled")
-
-        # Line separation --------------------------------------------------
-        tk.Frame(self.master, width=260, height=2, bg='black').place(x=3*padding + 2*240+15+2*45, y=150 + 30 + 3 * down+70)
-        tk.Frame(self.master, width=260, height=2, bg='black').place(x=2 * padding + 240 + 15+45, y=150 + 30 + 3 * down + 70)
-        tk.Frame(self.master, width=260, height=2, bg='black').place(x= padding + 15, y=150 + 30 + 3 * down + 70)
-
-        tk.Frame(self.master, width=260, height=2, bg='black').place(x=3 * padding + 2 * 240 + 15 + 2 * 45, y=150 +475)
-        tk.Frame(self.master, width=260, height=2, bg='black').place(x=2 * padding + 240 + 15 + 45, y=150 + 475)
-        tk.Frame(self.master, width=260, height=2, bg='black').place(x=padding + 15, y=150 + 475)
-
-        # Labels for status ------------------------------------------------
-        self.panel_labels = []
-
-        label13 = tk.Label(self.master, text="", font=("Arial", 18))
-        label13.place(x=3 * padding + 2*240 + 20+90, y=415)
-
-        label133 = tk.Label(self.master, text="", font=("Arial", 18))
-        label133.place(x=3 * padding + 2 * 240 + 20 +130+100, y=415)
-
-        label14 = tk.Label(self.master, text="", font=("Arial", 18))
-        label14.place(x=3 * padding + 2 * 240 + 20+90, y=415+40)
-
-        label15 = tk.Label(self.master, text="", font=("Arial", 18))
-        label15.place(x=3 * padding + 2 * 240 + 20 +130+100, y=415+40)
-
-        label16 = tk.Label(self.master, text="", font=("Arial", 18))
-        label16.place(x=3 * padding + 2 * 240 + 20 + 90+ 80, y=400 + 80 + 40)
-
-        label161 = tk.Label(self.master, text="", font=("Arial", 18))
-        label161.place(x=3 * padding + 2 * 240 + 20 + 90 +80+100, y=400 + 80 + 40)
-
-        label162 = tk.Label(self.master, text="", font=("Arial", 18))
-        label162.place(x=3 * padding + 2 * 240 + 20 + 90 + 80, y=400 + 80 + 40 + 30)
-
-        # ------------------------------------------
-        label17 = tk.Label(self.master, text="", font=("Arial", 18))
-        label17.place(x=2 * padding +  240 + 20+ 45, y=415)
-
-        label177 = tk.Label(self.master, text="", font=("Arial", 18))
-        label177.place(x=2 * padding + 240 + 20 + 130+ 50, y=415)
-
-        label18 = tk.Label(self.master, text="", font=("Arial", 18))
-        label18.place(x=2 * padding +  240 + 20+ 45, y=415+40)
-
-        label19 = tk.Label(self.master, text="", font=("Arial", 18))
-        label19.place(x=2 * padding + 240 + 20 + 130+ 50, y=415+40)
-
-        label20 = tk.Label(self.master, text="", font=("Arial", 18))
-        label20.place(x=2 * padding + 240 + 20 + 45 + 80, y=400 + 80 + 40)
-
-        label201 = tk.Label(self.master, text="", font=("Arial", 18))
-        label201.place(x=2 * padding + 240 + 20 + 45+ 170, y=400 + 80 + 40)
-
-        label202 = tk.Label(self.master, text="", font=("Arial", 18))
-        label202.place(x=2 * padding + 240 + 20 + 45 + 80, y=400 + 80 + 40+30)
-
-        # ------------------------------------------
-        label21 = tk.Label(self.master, text="", font=("Arial", 18))
-        label21.place(x=padding + 20, y=415)
-
-        label211 = tk.Label(self.master, text="", font=("Arial", 18))
-        label211.place(x=padding + 20 + 135, y=415)
-
-        label22 = tk.Label(self.master, text="", font=("Arial", 18))
-        label22.place(x=padding + 20, y=415 + 40)
-
-        label23 = tk.Label(self.master, text="", font=("Arial", 18))
-        label23.place(x=padding + 20 + 135, y=415 + 40)
-
-        label24 = tk.Label(self.master, text="", font=("Arial", 18))
-        label24.place(x=padding + 20+80, y=400 + 80 + 40)
-
-        label25 = tk.Label(self.master, text="", font=("Arial", 18))
-        label25.place(x=padding + 20+80, y=400 + 80 + 40+30)
-
-        label26 = tk.Label(self.master, text="", font=("Arial", 18))
-        label26.place(x=padding + 190, y=400 + 80 + 40)
-
-        self.panel_labels.append([label21, label211, label22, label23, label24, label25, label26])
-        self.panel_labels.append([label17, label177, label18, label19, label20, label201, label202])
-        self.panel_labels.append([label13, label133, label14, label15, label16, label161, label162])
-
-        # Initialize label values
-        for i in range(3):
-            self.set_status_labels(i, 0, 0, 0, 0, 0, 0, 0)
-
-        # Temperature labels:
-        tk.Label(self.master, text="Temp:", font=("Arial", 18)).place(x=padding + 20, y=400 + 80 + 40)
-        tk.Label(self.master, text="Temp:", font=("Arial", 18)).place(x=2 * padding + 240 + 20 + 45, y=400 + 80 + 40)
-        tk.Label(self.master, text="Temp:", font=("Arial", 18)).place(x=3 * padding + 2 * 240 + 20 + 90, y=400 + 80 + 40)
-
-        # Scheduler labels:
-        tk.Label(self.master, text="Scheduler:", font=("Arial", 18)).place(x=padding + 20, y=640)
-        tk.Label(self.master, text="Scheduler:", font=("Arial", 18)).place(x=2 * padding + 240 + 20 + 45, y=640)
-        tk.Label(self.master, text="Scheduler:", font=("Arial", 18)).place(x=3 * padding + 2 * 240 + 20 + 90, y=640)
-
-        # Buttons for panels2 ----------------------------------------------
-        self.button6 = tk.Button(self.master, text="Status", command=lambda: self.status_clicked(1))
-        self.button6.place(x=padding + 80+10 +30+5, y=150 + 30 + 3 * down+260)
-        self.change_button_state(self.button6, "disabled")
-
-        self.button7 = tk.Button(self.master, text="Status", command=lambda: self.status_clicked(2))
-        self.button7.place(x=2*padding + 240+80+10+80, y=150 + 30 + 3 * down+260)
-        self.change_button_state(self.button7, "disabled")
-
-        self.button8 = tk.Button(self.master, text="Status", command=lambda: self.status_clicked(3))
-        self.button8.place(x=3*padding + 2*240+80+135, y=150 + 30 + 3 * down +260)
-        self.change_button_state(self.button8, "disabled")
 
         # Buttons for reseting logger --------------------------------------
         self.button9 = tk.Button(self.master, text="Delete log", command=self.clear_log)
         self.button9.place(x=padding + 80 + 10+100, y=70)
 
-        # Buttons for schedulers -------------------------------------------
-        self.button_sch_1 = tk.Button(self.master, text="Setup", command=lambda: self.open_scheduler(1))
-        self.button_sch_1.place(x=padding + 20 + 80, y=690)
-
-        self.button_sch_2 = tk.Button(self.master, text="Setup", command=lambda: self.open_scheduler(2))
-        self.button_sch_2.place(x=2*padding+240+45 + 100, y=690)
-
-        self.button_sch_3 = tk.Button(self.master, text="Setup", command=lambda: self.open_scheduler(3))
-        self.button_sch_3.place(x=3*padding+480+2*45 + 100, y=690)
-
-        # Buttons for ON/OFF -------------------------------------------
-        self.l1_switch = tk.Checkbutton(command=lambda: self.toggle(1), text="ON/OFF")
-        self.l1_switch.place(x=20+150, y=690)
-
-        self.l2_switch = tk.Checkbutton(command=lambda: self.toggle(2), text="ON/OFF")
-        self.l2_switch.place(x=2*padding+240+45  + 150, y=690)
-
-        self.l3_switch = tk.Checkbutton(command=lambda: self.toggle(3), text="ON/OFF")
-        self.l3_switch.place(x= 3*padding+480+2*45  + 150, y=690)
-
-        self.change_button_state(self.l1_switch, "disabled")
-        self.change_button_state(self.l2_switch, "disabled")
-        self.change_button_state(self.l3_switch, "disabled")
-
-        # Labels for ACTIVE scheduler ----------------------------------
-        self.label_light_1 = tk.Label(self.master, text="INACTIVE", font=("Arial", 18), foreground="red")
-        self.label_light_1.place(x=20+150, y=640)
-
-        self.label_light_2 = tk.Label(self.master, text="INACTIVE", font=("Arial", 18), foreground="red")
-        self.label_light_2.place(x=2*padding+240+45 + 150, y=640)
-
-        self.label_light_3 = tk.Label(self.master, text="INACTIVE", font=("Arial", 18), foreground="red")
-        self.label_light_3.place(x=3*padding+480+2*45 + 150, y=640)
+        # Buttons for scenes (all panels at once) --------------------------
+        self.button_confirm_all = tk.Button(self.master, text="Confirm all", command=self.confirm_all_clicked)
+        self.button_confirm_all.place(x=padding + 300, y=70)
+        self.change_button_state(self.button_confirm_all, "disabled")
+
+        self.scene_name = tk.Entry(self.master, width=14)
+        self.scene_name.place(x=padding + 400, y=74)
+
+        self.button_save_scene = tk.Button(self.master, text="Save scene", command=self.save_scene_clicked)
+        self.button_save_scene.place(x=padding + 530, y=70)
+        self.change_button_state(self.button_save_scene, "disabled")
+
+        self.button_recall_scene = tk.Button(self.master, text="Recall scene", command=self.recall_scene_clicked)
+        self.button_recall_scene.place(x=padding + 620, y=70)
+        self.change_button_state(self.button_recall_scene, "disabled")
+
+        # Button for latency histograms ------------------------------------
+        self.button_latency = tk.Button(self.master, text="Latency", command=self.latency_clicked)
+        self.button_latency.place(x=padding + 720, y=70)
+
+        # Button for panel history -----------------------------------------
+        self.button_history = tk.Button(self.master, text="History", command=self.history_clicked)
+        self.button_history.place(x=padding + 790, y=70)
+        self.change_button_state(self.button_history, "disabled")
+
+        # Button for profiling PI and PC -----------------------------------
+        self.button_profile = tk.Button(self.master, text="Profile", command=self.profile_clicked)
+        self.button_profile.place(x=padding + 850, y=70)
+        self.change_button_state(self.button_profile, "disabled")
+
+        # Panels ------------------------------------------------------------
+        # Any number of panels, PANEL_COLUMNS per row in a scrollable area below buttons
+        panels_area = tk.Frame(self.master)
+        panels_area.place(x=0, y=110, relwidth=1, relheight=1, height=-110)
+        canvas = tk.Canvas(panels_area, highlightthickness=0)
+        scrollbar = tk.Scrollbar(panels_area, orient="vertical", command=canvas.yview)
+        canvas.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.panels_frame = tk.Frame(canvas)
+        canvas.create_window((0, 0), window=self.panels_frame, anchor="nw")
+        self.panels_frame.bind("<Configure>", lambda event: canvas.configure(scrollregion=canvas.bbox("all")))
+
+        for panel_number in self.panels.numbers():
+            self.panel_views[panel_number] = PanelView(self.panels_frame, panel_number, self)
+        self.layout_panels()
 
     def log_message(self, log_level, message_to_log):
         if log_level == 'NOTICE':
@@ -666,8 +654,3 @@ class GUI:
             self.logger.log(logging.ERROR, message_to_log)
         elif log_level == 'CRITICAL':
             self.logger.log(logging.CRITICAL, message_to_log)
-
-    @staticmethod
-    def generate_hash(message_to_hash):
-        hash_object = hashlib.sha256(message_to_hash.encode())
-        return hash_object.hexdigest()
\ No newline at end of file
@@ -6,6 +6,13 @@ import getmac
 import nmap
 import socket
 import logging
+import os
+from shared_modules import SHARED_DIRECTORY, SHARED_MODULES
+
+# Helper modules imported by PI script. They are transferred next to it, together with SHARED_MODULES
+PI_MODULES = ["schedule_engine.py", "serial_mux.py", "async_runtime.py", "panel_state.py", "port_map.py", "scenes.py",
+              "state_store.py", "latency_trace.py", "telemetry.py", "telemetry_stream.py", "thermal.py",
+              "fade_engine.py", "metrics.py", "port_watcher.py", "worker.py"]
 
 
 def log_message(logger, log_level, message_to_log):
@@ -19,6 +26,24 @@ def log_message(logger, log_level, message_to_log):
         logger.log(logging.CRITICAL, message_to_log)
 
 
+def get_script_args():
+    # Command line options of PI script as set in project_config, same for GUI and fleet
+    script_args = []
+    if MQTT_ECHO:
+        script_args.append("--echo")
+    if MQTT_TRACE:
+        script_args.append("--trace")
+    return " ".join(script_args)
+
+
+def start_status_stream(client):
+    # Sends stream settings of project_config to PI of given Client. Sent on every (re)connect since PI forgets them
+    # when restarted
+    if STREAM_INTERVAL > 0:
+        client.publish_command("pc_to_pi", "stream", [int(STREAM_INTERVAL * 1000), STREAM_PWM_THRESHOLD,
+                                                      STREAM_TEMP_THRESHOLD])
+
+
 def get_PI_IP_by_hostname(hostname):
     logger = logging.getLogger()
     try:
@@ -88,6 +113,13 @@ def transfer_script_to_PI(RP_ip, RP_username, RP_password, script_name):
         remote_path = f"/home/pi/python/{script_name}"
         sftp.put(local_path, remote_path)
 
+        # Transfer helper modules from the same directory and modules shared with PC from Shared directory, PI
+        # script imports all of them from its own directory
+        for module_name in PI_MODULES:
+            sftp.put(os.path.join(os.path.dirname(local_path), module_name), f"/home/pi/python/{module_name}")
+        for module_name in SHARED_MODULES:
+            sftp.put(os.path.join(SHARED_DIRECTORY, module_name), f"/home/pi/python/{module_name}")
+
         # Close the SFTP connection
         sftp.close()
 
@@ -129,7 +161,7 @@ def reset_PI(RP_ip, RP_username, RP_password):
         print("SSH connection closed")
 
 
-def run_PI_script(RP_ip, RP_username, RP_password, script_name):
+def run_PI_script(RP_ip, RP_username, RP_password, script_name, script_args=""):
     logger = logging.getLogger()
 
     ssh = paramiko.SSHClient()
@@ -141,7 +173,7 @@ def run_PI_script(RP_ip, RP_username, RP_password, script_name):
         log_message(logger, "NOTICE", "SSH connection successful!")
 
         # Execute the Python script on the Raspberry Pi
-        ssh.exec_command(f"python3 /home/pi/python/{script_name} &")
+        ssh.exec_command(f"python3 /home/pi/python/{script_name} {script_args} &")
         # ssh.exec_command("nohup python3 /home/pi/python/{script_name} &")
         # Print the output of the script
         # print(stdout.read().decode())
@@ -0,0 +1,353 @@
+import logging
+import threading
+import time
+import codec
+import PI_handler
+from Client import Client
+from transport import TRANSPORT_MQTT
+
+# Connection states of a PI, shown in fleet view
+STATE_OFFLINE = "offline"
+STATE_CONNECTING = "connecting"
+STATE_ONLINE = "online"
+STATE_STALE = "stale"
+STATE_RECOVERING = "recovering"
+
+# PI sends check every 40 seconds. PI that was silent longer than this is stale, same limit as GUI's timer (7 x 10 s)
+STALE_AFTER = 70.0
+# Health of all PIs is checked this often (seconds)
+HEALTH_INTERVAL = 10.0
+# Unhealthy PI is not recovered again before this many seconds. Pause doubles after every attempt up to maximum and
+# goes back to start once PI is heard from
+RECOVERY_BACKOFF = 30.0
+MAX_RECOVERY_BACKOFF = 600.0
+# Group every PI belongs to
+GROUP_ALL = "all"
+
+
+class FleetDevice:
+    # One PI of the fleet: where to reach it, its MQTT client and what it reported last. Fields that change are
+    # guarded by fleet controller's lock
+    def __init__(self, name, host, port=1883, namespace="", groups=(), username=None, password=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        # Prefix of PI's topics, PI must be started with same --namespace
+        self.namespace = namespace
+        self.groups = set(groups) | {GROUP_ALL}
+        # SSH login for recovery, fleet defaults if None
+        self.username = username
+        self.password = password
+
+        self.client = None
+        self.state = STATE_OFFLINE
+        self.last_seen = None
+        # Script sent something since it was (re)started. Only such PI is taken as hung when it goes silent
+        self.heard = False
+        self.recovery_backoff = RECOVERY_BACKOFF
+        self.next_recovery = 0.0
+        # panel -> (fir, nir, vis, uv, temp1, temp2, temp3, time received)
+        self.panels = {}
+        # panel -> thermal level (0 ok, 1 derated, 2 cut) of last alarm
+        self.alarms = {}
+        self.rejected = 0
+        self.last_error = ""
+
+
+class FleetController:
+    # Controls several PIs from one process. Every PI gets its own MQTT client (its own broker, or a shared broker with
+    # per PI topic namespace) and all of them are connected in parallel. Commands fan out to a group of PIs, replies
+    # of all PIs end up in one status view. A health thread marks PIs that went silent and can restart their broker or
+    # script over SSH like GUI does for a single PI
+    def __init__(self, devices, mqtt_name, username, password, protocol=codec.PROTOCOL_TEXT, ssh_username=None,
+                 ssh_password=None, script=None, script_args="", transport=TRANSPORT_MQTT, broker=None):
+        self.devices = {device.name: device for device in devices}
+        self.mqtt_name = mqtt_name
+        self.username = username
+        self.password = password
+        self.protocol = protocol
+        # Recovery over SSH is off unless script to restart is given
+        self.ssh_username = ssh_username
+        self.ssh_password = ssh_password
+        self.script = script
+        self.script_args = script_args
+        self.transport = transport
+        self.broker = broker
+
+        # Called from network thread of PI's client after every (re)connect, e.g. to start status stream
+        self.on_connected = None
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.logger = logging.getLogger()
+
+    # Connections
+
+    def connect_all(self, timeout=None):
+        # Connects every PI that is not connected, all at once. Returns names of PIs that are connected when done
+        threads = []
+        for device in self.devices.values():
+            if device.client is None or not device.client.is_connected():
+                thread = threading.Thread(target=self.connect, args=(device,), daemon=True)
+                thread.start()
+                threads.append(thread)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return [device.name for device in self.devices.values() if self.is_connected(device)]
+
+    def connect(self, device):
+        with self.lock:
+            if device.state == STATE_CONNECTING:
+                return False
+            device.state = STATE_CONNECTING
+        if device.client is not None:
+            device.client.purpose_disconnect()
+        client = Client(f"{self.mqtt_name}_{device.name}", self.username, self.password, self.protocol,
+                        self.transport, self.broker, device.namespace)
+        client.on_connected = lambda: self.on_device_connected(device)
+        device.client = client
+        try:
+            connected = client.connect(device.host, device.port)
+        except OSError as e:
+            self.log_message("ERROR", f"{device.name}: could not connect to broker on {device.host}: {e}")
+            connected = False
+        with self.lock:
+            device.state = STATE_ONLINE if connected else STATE_OFFLINE
+            if connected:
+                device.last_seen = time.monotonic()
+        return connected
+
+    def on_device_connected(self, device):
+        # Subscriptions are made again after every reconnect, broker may have forgotten them
+        def handler(client, userdata, message):
+            self.on_message(device, message)
+        device.client.add_topic_callback(codec.PI_TO_PC, handler)
+        device.client.add_topic_callback(codec.PANEL_TOPIC.format("+"), handler)
+        with self.lock:
+            device.state = STATE_ONLINE
+            device.last_seen = time.monotonic()
+        if self.on_connected is not None:
+            self.on_connected(device)
+
+    def disconnect_all(self):
+        self.stop()
+        for device in self.devices.values():
+            if device.client is not None:
+                device.client.purpose_disconnect()
+            with self.lock:
+                device.state = STATE_OFFLINE
+
+    def is_connected(self, device):
+        return device.client is not None and device.client.is_connected()
+
+    # Commands
+
+    def devices_in(self, target):
+        # PIs of a group or PI with given name, sorted by name
+        if target in self.devices:
+            return [self.devices[target]]
+        return sorted((device for device in self.devices.values() if target in device.groups),
+                      key=lambda device: device.name)
+
+    def groups(self):
+        groups = {GROUP_ALL}
+        for device in self.devices.values():
+            groups |= device.groups
+        return sorted(groups)
+
+    def send(self, target, command, fields):
+        # Publishes command to every connected PI of target (group or PI name). Returns {name: sequence or None}
+        sequences = {}
+        for device in self.devices_in(target):
+            if self.is_connected(device):
+                sequences[device.name] = device.client.publish_command(codec.PC_TO_PI, command, fields)
+            else:
+                sequences[device.name] = None
+        return sequences
+
+    def request_status(self, target=GROUP_ALL, panel_numbers=()):
+        # Every PI of target is asked for given panels and all panels it already reported
+        for device in self.devices_in(target):
+            with self.lock:
+                asked = sorted(set(device.panels) | set(panel_numbers))
+            if self.is_connected(device):
+                for panel_number in asked:
+                    device.client.publish_command(codec.PC_TO_PI, "status", [panel_number])
+
+    # Messages
+
+    def on_message(self, device, message):
+        # Called from network thread of PI's client. Anything received, even damaged, shows PI is alive
+        now = time.monotonic()
+        with self.lock:
+            device.last_seen = now
+            device.heard = True
+            device.recovery_backoff = RECOVERY_BACKOFF
+            device.next_recovery = 0.0
+            if device.state == STATE_STALE:
+                device.state = STATE_ONLINE
+        try:
+            command, content, sequence = codec.decode(codec.PI_TO_PC, message.payload)
+        except codec.CodecError:
+            self.log_message("WARNING", f"{device.name}: damaged message disregarded")
+            return
+
+        if command == "status":
+            try:
+                panel_number = content[0]
+                with self.lock:
+                    device.panels[panel_number] = tuple(content[1:8]) + (time.time(),)
+            except:
+                pass
+
+        elif command == "ack":
+            try:
+                acked_sequence, result = content[:2]
+                acked_command = device.client.acknowledge(acked_sequence)
+                if result != codec.ACK_OK:
+                    with self.lock:
+                        device.rejected += 1
+                        device.last_error = f"{acked_command} rejected with code {result}"
+                    self.log_message("ERROR", f"{device.name}: PI rejected message #{acked_sequence} "
+                                              f"({acked_command}) with code {result}")
+            except:
+                pass
+
+        elif command == "alarm":
+            try:
+                panel_number, level, temperature = content[:3]
+                with self.lock:
+                    device.alarms[panel_number] = level
+                if level:
+                    self.log_message("WARNING", f"{device.name}: panel {panel_number} is hot ({temperature} C), "
+                                                f"limited by PI (level {level})")
+                else:
+                    self.log_message("NOTICE", f"{device.name}: panel {panel_number} cooled down ({temperature} C)")
+            except:
+                pass
+
+        elif command == "text":
+            self.log_message("NOTICE", f"{device.name}: {content[0]}")
+
+    # Health
+
+    def check_health(self):
+        # Updates state of every PI, returns PIs that are offline or stale
+        now = time.monotonic()
+        unhealthy = []
+        with self.lock:
+            for device in self.devices.values():
+                if device.state in (STATE_CONNECTING, STATE_RECOVERING):
+                    continue
+                if not self.is_connected(device):
+                    device.state = STATE_OFFLINE
+                elif device.last_seen is not None and now - device.last_seen > STALE_AFTER:
+                    device.state = STATE_STALE
+                else:
+                    device.state = STATE_ONLINE
+                if device.state in (STATE_OFFLINE, STATE_STALE):
+                    unhealthy.append(device)
+        return unhealthy
+
+    def start(self):
+        # Starts health thread, recovery of unhealthy PIs runs on its own thread per PI
+        self.stop_event.clear()
+        threading.Thread(target=self.run_health_checks, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run_health_checks(self):
+        while not self.stop_event.wait(HEALTH_INTERVAL):
+            now = time.monotonic()
+            for device in self.check_health():
+                with self.lock:
+                    # Attempts on a PI that does not come back are spaced out more and more
+                    if now < device.next_recovery:
+                        continue
+                    device.next_recovery = now + device.recovery_backoff
+                    device.recovery_backoff = min(device.recovery_backoff * 2, MAX_RECOVERY_BACKOFF)
+                    stale = device.state == STATE_STALE
+                    if self.script is not None:
+                        device.state = STATE_RECOVERING
+                if self.script is not None:
+                    threading.Thread(target=self.recover, args=(device, stale), daemon=True).start()
+                elif not stale:
+                    # Without SSH just try broker again
+                    threading.Thread(target=self.connect, args=(device,), daemon=True).start()
+
+    def recover(self, device, stale=False):
+        # Same steps as GUI's resolve without stopping the program: broker is started if it is down, script is
+        # restarted only if it is not running or if it was heard from before and went silent (stale), then broker is
+        # connected again. PI that was never heard from or is only unreachable keeps its running script
+        host = device.host
+        username = device.username or self.ssh_username
+        password = device.password or self.ssh_password
+        try:
+            if not PI_handler.check_SSH_connection(host, username, password):
+                self.set_error(device, "SSH connection failed, PI may need power cycle")
+                return
+            if not PI_handler.check_broker_status(host, username, password):
+                self.log_message("NOTICE", f"{device.name}: restarting MQTT broker")
+                PI_handler.start_broker(host, username, password)
+            with self.lock:
+                hung = stale and device.heard
+            running = PI_handler.check_script_running(host, username, password, self.script)
+            if not running or hung:
+                self.log_message("NOTICE", f"{device.name}: restarting script, it "
+                                           f"{'stopped answering' if running else 'is not running'}")
+                script_args = self.script_args
+                if device.namespace:
+                    script_args = f"{script_args} --namespace {device.namespace}".strip()
+                PI_handler.stop_PI_scripts(host, username, password, self.script)
+                PI_handler.run_PI_script(host, username, password, self.script, script_args)
+                with self.lock:
+                    device.last_seen = time.monotonic()
+                    device.heard = False
+        finally:
+            with self.lock:
+                device.state = STATE_ONLINE if self.is_connected(device) else STATE_OFFLINE
+        if not self.is_connected(device):
+            self.connect(device)
+
+    def set_error(self, device, error):
+        with self.lock:
+            device.last_error = error
+        self.log_message("ERROR", f"{device.name}: {error}")
+
+    # Status view
+
+    def snapshot(self):
+        # [(name, state, seconds since last message or None, {panel: status}, {panel: alarm level}, rejected, error)]
+        now = time.monotonic()
+        with self.lock:
+            return [(device.name, device.state, None if device.last_seen is None else now - device.last_seen,
+                     dict(device.panels), dict(device.alarms), device.rejected, device.last_error)
+                    for device in sorted(self.devices.values(), key=lambda device: device.name)]
+
+    def summary(self):
+        # Totals over all PIs: {state: count}, panels reporting, panels limited by thermal supervisor, hottest panel
+        states = {}
+        panel_count = 0
+        limited = 0
+        hottest = None
+        for name, state, age, panels, alarms, rejected, error in self.snapshot():
+            states[state] = states.get(state, 0) + 1
+            panel_count += len(panels)
+            limited += sum(1 for level in alarms.values() if level)
+            for panel_number, status in panels.items():
+                temperature = max(status[4:7])
+                if hottest is None or temperature > hottest[0]:
+                    hottest = (temperature, name, panel_number)
+        return states, panel_count, limited, hottest
+
+    def log_message(self, log_level, message_to_log):
+        if log_level == 'NOTICE':
+            self.logger.log(logging.NOTICE, message_to_log)
+        elif log_level == 'WARNING':
+            self.logger.log(logging.WARNING, message_to_log)
+        elif log_level == 'ERROR':
+            self.logger.log(logging.ERROR, message_to_log)
+        elif log_level == 'CRITICAL':
+            self.logger.log(logging.CRITICAL, message_to_log)
@@ -0,0 +1,161 @@
+import threading
+import time
+import tkinter as tk
+from tkinter import ttk
+from fleet import GROUP_ALL
+from panel_view import SLIDER_CHANNELS
+
+# Status view is refreshed this often (milliseconds)
+REFRESH_INTERVAL = 1000
+
+
+class FleetGUI:
+    # One window for all PIs of a fleet: commands go to a group or a single PI, table shows every PI with its panels
+    # underneath. Table is rebuilt from controller's snapshot on tkinter's thread, network threads never touch widgets
+    def __init__(self, master, controller, panel_numbers=()):
+        self.master = master
+        self.controller = controller
+        # Panels asked for when status is requested from PIs that did not report any yet
+        self.panel_numbers = list(panel_numbers)
+        master.title("Light Controller - Fleet")
+        master.geometry("1000x700")
+
+        self.set_up_UI_elements()
+        self.master.after(0, self.refresh)
+
+    def connect_clicked(self):
+        # Connecting waits for every broker, so it runs off tkinter's thread
+        threading.Thread(target=self.controller.connect_all, daemon=True).start()
+
+    def exit_clicked(self):
+        self.controller.disconnect_all()
+        self.master.destroy()
+
+    def set_clicked(self):
+        try:
+            fields = [int(self.panel_entry.get())] + [int(entry.get() or 0) for entry in self.value_entries]
+        except ValueError:
+            self.show_result("Panel and values must be whole numbers")
+            return
+        if fields[0] < 1 or not all(0 <= value <= 100 for value in fields[1:]):
+            self.show_result("Panel must be 1 or more and values 0-100")
+            return
+        self.show_sent("set", self.controller.send(self.target.get(), "set", fields))
+
+    def recall_scene_clicked(self):
+        name = self.scene_name.get().strip()
+        if not name:
+            return
+        self.show_sent("scene_recall", self.controller.send(self.target.get(), "scene_recall", [name]))
+
+    def status_clicked(self):
+        self.controller.request_status(self.target.get(), self.panel_numbers)
+
+    def show_sent(self, command, sequences):
+        missed = [name for name, sequence in sequences.items() if sequence is None]
+        text = f"{command} sent to {len(sequences) - len(missed)} of {len(sequences)} PIs"
+        if missed:
+            text += f", not connected: {', '.join(missed)}"
+        self.show_result(text)
+
+    def show_result(self, text):
+        self.result_label.config(text=text)
+
+    def refresh(self):
+        targets = self.controller.groups() + sorted(self.controller.devices)
+        if list(self.target["values"]) != targets:
+            self.target["values"] = targets
+
+        states, panel_count, limited, hottest = self.controller.summary()
+        summary = ", ".join(f"{count} {state}" for state, count in sorted(states.items()))
+        summary += f" | {panel_count} panels, {limited} limited"
+        if hottest is not None:
+            summary += f" | hottest {hottest[0]}°C ({hottest[1]} panel {hottest[2]})"
+        self.summary_label.config(text=summary)
+
+        # Rows are updated in place so expanded PIs and scroll position survive refresh
+        seen = set()
+        for name, state, age, panels, alarms, rejected, error in self.controller.snapshot():
+            hottest_panel = max((max(status[4:7]) for status in panels.values()), default="")
+            values = (state, "" if age is None else f"{age:.0f} s ago", len(panels), hottest_panel,
+                      sum(1 for level in alarms.values() if level), rejected, error)
+            self.set_row(name, "", name, values)
+            seen.add(name)
+            for panel_number, status in sorted(panels.items()):
+                row = f"{name}/{panel_number}"
+                level = alarms.get(panel_number, 0)
+                channels = " ".join(f"{channel} {value}%" for channel, value in zip(SLIDER_CHANNELS, status[:4]))
+                temperatures = "/".join(str(value) for value in status[4:7])
+                self.set_row(row, name, f"Panel {panel_number}",
+                             (channels, time.strftime("%H:%M:%S", time.localtime(status[7])), "", temperatures,
+                              level or "", "", ""))
+                seen.add(row)
+        for row in self.table.get_children():
+            for child in self.table.get_children(row):
+                if child not in seen:
+                    self.table.delete(child)
+            if row not in seen:
+                self.table.delete(row)
+
+        self.master.after(REFRESH_INTERVAL, self.refresh)
+
+    def set_row(self, row, parent, text, values):
+        if self.table.exists(row):
+            self.table.item(row, text=text, values=values)
+        else:
+            self.table.insert(parent, tk.END, iid=row, text=text, values=values)
+
+    def set_up_UI_elements(self):
+        top = tk.Frame(self.master)
+        top.pack(fill=tk.X, padx=10, pady=10)
+        tk.Label(top, text="FLEET:", font=("Arial", 26)).pack(side=tk.LEFT)
+        tk.Button(top, text="Connect all", command=self.connect_clicked).pack(side=tk.LEFT, padx=10)
+        tk.Button(top, text="Exit", command=self.exit_clicked).pack(side=tk.LEFT)
+
+        # Commands, sent to every PI of selected group (or one PI) ---------
+        commands = tk.Frame(self.master)
+        commands.pack(fill=tk.X, padx=10)
+        tk.Label(commands, text="Target:").pack(side=tk.LEFT)
+        self.target = ttk.Combobox(commands, width=12, state="readonly")
+        self.target["values"] = [GROUP_ALL]
+        self.target.set(GROUP_ALL)
+        self.target.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(commands, text="Panel:").pack(side=tk.LEFT)
+        self.panel_entry = tk.Entry(commands, width=4)
+        self.panel_entry.insert(0, "1")
+        self.panel_entry.pack(side=tk.LEFT, padx=5)
+        self.value_entries = []
+        for channel in SLIDER_CHANNELS:
+            tk.Label(commands, text=f"{channel}:").pack(side=tk.LEFT)
+            entry = tk.Entry(commands, width=4)
+            entry.pack(side=tk.LEFT, padx=5)
+            self.value_entries.append(entry)
+        tk.Button(commands, text="Set", command=self.set_clicked).pack(side=tk.LEFT, padx=5)
+
+        self.scene_name = tk.Entry(commands, width=14)
+        self.scene_name.pack(side=tk.LEFT, padx=5)
+        tk.Button(commands, text="Recall scene", command=self.recall_scene_clicked).pack(side=tk.LEFT)
+        tk.Button(commands, text="Status", command=self.status_clicked).pack(side=tk.LEFT, padx=5)
+
+        self.result_label = tk.Label(self.master, text="", anchor="w")
+        self.result_label.pack(fill=tk.X, padx=10, pady=5)
+        self.summary_label = tk.Label(self.master, text="", anchor="w", font=("Arial", 14))
+        self.summary_label.pack(fill=tk.X, padx=10)
+
+        # Status of every PI, its panels as children -----------------------
+        columns = ("state", "last", "panels", "hottest", "alarms", "rejected", "error")
+        headings = ("State / PWM", "Last message", "Panels", "Hottest °C", "Limited", "Rejected", "Last error")
+        widths = (260, 100, 60, 90, 60, 70, 220)
+        table_frame = tk.Frame(self.master)
+        table_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.table = ttk.Treeview(table_frame, columns=columns)
+        self.table.heading("#0", text="PI")
+        self.table.column("#0", width=120)
+        for column, heading, width in zip(columns, headings, widths):
+            self.table.heading(column, text=heading)
+            self.table.column(column, width=width)
+        scrollbar = ttk.Scrollbar(table_frame, orient="vertical", command=self.table.yview)
+        self.table.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.table.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
@@ -0,0 +1,29 @@
+import shared_modules
+import PI_handler
+from fleet import FleetController, FleetDevice
+from fleet_gui import FleetGUI
+import tkinter as tk
+from project_config import *
+import logging
+
+if __name__ == '__main__':
+    # Create logger and add custom level:
+    logging.NOTICE = 25
+    logging.basicConfig(filename='log.log', level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+    logging.addLevelName(logging.NOTICE, "NOTICE")
+    logging.getLogger().setLevel(logging.NOTICE)
+
+    # One controller for all PIs, scripts of silent PIs are restarted over SSH
+    devices = [FleetDevice(**device) for device in FLEET_DEVICES]
+    controller = FleetController(devices, "PC", MQTT_USERNAME, MQTT_PASSWORD, MQTT_PROTOCOL, RP_USERNAME, RP_PASSWORD,
+                                 SCRIPT_NAME, PI_handler.get_script_args())
+    controller.on_connected = lambda device: PI_handler.start_status_stream(device.client)
+
+    # Start fleet GUI
+    logging.getLogger().log(logging.NOTICE, '=================== Fleet program has started ===================')
+    root = tk.Tk()
+    gui = FleetGUI(root, controller, PANELS)
+    controller.start()
+    gui.connect_clicked()
+    root.mainloop()
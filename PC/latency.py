@@ -0,0 +1,122 @@
+import json
+import math
+import threading
+import time
+from array import array
+
+# Hops of one command, all in milliseconds:
+#  - ack: PC publish until ack from PI arrives (broker both ways and PI handling)
+#  - total: PC publish until Arduino's reply arrives on PC
+#  - broker: total minus time spent on PI, i.e. both trips through broker and network
+#  - pi: PI receive until serial write (or until reply is published when answered from cache)
+#  - serial: serial write until Arduino's reply line is read (9600 baud link both ways and Arduino itself)
+#  - reply: Arduino's reply read until PI published it
+# PC and PI clocks are never compared, every hop is measured on one machine only
+HOPS = ("ack", "total", "broker", "pi", "serial", "reply")
+PERCENTILES = (50, 95, 99)
+
+# Buckets grow by 2^(1/16) (about 4.4 %), from 1 us to well above a minute
+BUCKETS_PER_DOUBLING = 16
+BUCKET_COUNT = 28 * BUCKETS_PER_DOUBLING
+# Sent messages we still expect ack or trace for. When PI does not answer the oldest ones are forgotten
+MAX_IN_FLIGHT = 256
+
+
+class LatencyHistogram:
+    # Log bucketed histogram of durations. Memory is fixed no matter how many samples are added
+    def __init__(self):
+        self.counts = array("L", bytes(BUCKET_COUNT * array("L").itemsize))
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, milliseconds):
+        microseconds = max(milliseconds * 1000.0, 1.0)
+        index = min(int(math.log2(microseconds) * BUCKETS_PER_DOUBLING), BUCKET_COUNT - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.maximum = max(self.maximum, milliseconds)
+
+    def percentile(self, percent):
+        # Upper edge of bucket holding given percentile, in milliseconds
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(self.count * percent / 100.0)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(2 ** ((index + 1) / BUCKETS_PER_DOUBLING) / 1000.0, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        summary = {"count": self.count,
+                   "mean": self.total / self.count if self.count else 0.0,
+                   "max": self.maximum}
+        for percent in PERCENTILES:
+            summary[f"p{percent}"] = self.percentile(percent)
+        return summary
+
+
+class LatencyTracker:
+    # Per hop latency histograms of commands sent to PI. Sequence number of message is its correlation ID, PI returns
+    # it in ack and trace messages
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent_at = {}
+        self.histograms = {hop: LatencyHistogram() for hop in HOPS}
+
+    def sent(self, sequence):
+        with self.lock:
+            self.sent_at[sequence] = time.monotonic()
+            if len(self.sent_at) > MAX_IN_FLIGHT:
+                del self.sent_at[next(iter(self.sent_at))]
+
+    def acknowledged(self, sequence):
+        now = time.monotonic()
+        with self.lock:
+            sent_at = self.sent_at.get(sequence)
+            if sent_at is not None:
+                self.histograms["ack"].add((now - sent_at) * 1000.0)
+
+    def traced(self, sequence, cached, pi_us, serial_us, reply_us):
+        # PI's timings of one command, sent once Arduino's reply (or cached status) was published
+        now = time.monotonic()
+        with self.lock:
+            sent_at = self.sent_at.pop(sequence, None)
+            if sent_at is None:
+                return
+            total = (now - sent_at) * 1000.0
+            on_pi = (pi_us + serial_us + reply_us) / 1000.0
+            self.histograms["total"].add(total)
+            self.histograms["broker"].add(max(total - on_pi, 0.0))
+            self.histograms["pi"].add(pi_us / 1000.0)
+            if not cached:
+                self.histograms["serial"].add(serial_us / 1000.0)
+                self.histograms["reply"].add(reply_us / 1000.0)
+
+    def summary(self):
+        with self.lock:
+            return {hop: histogram.summary() for hop, histogram in self.histograms.items()}
+
+    def report(self):
+        lines = [f"{'hop':<8}{'count':>8}" + "".join(f"{f'p{percent}':>10}" for percent in PERCENTILES) +
+                 f"{'max':>10}   (ms)"]
+        for hop, summary in self.summary().items():
+            lines.append(f"{hop:<8}{summary['count']:>8}" +
+                         "".join(f"{summary[f'p{percent}']:>10.2f}" for percent in PERCENTILES) +
+                         f"{summary['max']:>10.2f}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        with self.lock:
+            data = {"time": time.time(),
+                    "hops": {hop: dict(histogram.summary(), buckets=list(histogram.counts))
+                             for hop, histogram in self.histograms.items()}}
+        with open(path, "w") as file:
+            json.dump(data, file, indent=2)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {hop: LatencyHistogram() for hop in HOPS}
@@ -1,3 +1,4 @@
+import shared_modules
 from GUI import GUI
 import tkinter as tk
 from project_config import *
@@ -0,0 +1,88 @@
+import tkinter as tk
+
+# Sliders of a panel, top to bottom. Same order as channels of set message and status (fir, nir, vis, uv), both
+# GUIs rely on it
+SLIDER_CHANNELS = ("F-IR", "N-IR", "VIS", "UV")
+
+
+class PanelView:
+    # Widgets of one panel in their own frame: sliders with confirm button, last status, scheduler setup and switch.
+    # GUI places frames in a grid, so any number of panels can be shown. Buttons call back gui with panel number
+    def __init__(self, parent, panel_number, gui):
+        self.panel_number = panel_number
+        self.frame = tk.Frame(parent, relief="solid", borderwidth=3, padx=10, pady=5)
+
+        tk.Label(self.frame, text=f"PANEL {panel_number}:", font=("Arial", 20)).grid(row=0, column=0, columnspan=2,
+                                                                                    sticky="w")
+
+        # Sliders ---------------------------------------------------------
+        self.scales = {}
+        for row, channel in enumerate(SLIDER_CHANNELS, start=1):
+            tk.Label(self.frame, text=f"{channel}:", font=("Arial", 18)).grid(row=row, column=0, sticky="sw")
+            scale = tk.Scale(self.frame, from_=0, to=100, orient="horizontal", length=170)
+            scale.grid(row=row, column=1)
+            self.scales[channel] = scale
+
+        self.button_confirm = tk.Button(self.frame, text="Confirm", command=lambda: gui.confirm_clicked(panel_number))
+        self.button_confirm.grid(row=5, column=1, pady=5)
+
+        tk.Frame(self.frame, height=2, bg="black").grid(row=6, column=0, columnspan=2, sticky="ew", pady=5)
+
+        # Status ----------------------------------------------------------
+        status = tk.Frame(self.frame)
+        status.grid(row=7, column=0, columnspan=2, sticky="w")
+        self.status_labels = [tk.Label(status, text="", font=("Arial", 18)) for _ in range(7)]
+        # F-IR N-IR / VIS UV / Temp: temp1 temp2 / temp3
+        for label, (row, column) in zip(self.status_labels, [(0, 0), (0, 2), (1, 0), (1, 2), (2, 1), (2, 2), (3, 1)]):
+            label.grid(row=row, column=column, sticky="w", padx=5)
+        tk.Label(status, text="Temp:", font=("Arial", 18)).grid(row=2, column=0, sticky="w", padx=5)
+        self.set_status(0, 0, 0, 0, 0, 0, 0)
+
+        self.button_status = tk.Button(self.frame, text="Status", command=lambda: gui.status_clicked(panel_number))
+        self.button_status.grid(row=8, column=1, pady=5)
+
+        tk.Frame(self.frame, height=2, bg="black").grid(row=9, column=0, columnspan=2, sticky="ew", pady=5)
+
+        # Scheduler -------------------------------------------------------
+        tk.Label(self.frame, text="Scheduler:", font=("Arial", 18)).grid(row=10, column=0, sticky="w")
+        self.label_active = tk.Label(self.frame, text="INACTIVE", font=("Arial", 18), foreground="red")
+        self.label_active.grid(row=10, column=1, sticky="w")
+
+        self.button_setup = tk.Button(self.frame, text="Setup", command=lambda: gui.open_scheduler(panel_number))
+        self.button_setup.grid(row=11, column=0, sticky="e", pady=5)
+        self.switch = tk.Checkbutton(self.frame, command=lambda: gui.toggle(panel_number), text="ON/OFF")
+        self.switch.grid(row=11, column=1, sticky="w", pady=5)
+
+        self.set_state("disabled")
+
+    def grid(self, row, column):
+        self.frame.grid(row=row, column=column, padx=10, pady=10, sticky="n")
+
+    def get_values(self):
+        return [scale.get() for scale in self.scales.values()]
+
+    def set_status(self, fir, nir, vis, uv, temp1, temp2, temp3):
+        for label, channel, value in zip(self.status_labels, SLIDER_CHANNELS, (fir, nir, vis, uv)):
+            label.config(text=f"{channel}: {value}%")
+        for label, value in zip(self.status_labels[4:], (temp1, temp2, temp3)):
+            label.config(text=f"{value}°C")
+
+    def set_state(self, new_state):
+        # Buttons that need connection to PI
+        for button in (self.button_confirm, self.button_status, self.switch):
+            button.config(state=new_state)
+
+    def set_schedule_active(self, active):
+        if active:
+            self.label_active.config(foreground="green", text="ACTIVE")
+            self.button_confirm.config(state="disabled")
+        else:
+            self.label_active.config(foreground="red", text="INACTIVE")
+            self.button_confirm.config(state="normal")
+            self.button_setup.config(state="normal")
+
+    def set_scheduler_open(self, is_open, connected):
+        # Schedule can't be switched while it is being edited
+        self.button_setup.config(state="disabled" if is_open else "normal")
+        if is_open or connected:
+            self.switch.config(state="disabled" if is_open else "normal")
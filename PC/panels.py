@@ -0,0 +1,49 @@
+class Panel:
+    # What GUI keeps about one panel. Widgets live in PanelView, this is only state. Slots instead of instance dicts
+    # keep it small when one controller has dozens of panels
+    __slots__ = ("number", "slots", "schedule_active", "schedule_version", "resync_version")
+
+    def __init__(self, number):
+        self.number = number
+        # Scheduler slots as (start, stop, [fir, nir, vis, uv, ramp in, ramp out])
+        self.slots = []
+        # Schedule is switched on on PI
+        self.schedule_active = False
+        # Schedule version on PI, None until PI acknowledged a full upload
+        self.schedule_version = None
+        # PI's version that rejected a change, while whole schedule uploaded because of it is not acknowledged yet
+        self.resync_version = None
+
+
+class PanelRegistry:
+    # Panels of one controller by panel number (ARDUINO_NUM), kept in ascending order. GUI iterates this instead of
+    # assuming a panel count, panels PI reports that were not configured are added when their status arrives
+    def __init__(self, panel_numbers=()):
+        self.panels = {}
+        for panel_number in panel_numbers:
+            self.add(panel_number)
+
+    def add(self, panel_number):
+        # Returns panel with given number, registered first if it is new
+        panel = self.panels.get(panel_number)
+        if panel is None:
+            panel = Panel(panel_number)
+            self.panels[panel_number] = panel
+            self.panels = dict(sorted(self.panels.items()))
+        return panel
+
+    def get(self, panel_number):
+        # None if panel is not registered
+        return self.panels.get(panel_number)
+
+    def numbers(self):
+        return list(self.panels)
+
+    def __contains__(self, panel_number):
+        return panel_number in self.panels
+
+    def __iter__(self):
+        return iter(list(self.panels.values()))
+
+    def __len__(self):
+        return len(self.panels)
@@ -7,6 +7,31 @@ RP_HOSTNAME = "yourhostname"
 # MQTT communication:
 MQTT_USERNAME = "yourusername"
 MQTT_PASSWORD = "yourpassword"
+# Wire format of messages sent to PI: "text" (compatible with older PI scripts) or "binary"
+MQTT_PROTOCOL = "text"
+# Debug: PI sends every received message back (echo). Otherwise messages are only acknowledged by sequence number
+MQTT_ECHO = False
+# PI reports time spent on PI and on serial link for every set and status request, shown under Latency in GUI
+MQTT_TRACE = False
+
+# Status streaming: PI samples all panels every STREAM_INTERVAL seconds (0 = only on request) and sends status when
+# PWM or temperature moved by more than threshold. Off by default, every sample takes one loop of panel's Arduino
+STREAM_INTERVAL = 0
+STREAM_PWM_THRESHOLD = 0
+STREAM_TEMP_THRESHOLD = 0
+
+# Panels: ARDUINO_NUM of every panel on PI, shown PANEL_COLUMNS per row. Panels PI reports that are not listed here are
+# added when their first status arrives
+PANELS = [1, 2, 3]
+PANEL_COLUMNS = 3
+
+# Fleet mode (fleet_main.py): one PC controls several PIs, e.g. one per greenhouse room. Every PI has a name, broker
+# host (and port), groups commands can be sent to, and optionally SSH username and password if they differ from
+# RP_USERNAME and RP_PASSWORD. PIs sharing one broker need different namespaces, their scripts run with --namespace
+FLEET_DEVICES = [
+    {"name": "room1", "host": "XXX.XXX.X.XX", "groups": ["north"]},
+    {"name": "room2", "host": "XXX.XXX.X.XX", "groups": ["south"]},
+]
 
 # Name of remote file to start on raspberry PI
 SCRIPT_NAME = "test.py"
@@ -1,24 +1,26 @@
 import tkinter as tk
 from tkinter import ttk
+from interval_index import IntervalIndex
 
 
 class Scheduler:
-    def __init__(self, root, input_slots=None):
+    def __init__(self, root, input_slots=None, title="Scheduler"):
         if input_slots is None:
             input_slots = []
         self.root = root
-        self.slots = input_slots
+        # Slots are kept sorted by start time so overlap checks are a bisect instead of a scan
+        self.slots = IntervalIndex(input_slots)
         self.child_popups = []
 
         # Create the main window
-        self.root.title("Scheduler")
+        self.root.title(title)
         self.root.geometry("400x400")
 
         self.last_slot = 0
         self.update_display()
 
     def get_slots(self):
-        return self.slots
+        return list(self.slots)
 
     def validate_number_hour(self, new_value):
         if new_value == '':
@@ -47,7 +49,12 @@ class Scheduler:
                 return True
         return False
 
-    def check_validation(self, start_h, start_min, end_h, end_min, values, popup):
+    def validate_number_ramp(self, new_value):
+        if new_value == '':
+            return True
+        return new_value.isdigit() and int(new_value) <= 65535
+
+    def check_validation(self, start_h, start_min, end_h, end_min, values, popup, ramps=("", "")):
 
         # Clock setting
         if start_h == "":
@@ -63,24 +70,8 @@ class Scheduler:
         end_time_minutes = int(end_h) * 60 + int(end_min)
 
         # check overlapping and duplicates
-        for slot in self.slots:
-            slot_start = slot[0]
-            slot_end = slot[1]
-            # Check duplicates
-            if slot_start == start_time_minutes or slot_end == end_time_minutes:
-                return
-            # Check inside overlap
-            if start_time_minutes > slot_start and end_time_minutes < slot_end:
-                return
-            # Check left overlap
-            if slot_start < start_time_minutes < slot_end:
-                return
-            # Check right overlap
-            if slot_start < end_time_minutes < slot_end:
-                return
-            # Eating a slot
-            if start_time_minutes < slot_start and end_time_minutes > slot_end:
-                return
+        if self.slots.overlaps(start_time_minutes, end_time_minutes):
+            return
 
         values_ints = []
         # Values check
@@ -94,9 +85,17 @@ class Scheduler:
                 return
             values_ints.append(value_int)
 
-        # Clock check
+        # Ramps in seconds must fit in slot, panel fades in from start and is faded out when slot ends
+        ramp_in, ramp_out = (int(ramp) if ramp != "" else 0 for ramp in ramps)
+        slot_seconds = (end_time_minutes - start_time_minutes + 1) * 60
+        if ramp_in + ramp_out > slot_seconds or ramp_out >= slot_seconds:
+            print("Ramps are longer than slot. Try again!")
+            return
+        values_ints += [ramp_in, ramp_out]
+
+        # Clock check, last minute of the day is 23:59 (PI rejects slots reaching past it)
         print(start_time_minutes, end_time_minutes)
-        if end_time_minutes > start_time_minutes:
+        if start_time_minutes < end_time_minutes < 24 * 60:
             popup.destroy()
             self.save_slot(start_time_minutes, end_time_minutes, values_ints)
             print("Success!")
@@ -110,7 +109,7 @@ class Scheduler:
         # Create a popup window for entering the slot details
         popup = tk.Toplevel()
         popup.title("Add Slot")
-        popup.geometry("220x250")
+        popup.geometry("220x320")
         self.child_popups.append(popup)
 
         vcmd = popup.register(self.validate_number_hour)
@@ -161,8 +160,18 @@ class Scheduler:
         ttk.Label(popup, text="%").place(x=80, y=190)
         ttk.Label(popup, text="%").place(x=80, y=220)
 
+        ttk.Label(popup, text="RAMP", font=("Ariel", 16)).place(x=10, y=245)
+        vcmd4 = popup.register(self.validate_number_ramp)
+        ttk.Label(popup, text="In:").place(x=10, y=285)
+        ramp_in = ttk.Entry(popup, validate="key", validatecommand=(vcmd4, '%P'), width=5)
+        ramp_in.place(x=40, y=285)
+        ttk.Label(popup, text="Out:").place(x=100, y=285)
+        ramp_out = ttk.Entry(popup, validate="key", validatecommand=(vcmd4, '%P'), width=5)
+        ramp_out.place(x=135, y=285)
+        ttk.Label(popup, text="s").place(x=180, y=285)
+
         # Create a button for confirming the slot details
-        confirm_button = ttk.Button(popup, text="Confirm", command=lambda: self.check_validation(start_hour.get(), start_minute.get(), end_hour.get(), end_minute.get(), [far_ir.get(), near_ir.get(), vis.get(), uv.get()], popup))
+        confirm_button = ttk.Button(popup, text="Confirm", command=lambda: self.check_validation(start_hour.get(), start_minute.get(), end_hour.get(), end_minute.get(), [far_ir.get(), near_ir.get(), vis.get(), uv.get()], popup, (ramp_in.get(), ramp_out.get())))
         confirm_button.place(x=130, y=190)
 
         cancel_button = ttk.Button(popup, text="Cancel", command=lambda: popup.destroy())
@@ -170,7 +179,7 @@ class Scheduler:
 
     def save_slot(self, start_time, end_time, values):
         # Add the slot details to the list of slots
-        self.slots.append((start_time, end_time, values))
+        self.slots.insert(start_time, end_time, values)
 
         # Update the display with the new slot
         self.update_display()
@@ -199,8 +208,6 @@ class Scheduler:
 
         tk.Frame(self.root, width=380, height=2, bg='black').place(x=10, y=122)
 
-        self.slots = sorted(self.slots, key=lambda slot: slot[0])
-
         # Create a frame for each slot
         for i, slot in enumerate(self.slots):
             pady = 10
@@ -216,15 +223,18 @@ class Scheduler:
             end_time = ttk.Label(self.root, text=self.convert_time(slot[1]))
             end_time.place(x=160, y=120 + i*25 +pady)
 
-            # Create a label for the value
-            value_label = ttk.Label(self.root, text=f"{slot[2]}")
+            # Create a label for the value, ramps (seconds) are shown only if slot has them
+            value_text = f"{list(slot[2][:4])}"
+            if any(slot[2][4:]):
+                value_text += f" {slot[2][4]}/{slot[2][5]}s"
+            value_label = ttk.Label(self.root, text=value_text)
             value_label.place(x=230, y=120 + i*25 +pady)
 
             delete_button = ttk.Button(self.root, text="X", width=2, command=lambda s=slot: self.delete_slot(s))
             delete_button.place(x=350, y=120 + i*25 +pady)
 
     def delete_slot(self, slot_to_delete):
-        self.slots.remove(slot_to_delete)
+        self.slots.remove(slot_to_delete[0])
         self.update_display()
 
     def convert_time(self, time_in_minutes):
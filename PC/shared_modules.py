@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Modules used by both PC and PI (codec, transport, interval_index, profiling) live in Shared directory of repository.
+# Importing this module makes them importable, so it is imported before anything else by PC entry points
+SHARED_DIRECTORY = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Shared"))
+SHARED_MODULES = ["codec.py", "interval_index.py", "transport.py", "profiling.py"]
+
+if SHARED_DIRECTORY not in sys.path:
+    sys.path.insert(0, SHARED_DIRECTORY)
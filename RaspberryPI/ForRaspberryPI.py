@@ -1,59 +1,78 @@
-import paho.mqtt.client as mqtt
-import serial
 import threading
-import serial.tools.list_ports
-import hashlib
+import argparse
+import itertools
+import os
+import sys
 import time
 
-
-def validate_message(components):
-    # Recreate sent message and compare hashes
-    received_hash = components[-1]
-    original_message = ','.join(components[:-1]) + ','
-    generated_hash = generate_hash(original_message)
-    if received_hash != generated_hash:
-        return False
-    return True
+# Modules shared with PC are uploaded next to this script. Run from repository they are in its Shared directory
+SHARED_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Shared")
+if os.path.isdir(SHARED_DIRECTORY):
+    sys.path.append(SHARED_DIRECTORY)
+
+import codec
+from schedule_engine import ScheduleEngine, SCHEDULE_OK
+from serial_mux import SerialMultiplexer
+from panel_state import PanelStateCache
+from port_map import PortMap, port_identity
+from port_watcher import PortWatcher
+from scenes import SceneStore, parse_entries
+from state_store import StateStore
+from latency_trace import CommandTracer
+from telemetry import TelemetryStore
+from telemetry_stream import TelemetryStreamer
+from thermal import ThermalSupervisor, TemperaturePoller
+from fade_engine import FadeEngine
+from transport import create_client, TRANSPORT_MQTT, TRANSPORTS
+from metrics import MetricsRegistry, MetricsServer, MetricsPublisher, process_memory
+from profiling import Profiler
+
+# Ping PC every 40 seconds to keep MQTT communication in check
+PING_INTERVAL = 40.0
+# Status requests are answered from cache. Arduino is asked again only if cached values are older than this (seconds)
+STATUS_MAX_AGE = 30.0
+# Runtime metrics: Prometheus endpoint on this PI (port 0 turns it off) and seconds between snapshots on metrics topic
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9101
+METRICS_INTERVAL = 60.0
+# Collapsed stacks of profiling runs are written next to this script
+PROFILE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Command whose reply did not come for this long is not counted in serial reply latency nor traced
+REPLY_TIMEOUT = 5.0
+# Opening serial port resets Arduino, wait for it to boot before asking which panel it drives
+ARDUINO_BOOT_TIME = 2.5
+# Which port drives which panel, kept next to this script
+PORT_MAP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "port_map.json")
+# Named scenes, kept next to this script
+SCENES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenes.json")
+# Above DERATE_TEMP PWM of panel is scaled down, above MAX_TEMP it is cut (degrees C). Arduino cuts at 80 by itself too
+MAX_TEMP = 80
+DERATE_TEMP = 70
+# Every panel is asked for its status this often (seconds) unless it sent one anyway, so supervisor sees temperatures
+# whether or not status is streamed. One get per panel is a small part of what Arduino's 750 ms loop can take
+TEMPERATURE_POLL_INTERVAL = 5.0
+# Schedules and last setpoints survive restarts in a journal and snapshot next to this script
+STATE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Result codes of scene acknowledgement
+SCENE_OK = 0
+SCENE_UNKNOWN = 1
+SCENE_INVALID = 2
 
 
 def get_Ardunio_ports():
-    list = []
-    ports = serial.tools.list_ports.comports()
-    for port in ports:
+    # Returns {device: identity} of all USB serial ports
+    # Imported here so PI logic runs without pyserial when it is given no ports (e.g. in loopback harness)
+    import serial.tools.list_ports
+    ports = {}
+    for port in serial.tools.list_ports.comports():
         if "USB" in port.device:
-            list.append(port.device)
-    return list
-
-
-def generate_hash(message_to_hash):
-    hash_object = hashlib.sha256(message_to_hash.encode())
-    return hash_object.hexdigest()
-
-
-def publish_message(topic, message):
-    client.publish(topic, message + generate_hash(message))
-
-
-def ping_PC():
-    # If this isn't accepted by PC then it means that PI has either lost connection to broker and can't reconnect,
-    # completely lost connection, broker is not operational, script encountered a runtime error and closed or PI lost
-    # power
-    # keep in mind as SSH connection might fail due to IP change, if you get is successfully from hostname then SSH
-    # must work and therefore problems lay somewhere else
-
-    # All messages must end with comma and must be separated by comma and no whitespaces
-    message = "check,"
-    publish_message("pi_to_pc", message)
-
-
-def start_threading_timer():
-    ping_PC()
-    threading.Timer(40.0, start_threading_timer).start()
+            ports[port.device] = port_identity(port)
+    return ports
 
 
 def determine_Arduino_message(data):
     message = []
-    print(data)
     if "NO" in data:
         return message
     message = data.split(",")
@@ -62,168 +81,658 @@ def determine_Arduino_message(data):
     return message
 
 
-def arduino_communication(arduino):
-    # Arduino reading
-    # When we receive something we send it to PC
-    while True:
-        data = arduino.readline().decode().rstrip()  # Read a line from the serial port
-        if data:
-            arduino_message = determine_Arduino_message(data)
-            if len(arduino_message) == 8:
-                publish_message("pi_to_pc", f"status,{arduino_message[0]},{arduino_message[1]},{arduino_message[2]},"
-                                            f"{arduino_message[3]},{arduino_message[4]},{arduino_message[5]},"
-                                            f"{arduino_message[6]},{arduino_message[7]},")
-
-
-def send_message_to_arduinos(message_to_send):
-    for arduino in arduinos:
-        if arduino.isOpen():
-            arduino.write(message_to_send.encode("utf-8"))
-
-
-def check_scheduler():
-    while True:
-        current_time = time.localtime()
-        time_minutes = current_time.tm_hour * 60 + current_time.tm_min
-
-        for panel_number, schedule in enumerate(schedules):
-            # Schedule is empty so leave it
-            if len(schedule) == 0:
-                continue
-            for slot in schedule:
-                start_minutes = int(slot[0])
-                stop_minutes = int(slot[1])
-                if start_minutes <= time_minutes <= stop_minutes:
-                    # Get values from schedule
-                    fir = slot[2]
-                    nir = slot[3]
-                    vis = slot[4]
-                    uv = slot[5]
-
-                    message = f"<set,{panel_number+1},{fir},{nir},{vis},{uv}>"
-                    # Set PWM signals to Arduinos
-                    send_message_to_arduinos(message)
-                    # Remove this slot from scheduler as it has already been processed
-                    schedule.remove(slot)
-                    break
-
-        time.sleep(5)
-
-
-def on_message_received_from_PC(client, userdata, message):
-    # 1.Decode message
-    message = message.payload.decode()
-
-    # 2. Send message back regardless of validity
-    publish_message("pi_to_pc", "echo," + message)
-
-    # 3. Split message by comma
-    components = message.split(",")
-
-    # 4. Check message validity
-    if not validate_message(components):
-        publish_message("pi_to_pc", "error,1,")
-        return
-
-    # 5. Hashes match so we can now decide what do to
-    content = components[1:-1]
-
-    if "status" in message:
+def parse_arguments(argv=None):
+    # argv is None for script's command line, harness passes its own
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--asyncio", action="store_true",
+                        help="Run MQTT, serial, heartbeat and scheduler as tasks on one asyncio event loop")
+    parser.add_argument("--status-max-age", type=float, default=STATUS_MAX_AGE,
+                        help="Seconds cached panel status is served before Arduino is asked again")
+    parser.add_argument("--protocol", choices=[codec.PROTOCOL_TEXT, codec.PROTOCOL_BINARY], default=codec.PROTOCOL_TEXT,
+                        help="Wire format of messages sent to PC. Both formats are always accepted from PC")
+    parser.add_argument("--echo", action="store_true",
+                        help="Debug mode: send every received message back to PC before it is processed")
+    parser.add_argument("--trace", action="store_true",
+                        help="Send PC time spent on PI and on serial link for every set and status request")
+    parser.add_argument("--stream-interval", type=float, default=0.0,
+                        help="Seconds between status samples streamed on panel topics, 0 leaves streaming to PC")
+    parser.add_argument("--stream-pwm-threshold", type=int, default=0,
+                        help="Streamed status is published when PWM value moves by more than this")
+    parser.add_argument("--stream-temp-threshold", type=int, default=0,
+                        help="Streamed status is published when temperature moves by more than this")
+    parser.add_argument("--mqtt-port", type=int, default=1883, help="Port of MQTT broker on this PI")
+    parser.add_argument("--transport", choices=TRANSPORTS, default=TRANSPORT_MQTT,
+                        help="mqtt: broker on this PI. loopback: in-process broker, only useful when PC runs in the "
+                             "same process (Benchmark/loopback_harness.py)")
+    parser.add_argument("--namespace", default="",
+                        help="Prefix of all MQTT topics (e.g. room1/pc_to_pi) when several PIs share one broker")
+    parser.add_argument("--ports", nargs="*", metavar="DEVICE",
+                        help="Use these serial ports (e.g. of arduino_simulator.py) instead of USB ports found, none "
+                             "for no Arduinos at all")
+    parser.add_argument("--state-directory",
+                        help="Keep port map, scenes, schedule journal and profiles here instead of next to script")
+    parser.add_argument("--metrics-host", default=METRICS_HOST, help="Address of Prometheus metrics endpoint")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Port of Prometheus metrics endpoint (/metrics), 0 turns it off")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help="Seconds between metrics published on metrics topic, 0 turns it off")
+    return parser.parse_args(argv)
+
+
+class PIController:
+    # Everything PI script does: MQTT handlers, serial path to Arduinos, schedules, fades, streaming and metrics. Built
+    # from parsed arguments, so script's __main__ and Benchmark/loopback_harness.py run the same code. broker is the
+    # LoopbackBroker to use with --transport loopback, process wide one if None
+    def __init__(self, args, broker=None):
+        self.args = args
+        self.protocol = args.protocol
+        self.namespace = args.namespace
+        self.echo_enabled = args.echo
+        self.tracing_enabled = args.trace
+        # Sequence number of outgoing messages
+        self.outgoing_sequence = itertools.count()
+        # Files go to --state-directory if it is given, next to this script otherwise
+        directory = args.state_directory
+
+        # Runtime metrics. Hot paths update these directly, the rest is collected when metrics are read
+        self.metrics = MetricsRegistry()
+        self.received_metric = self.metrics.counter("pi_messages_received_total", "Messages received from PC",
+                                                    ("command",))
+        self.hash_failure_metric = self.metrics.counter("pi_hash_failures_total",
+                                                        "Messages from PC that failed hash or CRC check")
+        self.status_line_metric = self.metrics.counter("pi_status_lines_total", "Status lines read from Arduinos",
+                                                       ("panel",))
+        self.reply_latency_metric = self.metrics.histogram(
+            "pi_serial_reply_seconds", "Command queued for Arduino until its status line was read", ("panel",))
+        self.schedule_lag_metric = self.metrics.histogram("pi_schedule_lag_seconds", "How late schedule events fired")
+        # Matches status lines to written commands, gives reply latency and traces
+        self.command_tracer = CommandTracer(REPLY_TIMEOUT)
+
+        # Profiling is off until PC asks for it, wrapped handlers then only check a flag
+        self.profiler = Profiler(directory or PROFILE_DIRECTORY, "pi_profile")
+
+        # Set up client
+        # Client ids must be unique on a broker shared by several PIs
+        self.client = create_client(f"R_PI_{self.namespace}" if self.namespace else "R_PI", args.transport, broker)
+        self.client.username_pw_set("jakob", "jakob")
+        self.client.message_callback_add(codec.device_topic(self.namespace, "pc_to_pi"),
+                                         self.profiler.wrap("on_message_received_from_PC",
+                                                            self.on_message_received_from_PC))
+
+        # Derates or cuts panels that get too hot, checked on every status line as it is read
+        self.thermal_supervisor = ThermalSupervisor(MAX_TEMP, DERATE_TEMP)
+
+        # Schedules and setpoints from before restart, loads in milliseconds
+        self.state_store = StateStore(directory or STATE_DIRECTORY).load()
+
+        # Last known state of every panel
+        self.panel_states = PanelStateCache(args.status_max_age)
+        # History of every panel for thermal tuning, in memory only
+        self.telemetry = TelemetryStore()
+
+        # Named scenes
+        self.scene_store = SceneStore(os.path.join(directory, "scenes.json") if directory else SCENES_PATH)
+
+        # Status stream, off until PC asks for it or --stream-interval is given
+        self.streamer = TelemetryStreamer(self.request_panel_samples, self.publish_panel_status)
+        if args.stream_interval > 0:
+            self.streamer.configure(args.stream_interval, args.stream_pwm_threshold, args.stream_temp_threshold)
+
+        if args.ports is not None:
+            # Given ports (pseudo-terminals...) get new names on every run, so their panels are not cached on disk
+            self.port_map = PortMap(None)
+            self.list_ports = self.get_given_ports
+        else:
+            self.port_map = PortMap(os.path.join(directory, "port_map.json") if directory else PORT_MAP_PATH)
+            self.list_ports = get_Ardunio_ports
+
+        # Engage serial communication. One loop watches all ports, timeout=0 so reads never block it
+        self.serial_mux = SerialMultiplexer(self.profiler.wrap("arduino_communication", self.arduino_communication))
+        self.serial_mux.on_port_lost = self.on_port_lost
+        self.serial_mux.on_written = self.command_tracer.on_written
+
+        # Arduinos can be plugged in and unplugged while running. Ports present at start up are opened in parallel,
+        # later ones by port watcher. Ports in replugged_ports get their panel's setpoint back with their first status
+        # line
+        self.replugged_ports = set()
+        self.port_watcher = PortWatcher(self.list_ports, self.on_port_added, self.on_port_removed)
+
+        # Temperatures of every connected panel reach thermal supervisor even while nothing else asks for status. Panels
+        # limited by supervisor are released only after it sees them cool, this keeps them polled too
+        self.temperature_poller = TemperaturePoller(self.thermal_supervisor, self.port_map.panels,
+                                                    self.request_panel_status, TEMPERATURE_POLL_INTERVAL)
+
+        # Fades of scheduled ramps, paced by how fast every Arduino takes messages
+        self.fade_engine = FadeEngine(self.write_panel, self.port_map.lookup)
+
+        # Create schedule engine. It sleeps until next slot boundary and wakes up early when schedule changes
+        self.schedule_engine = ScheduleEngine(self.profiler.wrap("on_schedule_transition", self.on_schedule_transition))
+        self.schedule_engine.on_slot_done = lambda panel_number, slot: self.state_store.record_slot_done(panel_number,
+                                                                                                        slot[0])
+        self.schedule_engine.on_lag = self.schedule_lag_metric.observe
+
+        self.register_metric_collectors()
+        self.metrics_publisher = MetricsPublisher(self.metrics, self.publish_metrics, args.metrics_interval)
+        self.metrics_server = None
+
+        self.ping_timer = None
+        self.threads = []
+        self.running = False
+
+    def start_up(self):
+        # Once Arduinos have booted learn or verify which port drives which panel and restore state from before
+        # restart, all before we connect to broker
+        Arduino_ports, _ = self.port_watcher.scan()
+        if not self.open_ports(Arduino_ports):
+            print("No Arduinos found, panels are brought up as they are plugged in")
+        if self.args.metrics_port:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, self.args.metrics_host, self.args.metrics_port)
+                self.metrics_server.start()
+            except OSError as e:
+                self.metrics_server = None
+                print(f"Could not start metrics endpoint: {e}")
+        if self.serial_mux.get_devices():
+            time.sleep(ARDUINO_BOOT_TIME)
+        self.handshake_arduinos()
+        self.restore_state()
+        self.schedule_engine.poll()
+        self.serial_mux.flush(ARDUINO_BOOT_TIME)
+
+    def workers(self):
+        # Parts that run on their own thread (or task with --asyncio) besides serial loop
+        return [self.schedule_engine, self.state_store, self.streamer, self.temperature_poller, self.fade_engine,
+                self.metrics_publisher, self.port_watcher]
+
+    def run_asyncio(self):
+        # Import here so threaded mode does not depend on asyncio runtime module
+        from async_runtime import AsyncRuntime
+        runtime = AsyncRuntime(self.client, self.serial_mux, self.ping_PC, PING_INTERVAL, self.workers())
+        runtime.run("localhost", self.args.mqtt_port, [codec.device_topic(self.namespace, "pc_to_pi")])
+
+    def start(self):
+        # Connect to broker and subscribe to topics, then every part gets its own thread. Caller runs client's
+        # network loop (loop_forever in script, loop_start in harness)
+        self.client.connect("localhost", self.args.mqtt_port, 20)
+        self.client.subscribe(codec.device_topic(self.namespace, "pc_to_pi"))
+        self.running = True
+
+        for worker in [self.serial_mux] + self.workers():
+            thread = threading.Thread(target=worker.run)
+            thread.start()
+            self.threads.append(thread)
+
+        # Start the timer for keeping MQTT communication in check
+        self.start_threading_timer()
+
+    def stop(self):
+        # Stops what start() started, used by harness. Script itself runs until it is killed
+        self.running = False
+        if self.ping_timer is not None:
+            self.ping_timer.cancel()
+        for worker in [self.serial_mux] + self.workers():
+            worker.stop()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.client.disconnect()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.state_store.close()
+
+    def get_given_ports(self):
+        # Ports given with --ports that exist, pseudo-terminals of simulator go away when it stops
+        return {port: port for port in self.args.ports if os.path.exists(port)}
+
+    def publish_command(self, topic, command, fields, qos=0):
+        # Encoded as text or binary frame depending on --protocol
+        payload = codec.encode(topic, command, fields, self.protocol, next(self.outgoing_sequence))
+        self.client.publish(codec.device_topic(self.namespace, topic), payload, qos)
+
+    def ping_PC(self):
+        # If this isn't accepted by PC then it means that PI has either lost connection to broker and can't
+        # reconnect, completely lost connection, broker is not operational, script encountered a runtime error and
+        # closed or PI lost power
+        # keep in mind as SSH connection might fail due to IP change, if you get is successfully from hostname then
+        # SSH must work and therefore problems lay somewhere else
+
+        self.publish_command("pi_to_pc", "check", [])
+
+    def start_threading_timer(self):
+        if not self.running:
+            return
+        self.ping_PC()
+        self.ping_timer = threading.Timer(PING_INTERVAL, self.start_threading_timer)
+        self.ping_timer.start()
+
+    def arduino_communication(self, port, data):
+        # Arduino reading. Called by serial multiplexer with one complete line from given port
+        # When we receive something we send it to PC
+        replied = time.monotonic()
+        arduino_message = determine_Arduino_message(data)
+        if len(arduino_message) == 8:
+            try:
+                integers = [int(c) for c in arduino_message]
+            except ValueError:
+                return
+            self.status_line_metric.inc(integers[0])
+            # Command this line answers, status lines are matched to written commands in order
+            command = self.command_tracer.on_reply(integers[0], replied)
+            if command is not None:
+                self.reply_latency_metric.observe(replied - command[2], integers[0])
+
+            # Temperature is checked before anything else, on serial thread, so overheating panel is derated right away
+            thermal = self.thermal_supervisor.check(integers[0], integers[1:])
+            if thermal is not None:
+                self.on_thermal_event(integers[0], *thermal)
+
+            # First field is ARDUINO_NUM so we now know which panel this port drives
+            self.port_map.learn(port, integers[0])
+            self.serial_mux.discard(port, "probe")
+            # Panel took a message, fade engine may send its next step
+            self.fade_engine.on_reply(integers[0])
+            if port in self.replugged_ports:
+                self.replugged_ports.discard(port)
+                self.restore_panel(integers[0])
+            self.panel_states.update(integers[0], integers[1:])
+            self.telemetry.add(integers[0], integers[1:])
+            # While streaming PC gets status on panel's own topic and only when values moved, otherwise every line is
+            # sent
+            if self.streamer.is_streaming():
+                self.streamer.on_sample(integers[0], integers[1:])
+            else:
+                self.publish_status(integers[0], integers[1:], 0.0)
+
+            # Tell PC how long command that caused this reply spent on PI and on serial link
+            if command is not None and command[0] is not None:
+                sequence, received, queued, written = command
+                self.publish_trace(sequence, False, written - received, replied - written, time.monotonic() - replied)
+
+    def on_thermal_event(self, panel_number, level, temperature, values, level_changed):
+        # Limit panel first, then tell PC
+        if values is not None:
+            fir, nir, vis, uv = values
+            self.send_message_to_panel(panel_number, f"<set,{panel_number},{fir},{nir},{vis},{uv}>", priority=True)
+        if level_changed:
+            print(f"Thermal supervisor: panel {panel_number} at {temperature} C, level {level}")
+            # Alarm is sent with QoS 1 so it is not lost like normal status messages could be
+            self.publish_command("pi_to_pc", "alarm", [panel_number, level, temperature], qos=1)
+
+    def publish_status(self, panel_number, values, age):
+        # values: fir, nir, vis, uv, temp1, temp2, temp3. Age of values in milliseconds is appended as last field
+        self.publish_command("pi_to_pc", "status", [panel_number] + list(values) + [int(age * 1000)])
+
+    def publish_panel_status(self, panel_number, values):
+        # Retained, so whoever subscribes later gets last state right away
+        payload = codec.encode("pi_to_pc", "status", [panel_number] + list(values) + [0], self.protocol,
+                               next(self.outgoing_sequence))
+        self.client.publish(codec.device_topic(self.namespace, codec.PANEL_TOPIC.format(panel_number)), payload,
+                            retain=True)
+
+    def publish_metrics(self, snapshot):
+        payload = codec.encode("pi_to_pc", "metrics", [snapshot], self.protocol, next(self.outgoing_sequence))
+        self.client.publish(codec.device_topic(self.namespace, codec.METRICS_TOPIC), payload)
+
+    def register_metric_collectors(self):
+        # Values kept by other parts are read only when metrics are rendered or published
+        serial_read = self.metrics.counter("pi_serial_bytes_read_total", "Bytes read from serial port", ("port",))
+        serial_written = self.metrics.counter("pi_serial_bytes_written_total", "Bytes written to serial port",
+                                              ("port",))
+        serial_dropped = self.metrics.counter("pi_serial_dropped_total", "Messages dropped from full write queue",
+                                              ("port",))
+        serial_queue = self.metrics.gauge("pi_serial_queue_depth", "Messages waiting in write queue", ("port",))
+        serial_ports = self.metrics.gauge("pi_serial_ports", "Open serial ports")
+        fades = self.metrics.gauge("pi_fades_active", "Panels being faded")
+        threads = self.metrics.gauge("pi_threads", "Threads of PI script")
+        rss = self.metrics.gauge("pi_resident_memory_bytes", "Resident memory of PI script")
+        peak_rss = self.metrics.gauge("pi_resident_memory_peak_bytes", "Peak resident memory of PI script")
+
+        def collect():
+            for device, (read, written, dropped) in self.serial_mux.counters().items():
+                serial_read.set(read, device)
+                serial_written.set(written, device)
+                serial_dropped.set(dropped, device)
+            for device, depth in self.serial_mux.queued().items():
+                serial_queue.set(depth, device)
+            serial_ports.set(len(self.serial_mux.get_devices()))
+            fades.set(self.fade_engine.fading_count())
+            threads.set(threading.active_count())
+            current, peak = process_memory()
+            rss.set(current)
+            peak_rss.set(peak)
+        self.metrics.add_collector(collect)
+
+    def request_panel_samples(self):
+        # Called by streamer at configured rate, replies come back through arduino_communication
+        for panel_number in self.port_map.panels():
+            self.request_panel_status(panel_number)
+
+    def request_panel_status(self, panel_number):
+        self.send_message_to_panel(panel_number, f"<get,{panel_number}>")
+
+    def publish_trace(self, sequence, cached, pi_time, serial_time, reply_time):
+        # Times in seconds are sent in microseconds
+        self.publish_command("pi_to_pc", "trace", [sequence, cached] +
+                        [int(duration * 1000000) for duration in (pi_time, serial_time, reply_time)])
+
+    def send_message_to_arduinos(self, message_to_send, key=None, priority=False):
+        self.serial_mux.write_all(message_to_send.encode("utf-8"), key, priority)
+
+    def send_message_to_panel(self, panel_number, message_to_send, priority=False, trace=None):
+        # Write only to port driving given panel. Until we know it, send to all and Arduinos filter by ARDUINO_NUM
+        # Messages wait in port's queue, newer set (or get) for a panel replaces one that was not sent yet. Trace is
+        # (sequence, received) of PC command that caused this message
+        key = (message_to_send[1:4], panel_number)
+        self.command_tracer.on_queued(key, panel_number, *(trace or ()))
+        device = self.port_map.lookup(panel_number)
+        if device is None or not self.serial_mux.write(device, message_to_send.encode("utf-8"), key, priority):
+            self.send_message_to_arduinos(message_to_send, key, priority)
+
+    def set_panel(self, panel_number, fir, nir, vis, uv, trace=None):
+        # Set PWM signals to Arduino and remember them so they can be restored after restart. Stops fade of this panel
+        self.state_store.record_setpoint(panel_number, [fir, nir, vis, uv])
+        self.fade_engine.cancel(panel_number, [fir, nir, vis, uv])
+        self.write_panel(panel_number, [fir, nir, vis, uv], trace)
+
+    def write_panel(self, panel_number, values, trace=None):
+        # Panel that is too hot gets limited values, requested ones are applied once thermal supervisor releases it.
+        # Used directly by fade engine so fade steps are not journaled
+        fir, nir, vis, uv = self.thermal_supervisor.limit(panel_number, values)
+        message = f"<set,{panel_number},{fir},{nir},{vis},{uv}>"
+        self.send_message_to_panel(panel_number, message, trace=trace)
+
+    def apply_scene(self, entries):
+        # Every set is queued as its own keyed message on its panel's port (or on all ports while port is unknown).
+        # Arduino reads one message per loop into a 64 byte buffer while it waits for temperatures, so sets written as
+        # one burst would be lost. Returns number of panels set
+        for panel_number, fir, nir, vis, uv in entries:
+            self.set_panel(panel_number, fir, nir, vis, uv)
+        return len(entries)
+
+    def handshake_arduinos(self):
+        # Ask every port which panel it drives
+        for device in self.serial_mux.get_devices():
+            self.handshake_port(device)
+
+    def handshake_port(self, device):
+        # Port known from port map is only verified. Unknown one is asked for every panel number that has no port yet
+        # (up to number of ports and panels with a saved setpoint) and only the matching Arduino answers. Probes are
+        # queued, so serial multiplexer writes one per Arduino loop and the next only after a reply or REPLY_WAIT. Once
+        # port answered the probes still queued are dropped (see arduino_communication)
+        panel_number = self.port_map.panel_of(device)
+        if panel_number is not None:
+            candidates = [panel_number]
+        else:
+            mapped = self.port_map.panels()
+            candidates = set(range(1, len(self.serial_mux.get_devices()) + 1)) | set(self.state_store.get_setpoints())
+            candidates = sorted(candidates.difference(mapped))
+        for candidate in candidates:
+            self.serial_mux.write(device, f"<get,{candidate}>".encode("utf-8"), ("probe", candidate))
+
+    def open_port(self, device, identity):
+        # Opening resets Arduino. Returns True if port was added to serial multiplexer, port that could not be opened is
+        # tried again on next scan of port watcher. Imported here so PI logic runs without pyserial when it has no ports
+        import serial
         try:
-            panel_number = int(content[0])
-
-            # Get values from arduino
-            message = f"<get,{panel_number}>"
-
-            # Send message to ALL Arduinos, will send back when Arduino messages back
-            send_message_to_arduinos(message)
-        except:
-            pass
-
-    elif "set" in message:
-        # Status is sent back to PC automatically
+            serial_port = serial.Serial(device, 9600, timeout=0)
+        except (OSError, ValueError) as e:
+            print(f"Could not open {device}: {e}")
+            self.port_watcher.forget(device)
+            return False
+        self.port_map.add_device(device, identity)
+        self.serial_mux.add_port(device, serial_port)
+        print(f"Arduino port {device} added")
+        return True
+
+    def open_ports(self, ports):
+        # Opens {device: identity} in parallel, some USB serial drivers block in open. Returns devices that were opened
+        opened = []
+
+        def open_one(device, identity):
+            if self.open_port(device, identity):
+                opened.append(device)
+        threads = [threading.Thread(target=open_one, args=item) for item in ports.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return opened
+
+    def on_port_added(self, device, identity):
+        # Called by port watcher for Arduino plugged in while running. Port is opened on its own thread so other ports
+        # and the watcher are not held up while board boots, then it is asked which panel it drives. Panel's last
+        # setpoint is restored once its first status line arrives
+        def bring_up():
+            self.replugged_ports.add(device)
+            if not self.open_port(device, identity):
+                self.replugged_ports.discard(device)
+                return
+            time.sleep(ARDUINO_BOOT_TIME)
+            self.handshake_port(device)
+        threading.Thread(target=bring_up, daemon=True).start()
+
+    def on_port_removed(self, device):
+        # Called by port watcher for Arduino that was unplugged. Its panel is written to all ports until it is back
+        self.serial_mux.remove_port(device)
+        self.port_map.remove_device(device)
+        self.replugged_ports.discard(device)
+        print(f"Arduino port {device} removed")
+
+    def on_port_lost(self, device):
+        # Called by serial multiplexer when port failed. If it is still listed, port watcher opens it again
+        self.port_map.remove_device(device)
+        self.replugged_ports.discard(device)
+        self.port_watcher.forget(device)
+        print(f"Arduino port {device} lost")
+
+    def restore_panel(self, panel_number):
+        # Arduino starts with all channels off after being plugged in again, so bring back panel's last setpoint
+        values = self.state_store.get_setpoints().get(panel_number)
+        if values is not None and not self.fade_engine.is_fading(panel_number):
+            self.write_panel(panel_number, values)
+
+    def on_schedule_transition(self, panel_number, values, ramp=0):
+        # Called by schedule engine exactly on slot start (slot values) and on start of ramp out (all zeros)
+        if ramp <= 0:
+            self.set_panel(panel_number, *values)
+            return
+        # Target is saved right away so restart does not need to know about fades
+        self.state_store.record_setpoint(panel_number, values)
+        cached = self.panel_states.get(panel_number)
+        self.fade_engine.fade(panel_number, values, ramp, cached[0][:4] if cached is not None else None)
+
+    def restore_state(self):
+        # Schedules go back to engine (active slots fire as soon as engine is polled) and last setpoints are re-applied
+        for panel_number, (version, slots) in self.state_store.get_schedules().items():
+            try:
+                self.schedule_engine.set_schedule(panel_number, slots, version)
+            except ValueError as e:
+                print(f"Could not restore schedule of panel {panel_number}: {e}")
+        setpoints = self.state_store.get_setpoints()
+        self.apply_scene([(panel_number, *values) for panel_number, values in sorted(setpoints.items())])
+
+    def on_message_received_from_PC(self, client, userdata, message):
+        # 1. Take raw message, text and binary frames are told apart by codec
+        received = time.monotonic()
+        payload = message.payload
+
+        # 2. Send message back only in echo (debug) mode, otherwise valid messages are acknowledged by sequence number
+        if self.echo_enabled:
+            self.publish_command("pi_to_pc", "echo", [payload])
+
+        # 3. Decode and check message validity
         try:
-            integers = [int(c) for c in content]
-
-            panel_number = integers[0]
-            fir = integers[1]
-            nir = integers[2]
-            vis = integers[3]
-            uv = integers[4]
-
-            message = f"<set,{panel_number},{fir},{nir},{vis},{uv}>"
-
-            # Set PWM signals to Arduinos
-            send_message_to_arduinos(message)
-        except:
-            pass
-
-    # Scheduler handling
-    elif "ON" in message:
-        try:
-            panel_number = int(content[0])
-            # Update Scheduler based on panel number
-            schedules[panel_number - 1].clear()
-            for slot in content[1:]:
-                time_list = slot.split(";")
-                schedules[panel_number - 1].append(time_list)
-        except:
-            pass
-
-    elif "OFF" in message:
-        try:
-            # Clear scheduler, effectively turning it off
-            panel_number = int(content[0])
-            schedules[panel_number - 1].clear()
-        except:
-            pass
-
-    else:
-        # If message is valid but for some reason does not match with any order
-        returning_message = "Received message from PC doesn't match any orders for PI!"
-        publish_message("pi_to_pc", returning_message)
+            command, content, sequence = codec.decode("pc_to_pi", payload)
+        except codec.CodecError:
+            # Sequence number of damaged message can't be trusted, PC finds out by missing ack
+            self.hash_failure_metric.inc()
+            self.publish_command("pi_to_pc", "error", [1])
+            return
+        self.received_metric.inc(command if command in codec.COMMANDS["pc_to_pi"] else "unknown")
+
+        # 4. Message is valid so we can now decide what do to
+        result = self.execute_command(command, content, sequence, received)
+
+        # 5. Ack or nack messages that carry sequence number. Older PC scripts send none and get nothing back
+        if sequence is not None:
+            self.publish_command("pi_to_pc", "ack", [sequence, result])
+
+    def execute_command(self, command, content, sequence=None, received=None):
+        # Returns ack result code. Sequence number and receive time are only used to trace latency
+        trace = (sequence, received) if self.tracing_enabled and sequence is not None else None
+        if command == "status":
+            try:
+                panel_number = content[0]
+
+                # Answer right away from cache
+                cached = self.panel_states.get(panel_number)
+                if cached is not None:
+                    self.publish_status(panel_number, cached[0], cached[1])
+
+                # Get values from arduino only if cache is too old, will send back when Arduino messages back
+                if self.panel_states.needs_refresh(panel_number):
+                    message = f"<get,{panel_number}>"
+                    self.send_message_to_panel(panel_number, message, trace=trace)
+                elif trace is not None and cached is not None:
+                    self.publish_trace(sequence, True, time.monotonic() - received, 0, 0)
+            except:
+                return codec.ACK_FAILED
+
+        elif command == "set":
+            # Status is sent back to PC automatically
+            try:
+                panel_number, fir, nir, vis, uv = content[:5]
+
+                # Set PWM signals to Arduino
+                self.set_panel(panel_number, fir, nir, vis, uv, trace)
+            except:
+                return codec.ACK_FAILED
+
+        # Scheduler handling
+        elif command == "ON":
+            try:
+                panel_number = content[0]
+                # Update Scheduler based on panel number, engine wakes up by itself to pick up new slots
+                version = self.schedule_engine.set_schedule(panel_number, content[1:])
+                self.state_store.record_schedule(panel_number, version, content[1:])
+                self.publish_command("pi_to_pc", "schedule_ack", [panel_number, SCHEDULE_OK, version])
+            except:
+                return codec.ACK_FAILED
+
+        elif command == "OFF":
+            try:
+                # Clear scheduler, effectively turning it off
+                panel_number = content[0]
+                version = self.schedule_engine.clear_schedule(panel_number)
+                self.state_store.record_schedule(panel_number, version, [])
+                self.publish_command("pi_to_pc", "schedule_ack", [panel_number, SCHEDULE_OK, version])
+            except:
+                return codec.ACK_FAILED
+
+        # Incremental schedule changes, applied in place only if made against current schedule version. Stale or invalid
+        # change is still acked, its result is carried by schedule_ack
+        elif command in ("slot_add", "slot_remove", "slot_replace"):
+            try:
+                panel_number, base_version = content[:2]
+                remove_start = None
+                slot = None
+                if command == "slot_add":
+                    slot = content[2]
+                elif command == "slot_remove":
+                    remove_start = content[2]
+                else:
+                    remove_start, slot = content[2:4]
+                result, version = self.schedule_engine.update_schedule(panel_number, base_version, remove_start, slot)
+                if result == SCHEDULE_OK:
+                    self.state_store.record_update(panel_number, version, remove_start, slot)
+                self.publish_command("pi_to_pc", "schedule_ack", [panel_number, result, version])
+            except:
+                return codec.ACK_FAILED
+
+        # History of panel status, downsampled by PI to requested resolution
+        elif command == "history":
+            try:
+                panel_number, start, stop, resolution = content[:4]
+                resolution, rows = self.telemetry.query(panel_number, start, stop, resolution)
+                self.publish_command("pi_to_pc", "history", [panel_number, resolution] + rows)
+            except:
+                return codec.ACK_FAILED
+
+        # Streaming of status on panel topics at given rate, interval 0 stops it
+        elif command == "stream":
+            try:
+                interval, pwm_threshold, temp_threshold = content[:3]
+                self.streamer.configure(interval / 1000.0, pwm_threshold, temp_threshold)
+            except:
+                return codec.ACK_FAILED
+
+        elif command == "profile":
+            # Stopping sends timings of handlers to PC as text, sampled stacks stay in a file on PI
+            try:
+                enable, interval = content[:2]
+                if enable:
+                    if interval:
+                        self.profiler.start(interval / 1000.0)
+                    else:
+                        self.profiler.start()
+                elif self.profiler.is_running():
+                    try:
+                        result = f"Stacks written to {self.profiler.stop()}"
+                    except OSError as e:
+                        result = f"Could not write stacks: {e}"
+                    self.publish_command("pi_to_pc", "text", [self.profiler.report() + "\n" + result])
+            except:
+                return codec.ACK_FAILED
+
+        # Scenes, one message sets many panels and is acknowledged once
+        elif command == "scene":
+            try:
+                entries = parse_entries(content)
+            except (ValueError, TypeError):
+                self.publish_command("pi_to_pc", "scene_ack", [SCENE_INVALID, 0, ""])
+                return codec.ACK_FAILED
+            self.publish_command("pi_to_pc", "scene_ack", [SCENE_OK, self.apply_scene(entries), ""])
+
+        elif command == "scene_save":
+            name = content[0]
+            try:
+                entries = self.scene_store.save(name, content[1:])
+            except (ValueError, TypeError):
+                self.publish_command("pi_to_pc", "scene_ack", [SCENE_INVALID, 0, name])
+                return codec.ACK_FAILED
+            self.publish_command("pi_to_pc", "scene_ack", [SCENE_OK, len(entries), name])
+
+        elif command == "scene_recall":
+            name = content[0]
+            entries = self.scene_store.get(name)
+            if entries is None:
+                self.publish_command("pi_to_pc", "scene_ack", [SCENE_UNKNOWN, 0, name])
+                return codec.ACK_FAILED
+            self.publish_command("pi_to_pc", "scene_ack", [SCENE_OK, self.apply_scene(entries), name])
+
+        elif command == "scene_delete":
+            name = content[0]
+            result = SCENE_OK if self.scene_store.delete(name) else SCENE_UNKNOWN
+            self.publish_command("pi_to_pc", "scene_ack", [result, 0, name])
+            if result != SCENE_OK:
+                return codec.ACK_FAILED
+
+        else:
+            # If message is valid but for some reason does not match with any order
+            returning_message = "Received message from PC doesn't match any orders for PI!"
+            self.publish_command("pi_to_pc", "text", [returning_message])
+            return codec.ACK_UNKNOWN
+
+        return codec.ACK_OK
 
 
 if __name__ == '__main__':
+    pi = PIController(parse_arguments())
+    pi.start_up()
 
-    MAX_TEMP = 80
-
-    # Set up client and connect to broker
-    client = mqtt.Client("R_PI")
-    client.username_pw_set("jakob", "jakob")
-    client.connect("localhost", 1883, 20)
-
-    # Subscribe to topics
-    client.subscribe("pc_to_pi")
-    client.message_callback_add("pc_to_pi", on_message_received_from_PC)
-
-    Arduino_ports = get_Ardunio_ports()
-
-    if len(Arduino_ports) != 3:
-        # Not enough arduinos!
-        exit(1)
-
-    # Engage serial communication
-    arduino1 = serial.Serial(Arduino_ports[0], 9600)
-    arduino2 = serial.Serial(Arduino_ports[1], 9600)
-    arduino3 = serial.Serial(Arduino_ports[2], 9600)
-
-    arduinos = [arduino1, arduino2, arduino3]
-
-    # Start threads to listen for in serial communication
-    for arduino in arduinos:
-        thread = threading.Thread(target=arduino_communication, args=(arduino,))
-        thread.start()
-
-    # Start the timer for keeping MQTT communication in check. Ping every 40 seconds
-    start_threading_timer()
-
-    # Create list for holding schedules
-    schedules = [[], [], []]
-
-    # Create thread for scheduler checking. Interrupt happens 5 seconds
-    scheduler_thread = threading.Thread(target=check_scheduler)
-    scheduler_thread.start()
-
-    client.loop_forever()
+    if pi.args.asyncio:
+        pi.run_asyncio()
+        exit(0)
 
+    pi.start()
+    pi.client.loop_forever()
@@ -0,0 +1,341 @@
+import argparse
+import collections
+import math
+import os
+import pty
+import re
+import select
+import signal
+import threading
+import time
+import tty
+
+# Same values as Arduino/Arduino.ino
+MAX_TEMP = 80
+BAUD_RATE = 9600
+N = 50
+# Hardware serial buffers of ATmega328P
+RX_BUFFER_SIZE = 64
+TX_BUFFER_SIZE = 64
+# Stream.readStringUntil gives up when no character came for this long
+STREAM_TIMEOUT = 1.0
+# DS18B20 conversion at 12 bit resolution, requestTemperatures blocks for it. Without sensor it returns right away
+CONVERSION_TIME = 0.75
+# Opening the port resets the board (DTR), bootloader eats everything sent until sketch runs
+BOOT_TIME = 2.0
+# DallasTemperature value of a sensor that is not connected
+DEVICE_DISCONNECTED_C = -127
+
+# 8N1 needs 10 bits per byte
+BYTE_TIME = 10.0 / BAUD_RATE
+# How often an idle sketch is woken up when requestTemperatures takes no time
+IDLE_WAKEUP = 0.1
+
+TEMPERATURE_CURVES = ("pwm", "constant", "sine", "disconnected")
+
+
+def to_int(text):
+    # String.toInt: leading integer of text or 0
+    match = re.match(r"\s*([-+]?\d+)", text)
+    return int(match.group(1)) if match else 0
+
+
+class TemperatureCurve:
+    # Temperature reported by the sensor of one panel. pwm: panel heats up towards ambient + heating * mean PWM with
+    # given time constant, constant: always ambient, sine: ambient +- amplitude over period, disconnected: no sensor
+    def __init__(self, curve, ambient, heating, time_constant, amplitude, period):
+        self.curve = curve
+        self.ambient = ambient
+        self.heating = heating
+        self.time_constant = time_constant
+        self.amplitude = amplitude
+        self.period = period
+        self.temperature = float(ambient)
+        self.updated = time.monotonic()
+
+    def read(self, pwm):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        if self.curve == "disconnected":
+            return DEVICE_DISCONNECTED_C
+        if self.curve == "constant":
+            return float(self.ambient)
+        if self.curve == "sine":
+            return self.ambient + self.amplitude * math.sin(2 * math.pi * now / self.period)
+        target = self.ambient + self.heating * sum(pwm) / len(pwm)
+        self.temperature += (target - self.temperature) * (1 - math.exp(-elapsed / self.time_constant))
+        return self.temperature
+
+
+class VirtualArduino:
+    # One Arduino running Arduino.ino behind a pseudo-terminal. Sketch runs in its own thread with the same blocking
+    # behaviour: bytes arrive at baud rate into a 64 byte buffer (overflow is lost while sketch is busy), replies leave
+    # at baud rate and requestTemperatures blocks the loop for conversion time
+    def __init__(self, arduino_num, temperature_curve, conversion_time=CONVERSION_TIME, boot_time=BOOT_TIME):
+        self.arduino_num = arduino_num
+        self.temperature_curve = temperature_curve
+        self.conversion_time = conversion_time
+        self.boot_time = boot_time
+
+        self.master, slave = pty.openpty()
+        self.device = os.ttyname(slave)
+        # Raw mode stays on the pty, so nothing is echoed or translated before the script configures the port
+        tty.setraw(slave)
+        # Master read fails with EIO while nobody has slave open, that is how we see the port being opened and closed
+        os.close(slave)
+        os.set_blocking(self.master, False)
+
+        self.connected = False
+        self.running = False
+        self.thread = None
+        # Bytes on the wire as (arrival time, byte) and bytes in RX buffer
+        self.incoming = collections.deque()
+        self.last_arrival = 0.0
+        self.rx_buffer = collections.deque()
+        self.rx_lost = 0
+        # Replies as (delivery time, bytes) and time TX buffer is empty
+        self.outgoing = collections.deque()
+        self.tx_free = 0.0
+        self.reset()
+
+    def reset(self):
+        self.pwm = [0, 0, 0, 0]
+        self.temperature = float(self.temperature_curve.read(self.pwm))
+        self.incoming.clear()
+        self.rx_buffer.clear()
+        self.outgoing.clear()
+
+    # Wire
+
+    def receive(self):
+        # Moves bytes written by script onto the wire. Returns False if port is not open
+        now = time.monotonic()
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            if not data:
+                return False
+            for byte in data:
+                self.last_arrival = max(self.last_arrival, now) + BYTE_TIME
+                self.incoming.append((self.last_arrival, byte))
+
+    def arrive(self):
+        # Bytes that reached the board so far go to RX buffer or are lost if it is full
+        now = time.monotonic()
+        while self.incoming and self.incoming[0][0] <= now:
+            _, byte = self.incoming.popleft()
+            if len(self.rx_buffer) < RX_BUFFER_SIZE:
+                self.rx_buffer.append(byte)
+            else:
+                self.rx_lost += 1
+
+    def deliver(self):
+        now = time.monotonic()
+        while self.outgoing and self.outgoing[0][0] <= now:
+            _, data = self.outgoing.popleft()
+            try:
+                os.write(self.master, data)
+            except OSError:
+                pass
+
+    def wait(self, deadline, for_input=False):
+        # Sleeps until deadline while replies keep leaving and script's bytes keep arriving. With for_input returns
+        # as soon as a byte is in RX buffer. Returns False if port was closed
+        while self.running:
+            if not self.receive():
+                return False
+            self.deliver()
+            self.arrive()
+            now = time.monotonic()
+            if (for_input and self.rx_buffer) or now >= deadline:
+                return True
+            wakeup = deadline
+            if self.incoming:
+                wakeup = min(wakeup, self.incoming[0][0])
+            if self.outgoing:
+                wakeup = min(wakeup, self.outgoing[0][0])
+            select.select([self.master], [], [], max(wakeup - now, 0))
+        return False
+
+    # Arduino API
+
+    def available(self):
+        self.receive()
+        self.arrive()
+        return len(self.rx_buffer)
+
+    def read(self):
+        return chr(self.rx_buffer.popleft()) if self.rx_buffer else None
+
+    def read_string_until(self, end_char):
+        content = ""
+        while True:
+            if not self.rx_buffer and not self.wait(time.monotonic() + STREAM_TIMEOUT, for_input=True):
+                return None
+            character = self.read()
+            if character is None or character == end_char:
+                return content
+            content += character
+
+    def println(self, message):
+        # Returns once message fits in TX buffer, bytes leave at baud rate
+        data = (message + "\r\n").encode()
+        now = time.monotonic()
+        self.tx_free = max(self.tx_free, now) + len(data) * BYTE_TIME
+        self.outgoing.append((self.tx_free, data))
+        if self.tx_free - now > TX_BUFFER_SIZE * BYTE_TIME:
+            self.wait(self.tx_free - TX_BUFFER_SIZE * BYTE_TIME)
+
+    def request_temperatures(self):
+        # Temperature is read at the end of conversion, like DS18B20 scratchpad
+        if self.temperature_curve.curve == "disconnected":
+            self.wait(time.monotonic())
+        else:
+            self.wait(time.monotonic() + self.conversion_time)
+        self.temperature = float(self.temperature_curve.read(self.pwm))
+
+    # Sketch
+
+    def construct_message(self, message):
+        temp = int(self.temperature)
+        fir, nir, vis, uv = self.pwm
+        message += f"{self.arduino_num},{fir},{nir},{vis},{uv},"
+        message += f"{temp},{temp},{temp}"
+        return message + ",>"
+
+    def loop(self):
+        if self.available():
+            start_char = "<"
+            end_char = ">"
+
+            received_char = self.read()
+
+            if received_char == start_char:
+                content = self.read_string_until(end_char)
+                if content is None or len(content) > N:
+                    return
+
+                contents = [""] * (N + 1)
+                index = 0
+                substring = ""
+                for c in content:
+                    if c == ",":
+                        index += 1
+                        substring = ""
+                        continue
+                    substring += c
+                    contents[index] = substring
+
+                command = contents[0]
+                panel_number = to_int(contents[1])
+
+                if panel_number != self.arduino_num:
+                    return
+
+                outgoing_message = "<status,"
+                if command == "get":
+                    outgoing_message = self.construct_message(outgoing_message)
+                elif command == "set":
+                    self.pwm = [to_int(value) for value in contents[2:6]]
+                    outgoing_message = self.construct_message(outgoing_message)
+
+                self.println(outgoing_message)
+            else:
+                while self.available() and self.read() != end_char:
+                    pass
+        elif self.conversion_time == 0 or self.temperature_curve.curve == "disconnected":
+            # requestTemperatures takes no time, sleep until something comes instead of spinning
+            self.wait(time.monotonic() + IDLE_WAKEUP, for_input=True)
+
+        self.request_temperatures()
+
+        if self.temperature > MAX_TEMP:
+            self.pwm = [0, 0, 0, 0]
+
+    def run(self):
+        self.running = True
+        while self.running:
+            if not self.connected:
+                if not self.receive():
+                    time.sleep(IDLE_WAKEUP)
+                    continue
+                # Port was opened, board resets and bootloader swallows whatever comes meanwhile
+                self.connected = True
+                self.reset()
+                self.wait(time.monotonic() + self.boot_time)
+                self.incoming.clear()
+                self.rx_buffer.clear()
+                continue
+            self.loop()
+            if not self.receive():
+                self.connected = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+
+
+def start_simulators(panels, curves, conversion_time=CONVERSION_TIME, boot_time=BOOT_TIME):
+    # curves: {panel_number: TemperatureCurve}. Returns started VirtualArduinos
+    arduinos = [VirtualArduino(panel_number, curves[panel_number], conversion_time, boot_time)
+                for panel_number in panels]
+    for arduino in arduinos:
+        arduino.start()
+    return arduinos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Virtual Arduinos of Arduino.ino on pseudo-terminals. Start the PI "
+                                                 "script with the printed --ports")
+    parser.add_argument("--panels", type=int, default=3, help="Number of virtual Arduinos, numbered from 1")
+    parser.add_argument("--temperature", choices=TEMPERATURE_CURVES, default="pwm",
+                        help="Temperature curve of all panels")
+    parser.add_argument("--panel-temperature", action="append", default=[], metavar="PANEL=CURVE",
+                        help="Temperature curve of one panel, can be repeated")
+    parser.add_argument("--ambient", type=float, default=22.0, help="Ambient temperature in C")
+    parser.add_argument("--heating", type=float, default=0.5,
+                        help="pwm curve: degrees above ambient per percent of mean PWM")
+    parser.add_argument("--time-constant", type=float, default=120.0, help="pwm curve: seconds to 63%% of change")
+    parser.add_argument("--amplitude", type=float, default=30.0, help="sine curve: degrees around ambient")
+    parser.add_argument("--period", type=float, default=600.0, help="sine curve: seconds")
+    parser.add_argument("--conversion-time", type=float, default=CONVERSION_TIME,
+                        help="Seconds requestTemperatures blocks the sketch")
+    parser.add_argument("--boot-time", type=float, default=BOOT_TIME,
+                        help="Seconds board ignores input after port is opened")
+    args = parser.parse_args()
+
+    panel_curves = {panel_number: args.temperature for panel_number in range(1, args.panels + 1)}
+    for override in args.panel_temperature:
+        panel_number, _, curve = override.partition("=")
+        if curve not in TEMPERATURE_CURVES or to_int(panel_number) not in panel_curves:
+            parser.error(f"bad --panel-temperature {override}")
+        panel_curves[to_int(panel_number)] = curve
+
+    curves = {panel_number: TemperatureCurve(curve, args.ambient, args.heating, args.time_constant, args.amplitude,
+                                             args.period)
+              for panel_number, curve in panel_curves.items()}
+    arduinos = start_simulators(sorted(curves), curves, args.conversion_time, args.boot_time)
+    for arduino in arduinos:
+        print(f"Arduino {arduino.arduino_num} on {arduino.device}")
+    print("--ports " + " ".join(arduino.device for arduino in arduinos), flush=True)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        while not stop.wait(1.0):
+            pass
+    except KeyboardInterrupt:
+        pass
+    for arduino in arduinos:
+        arduino.stop()
@@ -0,0 +1,148 @@
+import asyncio
+import signal
+from transport import MQTT_ERR_SUCCESS
+
+# Seconds between paho housekeeping calls (keepalive pings, retries) and between reconnect attempts
+MQTT_MISC_INTERVAL = 1.0
+MQTT_RECONNECT_DELAY = 5.0
+
+
+class AsyncRuntime:
+    # Runs MQTT client, serial readers, heartbeat and workers (schedule engine, telemetry streamer, fade engine...) as
+    # tasks on one asyncio event loop instead of threads. Everything (MQTT callbacks, serial frames, schedule
+    # transitions) is called from the loop thread. Workers are worker.Worker, their poll() is called from the loop
+    def __init__(self, client, serial_mux, heartbeat, heartbeat_interval, workers=()):
+        self.client = client
+        self.serial_mux = serial_mux
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.workers = list(workers)
+
+        self.loop = None
+        self.tasks = []
+        self.drain_handle = None
+        self.stopping = None
+
+    def run(self, host, port, topics):
+        asyncio.run(self.main(host, port, topics))
+
+    async def main(self, host, port, topics):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+
+        # Single place for shutdown
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, self.stopping.set)
+
+        self.tasks = [
+            self.loop.create_task(self.mqtt_task(host, port, topics)),
+            self.loop.create_task(self.serial_task()),
+            self.loop.create_task(self.heartbeat_task()),
+        ]
+        self.tasks += [self.loop.create_task(self.worker_task(worker)) for worker in self.workers]
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.client.disconnect()
+        for device in self.serial_mux.get_devices():
+            self.serial_mux.remove_port(device)
+        self.serial_mux.apply_pending()
+
+    def stop(self):
+        # Can be called from any thread
+        self.loop.call_soon_threadsafe(self.stopping.set)
+
+    # MQTT ----------------------------------------------------------------
+    # paho is driven by the event loop through its socket callbacks instead of loop_forever, loopback client through
+    # on_message_queued
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def mqtt_task(self, host, port, topics):
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+        # Loopback transport has no socket, it tells when messages wait instead
+        self.client.on_message_queued = lambda: self.loop.call_soon_threadsafe(self.client.loop, 0)
+
+        def on_connect(client, userdata, flags, rc):
+            # Subscribe on every connect so subscriptions survive reconnects
+            for topic in topics:
+                client.subscribe(topic)
+        self.client.on_connect = on_connect
+
+        connected = False
+        while True:
+            try:
+                if not connected:
+                    self.client.connect(host, port, 20)
+                    connected = True
+                elif self.client.loop_misc() != MQTT_ERR_SUCCESS:
+                    self.client.reconnect()
+            except OSError as e:
+                print(f"MQTT connection failed: {e}. Retrying in {MQTT_RECONNECT_DELAY} seconds")
+                await asyncio.sleep(MQTT_RECONNECT_DELAY)
+                continue
+            await asyncio.sleep(MQTT_MISC_INTERVAL)
+
+    # Serial --------------------------------------------------------------
+
+    async def serial_task(self):
+        # Multiplexer selector is readable when any serial port (or its wakeup pipe) is, so loop watches just that
+        fd = self.serial_mux.fileno()
+        self.loop.add_reader(fd, self.poll_serial)
+        try:
+            # Ports added (and messages queued) before loop started are handled here
+            self.poll_serial()
+            await asyncio.Future()
+        finally:
+            self.loop.remove_reader(fd)
+            if self.drain_handle is not None:
+                self.drain_handle.cancel()
+
+    def poll_serial(self):
+        # Queued messages that could not be written yet are retried once port's output buffer should have room
+        if self.drain_handle is not None:
+            self.drain_handle.cancel()
+            self.drain_handle = None
+        timeout = self.serial_mux.poll(0)
+        if timeout is not None:
+            self.drain_handle = self.loop.call_later(timeout, self.poll_serial)
+
+    # Heartbeat -----------------------------------------------------------
+
+    async def heartbeat_task(self):
+        while True:
+            self.heartbeat()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    # Workers -------------------------------------------------------------
+
+    async def worker_task(self, worker):
+        changed = asyncio.Event()
+        worker.on_change = lambda: self.loop.call_soon_threadsafe(changed.set)
+        while True:
+            changed.clear()
+            # Timeout is None while worker is idle, task then sleeps until worker is given something to do
+            timeout = worker.poll()
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
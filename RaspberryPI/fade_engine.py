@@ -0,0 +1,155 @@
+import time
+from array import array
+from serial_mux import ARDUINO_LOOP_TIME
+from worker import Worker
+
+# Fades are stepped this often (seconds). Only steps that change the integer PWM value are sent
+FADE_TICK = 0.5
+# Serial multiplexer hands Arduino one message per loop (see serial_mux). So a panel gets its next step only after it
+# answered the previous one and every port gets at most MESSAGES_PER_TICK steps per tick, which leaves room in the
+# port's turns for status requests and manual commands. Step whose answer never came is given up after STEP_TIMEOUT
+MESSAGES_PER_TICK = 1
+STEP_TIMEOUT = 4 * ARDUINO_LOOP_TIME
+
+CHANNEL_COUNT = 4
+
+
+class FadeEngine(Worker):
+    # Moves panels from their current PWM values to target values over given time. All running fades are interpolated
+    # together once per tick over flat arrays (4 channels per panel). A panel gets a set message only when its rounded
+    # values changed and it answered the last one, every port gets at most MESSAGES_PER_TICK of them. Panels left out
+    # catch up next tick, fade simply gets coarser steps
+    def __init__(self, write, port_of):
+        # write(panel_number, values) sends values to panel, port_of(panel_number) returns its device or None
+        super().__init__()
+        self.write = write
+        self.port_of = port_of
+
+        self.panels = []
+        self.begin = array("d")
+        self.delta = array("d")
+        self.started = array("d")
+        self.duration = array("d")
+        self.sent = array("h")
+        # Last values written to every panel, fades start from here
+        self.current = {}
+        # panel -> time its last fade step was written, until panel's status line is read
+        self.in_flight = {}
+        self.next_tick = 0.0
+
+    def fade(self, panel_number, target, duration, start_values=None):
+        # start_values are used only if engine never wrote to this panel
+        target = [int(value) for value in target]
+        with self.condition:
+            self.remove_row(panel_number)
+            begin = self.current.get(panel_number, start_values)
+            if duration <= 0 or begin is None:
+                self.write_values(panel_number, target)
+                return
+            self.panels.append(panel_number)
+            self.begin.extend(float(value) for value in begin)
+            self.delta.extend(float(new - old) for old, new in zip(begin, target))
+            self.started.append(time.monotonic())
+            self.duration.append(float(duration))
+            self.sent.extend(int(value) for value in begin)
+            if len(self.panels) == 1:
+                self.next_tick = time.monotonic()
+        self.wake()
+
+    def cancel(self, panel_number, values=None):
+        # Stop fade of panel, values are what was written to it instead (manual set, scene...)
+        with self.condition:
+            self.remove_row(panel_number)
+            if values is not None:
+                self.current[panel_number] = [int(value) for value in values]
+
+    def on_reply(self, panel_number):
+        # Called for every status line of panel. Arduino finished a loop, so it has room for next step
+        with self.condition:
+            self.in_flight.pop(panel_number, None)
+
+    def is_fading(self, panel_number):
+        with self.condition:
+            return panel_number in self.panels
+
+    def fading_count(self):
+        with self.condition:
+            return len(self.panels)
+
+    def remove_row(self, panel_number):
+        # Caller must hold the condition
+        if panel_number not in self.panels:
+            return
+        self.keep_rows([row for row, panel in enumerate(self.panels) if panel != panel_number])
+
+    def keep_rows(self, rows):
+        # Rebuild arrays with given rows only. Caller must hold the condition
+        def pick(values, width):
+            return array(values.typecode, [values[row * width + i] for row in rows for i in range(width)])
+        self.begin = pick(self.begin, CHANNEL_COUNT)
+        self.delta = pick(self.delta, CHANNEL_COUNT)
+        self.sent = pick(self.sent, CHANNEL_COUNT)
+        self.started = pick(self.started, 1)
+        self.duration = pick(self.duration, 1)
+        self.panels = [self.panels[row] for row in rows]
+
+    def write_values(self, panel_number, values):
+        # Caller must hold the condition
+        self.current[panel_number] = list(values)
+        self.write(panel_number, values)
+
+    def step(self, now):
+        # One tick of all fades. Caller must hold the condition
+        fractions = [min(max((now - started) / duration, 0.0), 1.0)
+                     for started, duration in zip(self.started, self.duration)]
+        values = [int(begin + delta * fractions[i // CHANNEL_COUNT] + 0.5)
+                  for i, (begin, delta) in enumerate(zip(self.begin, self.delta))]
+
+        # Panels whose rounded values moved, biggest jump first so a busy port serves the most visible change
+        changed = []
+        for row in range(len(self.panels)):
+            first = row * CHANNEL_COUNT
+            distance = sum(abs(values[first + i] - self.sent[first + i]) for i in range(CHANNEL_COUNT))
+            if distance:
+                changed.append((distance, row))
+        changed.sort(reverse=True)
+
+        budget = {}
+        for _, row in changed:
+            panel_number = self.panels[row]
+            written = self.in_flight.get(panel_number)
+            if written is not None and now - written < STEP_TIMEOUT:
+                continue
+            port = self.port_of(panel_number)
+            if budget.get(port, 0) >= MESSAGES_PER_TICK:
+                continue
+            budget[port] = budget.get(port, 0) + 1
+            first = row * CHANNEL_COUNT
+            self.sent[first:first + CHANNEL_COUNT] = array("h", values[first:first + CHANNEL_COUNT])
+            self.write_values(panel_number, values[first:first + CHANNEL_COUNT])
+            self.in_flight[panel_number] = now
+
+        # Fade is done once its end values were sent
+        finished = [row for row, fraction in enumerate(fractions)
+                    if fraction >= 1.0 and
+                    all(values[row * CHANNEL_COUNT + i] == self.sent[row * CHANNEL_COUNT + i]
+                        for i in range(CHANNEL_COUNT))]
+        if finished:
+            self.keep_rows([row for row in range(len(self.panels)) if row not in finished])
+
+    def poll(self):
+        # Steps fades if tick is due. Returns seconds until next tick or None if nothing is fading
+        with self.condition:
+            if not self.panels:
+                return None
+            now = time.monotonic()
+            if now >= self.next_tick:
+                self.next_tick = max(self.next_tick + FADE_TICK, now)
+                self.step(now)
+        return self.next_timeout()
+
+    def next_timeout(self):
+        with self.condition:
+            if not self.panels:
+                return None
+            return max(self.next_tick - time.monotonic(), 0.0)
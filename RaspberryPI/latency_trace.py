@@ -0,0 +1,51 @@
+import collections
+import threading
+import time
+
+# Commands written to one panel that still wait for its status line. Arduino reads one message per loop, so more than
+# this can't be pending unless replies got lost, oldest ones are dropped then
+MAX_IN_FLIGHT = 8
+
+
+class CommandTracer:
+    # Follows every command written to an Arduino until its status line is read. Arduino answers each set or get for
+    # its panel with exactly one status line, in order, so written commands are a queue per panel and a status line
+    # belongs to the oldest one. Gives serial reply latency of every command and, for PC commands that carry sequence
+    # number and receive time, how long every hop on PI took
+    def __init__(self, timeout):
+        # Command whose reply did not come for this long is forgotten (reply lost, board unplugged...)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Write queue key -> (panel, sequence, received, queued) of message waiting in serial multiplexer's queue.
+        # Newer message with same key replaces queued one there, so it replaces its entry here as well
+        self.queued = {}
+        # panel -> (sequence, received, queued, written) of commands written to Arduino, oldest first
+        self.in_flight = {}
+
+    def on_queued(self, key, panel_number, sequence=None, received=None):
+        with self.lock:
+            self.queued[key] = (panel_number, sequence, received, time.monotonic())
+
+    def on_written(self, device, key, written):
+        # Called by serial multiplexer when message was handed to port's driver. Message sent to all ports is written
+        # several times, only first write is followed (only one Arduino answers it)
+        with self.lock:
+            entry = self.queued.pop(key, None)
+            if entry is None:
+                return
+            panel_number, sequence, received, queued = entry
+            in_flight = self.in_flight.get(panel_number)
+            if in_flight is None:
+                in_flight = self.in_flight[panel_number] = collections.deque(maxlen=MAX_IN_FLIGHT)
+            in_flight.append((sequence, received, queued, written))
+
+    def on_reply(self, panel_number, replied):
+        # Returns (sequence, received, queued, written) of command answered by this status line or None. Sequence and
+        # received are None for commands that were not traced
+        with self.lock:
+            in_flight = self.in_flight.get(panel_number)
+            while in_flight:
+                entry = in_flight.popleft()
+                if replied - entry[3] <= self.timeout:
+                    return entry
+            return None
@@ -0,0 +1,230 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from worker import Worker
+
+# Upper bounds of histogram buckets in seconds, from serial round trips (tens of ms) to badly late schedule events
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Content type of Prometheus text format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    # Values of one metric by label values. All metrics of a registry share its lock
+    def __init__(self, name, help_text, metric_type, labels, lock):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labels = tuple(labels)
+        self.lock = lock
+        self.values = {}
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def samples(self):
+        # Yields (name suffix, label values, extra labels, value). Caller must hold the lock
+        for label_values, value in sorted(self.values.items(), key=lambda item: [str(v) for v in item[0]]):
+            yield "", label_values, (), value
+
+    def snapshot(self):
+        # Caller must hold the lock
+        if not self.labels:
+            return self.values.get((), 0)
+        return {",".join(str(value) for value in label_values): value for label_values, value in self.values.items()}
+
+
+class Counter(Metric):
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    pass
+
+
+class Histogram(Metric):
+    # Values are [bucket counts..., count, sum] per label values
+    def __init__(self, name, help_text, labels, lock, buckets):
+        super().__init__(name, help_text, "histogram", labels, lock)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def samples(self):
+        for label_values, counts in sorted(self.values.items(), key=lambda item: [str(v) for v in item[0]]):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", label_values, (("le", format_value(float(bound))),), cumulative
+            yield "_bucket", label_values, (("le", "+Inf"),), counts[-2]
+            yield "_count", label_values, (), counts[-2]
+            yield "_sum", label_values, (), counts[-1]
+
+    def snapshot(self):
+        def summary(counts):
+            return {"count": counts[-2], "sum": round(counts[-1], 6)}
+        if not self.labels:
+            counts = self.values.get(())
+            return summary(counts) if counts is not None else {"count": 0, "sum": 0}
+        return {",".join(str(value) for value in label_values): summary(counts)
+                for label_values, counts in self.values.items()}
+
+
+class MetricsRegistry:
+    # Counters, gauges and histograms of the PI script. Values that already live elsewhere (queue depths, serial
+    # byte counts, memory) are read by collectors right before metrics are rendered instead of being updated
+    # on every change
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.metrics = {}
+        self.collectors = []
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.add(Counter(name, help_text, "counter", labels, self.lock))
+
+    def gauge(self, name, help_text, labels=()):
+        return self.add(Gauge(name, help_text, "gauge", labels, self.lock))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help_text, labels, self.lock, buckets))
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def collect(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+    def render(self):
+        # Prometheus text exposition format
+        self.collect()
+        lines = []
+        with self.lock:
+            for metric in self.metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+                for suffix, label_values, extra, value in metric.samples():
+                    lines.append(f"{metric.name}{suffix}{format_labels(metric.labels, label_values, extra)} "
+                                 f"{format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        # Compact form for MQTT: {name: value or {labels: value}}, histograms as count and sum
+        self.collect()
+        with self.lock:
+            return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+class MetricsServer:
+    # Serves registry on http://host:port/metrics from a daemon thread
+    def __init__(self, registry, host, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would flood the log
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsPublisher(Worker):
+    # Publishes registry snapshot as JSON every interval seconds
+    def __init__(self, registry, publish, interval):
+        super().__init__()
+        self.registry = registry
+        self.publish = publish
+        self.interval = interval
+        self.next_publish = time.monotonic() + interval
+
+    def poll(self):
+        # Publishes if due. Returns seconds until next publish or None if publishing is off
+        with self.condition:
+            if self.interval <= 0:
+                return None
+            now = time.monotonic()
+            due = now >= self.next_publish
+            if due:
+                self.next_publish = max(self.next_publish + self.interval, now)
+        if due:
+            self.publish(json.dumps(self.registry.snapshot(), separators=(",", ":")))
+        return self.next_timeout()
+
+    def next_timeout(self):
+        with self.condition:
+            if self.interval <= 0:
+                return None
+            return max(self.next_publish - time.monotonic(), 0.0)
+
+
+def process_memory():
+    # (RSS, peak RSS) of this process in bytes
+    memory = {}
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    memory[name] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory.get("VmRSS", 0), memory.get("VmHWM", 0)
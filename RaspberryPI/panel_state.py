@@ -0,0 +1,49 @@
+import threading
+import time
+
+# How long we wait for Arduino to answer a refresh before asking again
+REFRESH_TIMEOUT = 2.0
+
+
+class PanelStateCache:
+    # Last known PWM values and temperatures of every panel, filled from status lines sent by Arduinos. Status requests
+    # are answered from here; hardware is only asked again when the entry is older than max_age
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.states = {}
+        self.refresh_requested = {}
+
+    def update(self, panel_number, values):
+        # values: [fir, nir, vis, uv, temp1, temp2, temp3]
+        with self.lock:
+            self.states[panel_number] = (list(values), time.monotonic())
+            self.refresh_requested.pop(panel_number, None)
+
+    def get(self, panel_number):
+        # Returns (values, age in seconds) or None if panel never reported
+        with self.lock:
+            state = self.states.get(panel_number)
+        if state is None:
+            return None
+        values, updated = state
+        return values, time.monotonic() - updated
+
+    def get_all(self):
+        with self.lock:
+            panel_numbers = list(self.states)
+        return {panel_number: self.get(panel_number) for panel_number in panel_numbers}
+
+    def needs_refresh(self, panel_number):
+        # True if entry is missing or too old and no refresh is already on its way. Marks refresh as requested so
+        # several operators polling at once cause only one serial round trip
+        now = time.monotonic()
+        with self.lock:
+            state = self.states.get(panel_number)
+            if state is not None and now - state[1] <= self.max_age:
+                return False
+            requested = self.refresh_requested.get(panel_number)
+            if requested is not None and now - requested < REFRESH_TIMEOUT:
+                return False
+            self.refresh_requested[panel_number] = now
+            return True
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+
+
+def port_identity(port_info):
+    # Identity of a serial port that survives reboots. USB serial number is unique per board, clones often have none so
+    # we fall back to physical USB location (same socket on the hub)
+    if port_info.vid is not None:
+        usb_id = f"{port_info.vid:04X}:{port_info.pid:04X}"
+        if port_info.serial_number:
+            return f"{usb_id}:{port_info.serial_number}"
+        if port_info.location:
+            return f"{usb_id}@{port_info.location}"
+    return port_info.device
+
+
+class PortMap:
+    # Which serial port drives which panel. Learned from status replies (first field is ARDUINO_NUM) and cached on disk
+    # by port identity so commands can be sent to one port right after start. Path None keeps map in memory only
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.panels_by_identity = self.load()
+        self.identities = {}
+        self.devices_by_panel = {}
+
+    def load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as file:
+                return {identity: int(panel) for identity, panel in json.load(file).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def save(self):
+        if self.path is None:
+            return
+        # Write to temporary file first so power loss never leaves half written map
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "w") as file:
+                json.dump(self.panels_by_identity, file)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"Could not save port map: {e}")
+
+    def add_device(self, device, identity):
+        # Returns cached panel number of this port or None if it is not known yet
+        with self.lock:
+            self.identities[device] = identity
+            panel_number = self.panels_by_identity.get(identity)
+            if panel_number is not None:
+                self.devices_by_panel[panel_number] = device
+            return panel_number
+
+    def remove_device(self, device):
+        with self.lock:
+            self.identities.pop(device, None)
+            for panel_number, mapped_device in list(self.devices_by_panel.items()):
+                if mapped_device == device:
+                    del self.devices_by_panel[panel_number]
+
+    def learn(self, device, panel_number):
+        with self.lock:
+            identity = self.identities.get(device, device)
+            if self.devices_by_panel.get(panel_number) == device and \
+                    self.panels_by_identity.get(identity) == panel_number:
+                return
+            # Board was moved or reflashed, forget old entries for this port and this panel
+            for mapped_panel, mapped_device in list(self.devices_by_panel.items()):
+                if mapped_device == device:
+                    del self.devices_by_panel[mapped_panel]
+            for mapped_identity, mapped_panel in list(self.panels_by_identity.items()):
+                if mapped_panel == panel_number:
+                    del self.panels_by_identity[mapped_identity]
+            self.devices_by_panel[panel_number] = device
+            self.panels_by_identity[identity] = panel_number
+            self.save()
+
+    def lookup(self, panel_number):
+        # Device driving given panel or None if not known
+        with self.lock:
+            return self.devices_by_panel.get(panel_number)
+
+    def panels(self):
+        # Panels whose port is known
+        with self.lock:
+            return sorted(self.devices_by_panel)
+
+    def panel_of(self, device):
+        with self.lock:
+            for panel_number, mapped_device in self.devices_by_panel.items():
+                if mapped_device == device:
+                    return panel_number
+            return None
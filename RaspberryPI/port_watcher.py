@@ -0,0 +1,58 @@
+import time
+from worker import Worker
+
+# Serial ports are listed this often to notice Arduinos being plugged in or unplugged (seconds). Listing reads a few
+# sysfs files, so this is cheap enough to run forever
+PORT_POLL_INTERVAL = 2.0
+
+
+class PortWatcher(Worker):
+    # Lists serial ports every interval seconds and reports ports that appeared (on_added(device, identity)) or went
+    # away (on_removed(device)). Port that got a different board under the same name is reported as removed and added
+    def __init__(self, list_ports, on_added, on_removed, interval=PORT_POLL_INTERVAL):
+        super().__init__()
+        self.list_ports = list_ports
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.interval = interval
+
+        # {device: identity} as of last scan
+        self.known = {}
+        self.next_scan = 0.0
+
+    def scan(self):
+        # Returns ({device: identity} added, [device] removed) since last scan without calling callbacks
+        try:
+            ports = self.list_ports()
+        except OSError as e:
+            print(f"Could not list serial ports: {e}")
+            return {}, []
+        with self.condition:
+            removed = [device for device, identity in self.known.items() if ports.get(device) != identity]
+            added = {device: identity for device, identity in ports.items() if self.known.get(device) != identity}
+            self.known = dict(ports)
+        return added, removed
+
+    def forget(self, device):
+        # Port that failed to open or was lost while still listed is reported as added again on next scan
+        with self.condition:
+            self.known.pop(device, None)
+
+    def poll(self):
+        # Scans ports if due. Returns seconds until next scan
+        with self.condition:
+            now = time.monotonic()
+            due = now >= self.next_scan
+            if due:
+                self.next_scan = now + self.interval
+        if due:
+            added, removed = self.scan()
+            for device in removed:
+                self.on_removed(device)
+            for device, identity in added.items():
+                self.on_added(device, identity)
+        return self.next_timeout()
+
+    def next_timeout(self):
+        with self.condition:
+            return max(self.next_scan - time.monotonic(), 0.0)
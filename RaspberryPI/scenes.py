@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+
+# Scene: list of (panel, fir, nir, vis, uv) entries applied at once
+MAX_SCENE_NAME_LENGTH = 32
+
+
+def parse_entries(entries):
+    # Checks values and removes duplicate panels (last one wins). Raises ValueError on invalid entry
+    parsed = {}
+    for entry in entries:
+        panel_number, fir, nir, vis, uv = (int(value) for value in entry)
+        if panel_number < 1 or not all(0 <= value <= 100 for value in (fir, nir, vis, uv)):
+            raise ValueError(f"Invalid scene entry: {entry}")
+        parsed[panel_number] = (panel_number, fir, nir, vis, uv)
+    return [parsed[panel_number] for panel_number in sorted(parsed)]
+
+
+class SceneStore:
+    # Named scenes kept on PI so PC can recall them with one short message. Saved to disk on every change
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.scenes = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                return {name: parse_entries(entries) for name, entries in json.load(file).items()}
+        except (OSError, ValueError, AttributeError, TypeError):
+            return {}
+
+    def write(self):
+        # Write to temporary file first so power loss never leaves half written file. Caller must hold the lock
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "w") as file:
+                json.dump(self.scenes, file)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            print(f"Could not save scenes: {e}")
+
+    def save(self, name, entries):
+        if not name or len(name) > MAX_SCENE_NAME_LENGTH or "," in name:
+            raise ValueError(f"Invalid scene name: {name}")
+        parsed = parse_entries(entries)
+        with self.lock:
+            self.scenes[name] = parsed
+            self.write()
+        return parsed
+
+    def get(self, name):
+        with self.lock:
+            return self.scenes.get(name)
+
+    def delete(self, name):
+        with self.lock:
+            if self.scenes.pop(name, None) is None:
+                return False
+            self.write()
+            return True
+
+    def names(self):
+        with self.lock:
+            return sorted(self.scenes)
@@ -0,0 +1,249 @@
+import heapq
+import itertools
+import time
+from interval_index import IntervalIndex
+from worker import Worker
+
+# Slots are given in minutes of the day, both ends inclusive (same as the GUI scheduler)
+MINUTES_PER_DAY = 24 * 60
+SECONDS_PER_DAY = MINUTES_PER_DAY * 60
+
+# Event kinds. Stops sort before starts so that back to back slots hand over cleanly
+STOP_EVENT = 0
+START_EVENT = 1
+
+# Deadlines are kept on the monotonic clock. PI has no RTC and wall clock may jump when NTP syncs after boot, so we
+# never sleep longer than this and re-anchor all events if the wall clock moved
+RESYNC_INTERVAL = 300.0
+CLOCK_JUMP_TOLERANCE = 1.0
+
+OFF_VALUES = (0, 0, 0, 0)
+
+# Results of versioned schedule updates
+SCHEDULE_OK = 0
+SCHEDULE_STALE = 1
+SCHEDULE_INVALID = 2
+
+
+def parse_slot(slot):
+    # Slot is [start, stop, fir, nir, vis, uv] or [start, stop, fir, nir, vis, uv, ramp in, ramp out] as strings or
+    # ints, ramps in seconds. Convert only once when schedule is received. Values of parsed slot are
+    # (fir, nir, vis, uv, ramp in, ramp out)
+    start_minutes = int(slot[0])
+    stop_minutes = int(slot[1])
+    values = tuple(int(value) for value in slot[2:8])
+    if len(values) == 4:
+        values += (0, 0)
+    # Interval index keeps minutes as unsigned shorts, anything outside of the day must not get that far
+    if len(values) != 6 or not 0 <= start_minutes < stop_minutes < MINUTES_PER_DAY:
+        raise ValueError(f"Invalid slot: {slot}")
+    # Ramps must fit in slot and panel must be on for a moment at least, otherwise stop would come before start
+    ramp_in, ramp_out = values[4:]
+    if ramp_in < 0 or ramp_out < 0 or ramp_in + ramp_out > (stop_minutes + 1 - start_minutes) * 60 or \
+            ramp_out == (stop_minutes + 1 - start_minutes) * 60:
+        raise ValueError(f"Ramps don't fit in slot: {slot}")
+    return start_minutes, stop_minutes, values
+
+
+def seconds_since_midnight(wall_time):
+    local = time.localtime(wall_time)
+    return local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec + (wall_time % 1)
+
+
+class ScheduleEngine(Worker):
+    def __init__(self, on_transition):
+        # on_transition(panel_number, (fir, nir, vis, uv), ramp) is called from whoever polls engine on every slot
+        # boundary. Ramp is number of seconds panel should take to reach values, slot's ramp out starts before its stop
+        super().__init__()
+        self.on_transition = on_transition
+
+        self.events = []
+        self.slots = {}
+        self.versions = {}
+        self.active_slot = {}
+        self.counter = itertools.count()
+        # Optional callback on_slot_done(panel_number, slot) when a slot has finished and was dropped
+        self.on_slot_done = None
+        # Optional callback on_lag(seconds) with how late every event fired (metrics)
+        self.on_lag = None
+        self.done_slots = []
+        self.lags = []
+
+        self.wall_offset = time.time() - time.monotonic()
+
+    def set_schedule(self, panel_number, slots, version=None):
+        # Replace whole schedule of a panel. Slots are parsed and checked for overlaps before anything is touched so
+        # invalid schedule leaves the old one running. Version is only given when restoring saved schedule.
+        # Returns new schedule version
+        parsed = IntervalIndex(parse_slot(slot) for slot in slots)
+        with self.condition:
+            self.slots[panel_number] = parsed
+            self.active_slot.pop(panel_number, None)
+            self.events = [event for event in self.events if event[3] != panel_number]
+            self.push_panel_events(panel_number, parsed, time.time(), time.monotonic())
+            heapq.heapify(self.events)
+            if version is None:
+                version = self.versions.get(panel_number, 0) + 1
+            self.versions[panel_number] = version
+        self.wake()
+        return version
+
+    def clear_schedule(self, panel_number):
+        return self.set_schedule(panel_number, [])
+
+    def get_version(self, panel_number):
+        with self.condition:
+            return self.versions.get(panel_number, 0)
+
+    def update_schedule(self, panel_number, base_version, remove_start=None, slot=None):
+        # Apply one change in place: add slot (remove_start None), remove slot starting at remove_start (slot None) or
+        # replace one with another (both). Change must be made against current version, otherwise it is rejected and
+        # sender should upload whole schedule again. Returns (result, version)
+        try:
+            parsed = parse_slot(slot) if slot is not None else None
+        except (ValueError, TypeError, IndexError):
+            return SCHEDULE_INVALID, self.get_version(panel_number)
+
+        with self.condition:
+            version = self.versions.get(panel_number, 0)
+            if base_version != version:
+                return SCHEDULE_STALE, version
+            index = self.slots.setdefault(panel_number, IntervalIndex())
+
+            # Slot may already be gone because it fired, removing it again is not an error
+            removed = None
+            if remove_start is not None:
+                removed = index.remove(remove_start)
+            if parsed is not None:
+                try:
+                    index.insert(*parsed)
+                except (ValueError, OverflowError):
+                    # Put back what was removed so failed replace changes nothing
+                    if removed is not None:
+                        index.insert(*removed)
+                    return SCHEDULE_INVALID, version
+
+            # Only events of touched slots are rebuilt, rest of the schedule keeps running
+            if removed is not None:
+                self.events = [event for event in self.events
+                               if not (event[3] == panel_number and event[4][0] == removed[0])]
+                if self.active_slot.get(panel_number) == removed:
+                    del self.active_slot[panel_number]
+            if parsed is not None:
+                wall_now = time.time()
+                now_seconds = seconds_since_midnight(wall_now)
+                active = index.active_at(int(now_seconds // 60))
+                self.push_slot_events(panel_number, parsed, parsed == active, now_seconds, time.monotonic())
+            heapq.heapify(self.events)
+
+            version = self.versions[panel_number] = version + 1
+        self.wake()
+        return SCHEDULE_OK, version
+
+    def get_schedule(self, panel_number):
+        with self.condition:
+            return list(self.slots.get(panel_number, []))
+
+    def active_values(self, panel_number):
+        # Values of slot active right now or None
+        with self.condition:
+            index = self.slots.get(panel_number)
+            if index is None:
+                return None
+            slot = index.active_at(int(seconds_since_midnight(time.time()) // 60))
+            return slot[2][:4] if slot else None
+
+    def push_panel_events(self, panel_number, parsed_slots, wall_now, monotonic_now):
+        # Each slot fires once: start at its next occurrence (immediately if we are inside it) and stop after its
+        # last minute. Caller must hold the condition
+        now_seconds = seconds_since_midnight(wall_now)
+        active = parsed_slots.active_at(int(now_seconds // 60))
+        for slot in parsed_slots:
+            self.push_slot_events(panel_number, slot, slot == active, now_seconds, monotonic_now)
+
+    def push_slot_events(self, panel_number, slot, is_active, now_seconds, monotonic_now):
+        # Caller must hold the condition and heapify events afterwards. Stop event comes ramp out seconds before end of
+        # slot so panel is off when slot ends
+        start_minutes, stop_minutes, values = slot
+        ramp_in, ramp_out = values[4:]
+        start_delay = start_minutes * 60 - now_seconds
+        if not is_active and start_delay < 0:
+            # Window already passed today, wait for tomorrow
+            start_delay += SECONDS_PER_DAY
+        stop_delay = start_delay + (stop_minutes + 1 - start_minutes) * 60 - ramp_out
+
+        if is_active:
+            # Joined slot late (restart, new schedule), part of ramps that already passed is skipped
+            ramp_in = max(ramp_in + start_delay, 0.0)
+            start_delay = 0.0
+            if stop_delay <= 0:
+                # Already in ramp out, only fade out what is left. Stop sorts before start, so no start event
+                self.active_slot[panel_number] = slot
+                self.events.append((monotonic_now, STOP_EVENT, next(self.counter), panel_number, slot,
+                                    max(ramp_out + stop_delay, 0.0)))
+                return
+
+        start_deadline = monotonic_now + start_delay
+        stop_deadline = monotonic_now + stop_delay
+        self.events.append((start_deadline, START_EVENT, next(self.counter), panel_number, slot, ramp_in))
+        self.events.append((stop_deadline, STOP_EVENT, next(self.counter), panel_number, slot, ramp_out))
+
+    def resync(self, wall_now, monotonic_now):
+        # Wall clock jumped, recompute every deadline from remaining slots. Caller must hold the condition
+        self.events = []
+        for panel_number, parsed_slots in self.slots.items():
+            self.push_panel_events(panel_number, parsed_slots, wall_now, monotonic_now)
+        heapq.heapify(self.events)
+
+    def pop_due_events(self):
+        # Caller must hold the condition
+        due = []
+        now = time.monotonic()
+        while self.events and self.events[0][0] <= now:
+            deadline, kind, _, panel_number, slot, ramp = heapq.heappop(self.events)
+            self.lags.append(now - deadline)
+            if kind == START_EVENT:
+                self.active_slot[panel_number] = slot
+                due.append((panel_number, slot[2][:4], ramp))
+            else:
+                # Slot is done, drop it so it does not fire again
+                panel_slots = self.slots.get(panel_number)
+                if panel_slots is not None and panel_slots.index_of(slot[0]) != -1:
+                    panel_slots.remove(slot[0])
+                    self.done_slots.append((panel_number, slot))
+                # Only turn panel off if no other slot took over in the meantime
+                if self.active_slot.get(panel_number) == slot:
+                    del self.active_slot[panel_number]
+                    due.append((panel_number, OFF_VALUES, ramp))
+        return due
+
+    def poll(self):
+        # Calls on_transition for every transition that is due now. Returns seconds until next event
+        with self.condition:
+            wall_offset = time.time() - time.monotonic()
+            if abs(wall_offset - self.wall_offset) > CLOCK_JUMP_TOLERANCE:
+                self.wall_offset = wall_offset
+                self.resync(time.time(), time.monotonic())
+            due = self.pop_due_events()
+            done_slots = self.done_slots
+            self.done_slots = []
+            lags = self.lags
+            self.lags = []
+        if self.on_slot_done is not None:
+            for panel_number, slot in done_slots:
+                self.on_slot_done(panel_number, slot)
+        if self.on_lag is not None:
+            for lag in lags:
+                self.on_lag(lag)
+        # Call outside of lock so schedule can be changed while serial write is in progress
+        for panel_number, values, ramp in due:
+            self.on_transition(panel_number, values, ramp)
+        return self.next_timeout()
+
+    def next_timeout(self):
+        # Seconds until next event, never longer than resync interval
+        with self.condition:
+            timeout = RESYNC_INTERVAL
+            if self.events:
+                timeout = min(timeout, self.events[0][0] - time.monotonic())
+            return max(timeout, 0.0)
@@ -0,0 +1,286 @@
+import collections
+import os
+import selectors
+import threading
+import time
+
+# Arduino terminates every message with println, so one line is one frame
+FRAME_END = b"\n"
+# Drop garbage if Arduino never sends a line end (wrong baud rate, noise...)
+MAX_BUFFER_SIZE = 4096
+
+# Baud rate is not what limits a port. Arduino reads one message per loop, every loop waits about 750 ms for
+# temperatures and its receive buffer holds 64 bytes. So a port is written one message at a time: the next one goes once
+# a line came back (Arduino read the message and answered) or after REPLY_WAIT, by when Arduino read it even if it was
+# for another panel and nothing came back. Messages wait in the queue meanwhile, where a newer one can still replace them
+ARDUINO_LOOP_TIME = 0.75
+REPLY_WAIT = ARDUINO_LOOP_TIME + 0.25
+# Normal messages queued per port. When full the oldest one is dropped, priority messages are never dropped
+MAX_QUEUE_LENGTH = 32
+
+
+class WriteQueue:
+    # Outgoing messages of one port. Message with a key replaces every queued message with same key (last writer
+    # wins), priority messages are sent before all normal ones
+    def __init__(self):
+        self.priority = collections.deque()
+        self.normal = collections.deque()
+
+    def __len__(self):
+        return len(self.priority) + len(self.normal)
+
+    def put(self, data, key, priority):
+        # Returns False if queue was full and oldest normal message was dropped
+        if key is not None:
+            for queue in (self.priority, self.normal):
+                kept = [entry for entry in queue if entry[0] != key]
+                if len(kept) != len(queue):
+                    queue.clear()
+                    queue.extend(kept)
+        if priority:
+            self.priority.append((key, data))
+            return True
+        self.normal.append((key, data))
+        if len(self.normal) > MAX_QUEUE_LENGTH:
+            self.normal.popleft()
+            return False
+        return True
+
+    def get(self):
+        # Returns (key, data) of next message
+        if self.priority:
+            return self.priority.popleft()
+        return self.normal.popleft()
+
+    def discard(self, kind):
+        # Drops queued messages whose key starts with kind, e.g. "probe" for all ("probe", panel) messages
+        for queue in (self.priority, self.normal):
+            kept = [entry for entry in queue if entry[0] is None or entry[0][0] != kind]
+            if len(kept) != len(queue):
+                queue.clear()
+                queue.extend(kept)
+
+
+class SerialMultiplexer:
+    # Watches all serial ports from one thread. Whatever bytes are available are read, split into complete lines and
+    # passed to on_frame(device, line). Ports can be added and removed from any thread while loop is running
+    def __init__(self, on_frame):
+        self.on_frame = on_frame
+        # Called with device from loop thread when port failed (unplugged) and was removed
+        self.on_port_lost = None
+        # Called with (device, key, time) from loop thread right after queued message was written to port
+        self.on_written = None
+
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.ports = {}
+        self.buffers = {}
+        self.queues = {}
+        # device -> time port may be written again, while Arduino has not taken last message yet
+        self.busy_until = {}
+        self.pending = []
+        # Totals per device for metrics, kept after port is removed
+        self.bytes_in = {}
+        self.bytes_out = {}
+        self.dropped = {}
+        self.running = False
+
+        # Self pipe so other threads can wake up select when ports change or loop should stop
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, None)
+
+    def add_port(self, device, serial_port):
+        # Serial port should be opened with timeout=0 so read never blocks the loop
+        with self.lock:
+            self.ports[device] = serial_port
+            self.queues[device] = WriteQueue()
+            self.pending.append(("add", device, serial_port))
+        self.wakeup()
+
+    def remove_port(self, device):
+        with self.lock:
+            serial_port = self.ports.pop(device, None)
+            if serial_port is None:
+                return
+            self.queues.pop(device, None)
+            self.busy_until.pop(device, None)
+            self.pending.append(("remove", device, serial_port))
+        self.wakeup()
+
+    def lose_port(self, device):
+        # Port is gone (unplugged)
+        self.remove_port(device)
+        if self.on_port_lost is not None:
+            self.on_port_lost(device)
+
+    def get_devices(self):
+        with self.lock:
+            return list(self.ports)
+
+    def write(self, device, data, key=None, priority=False):
+        # Queues data for given port, loop writes it. Returns False if port is not known. Key (e.g. ("set", panel))
+        # makes this message replace queued ones with same key, priority puts it in front of all normal messages
+        with self.lock:
+            queue = self.queues.get(device)
+            if queue is None:
+                return False
+            if not queue.put(data, key, priority):
+                self.dropped[device] = self.dropped.get(device, 0) + 1
+                print(f"Write queue of {device} is full, oldest message dropped")
+        self.wakeup()
+        return True
+
+    def write_all(self, data, key=None, priority=False):
+        for device in self.get_devices():
+            self.write(device, data, key, priority)
+
+    def discard(self, device, kind):
+        # Drops messages of given kind that were not written to port yet
+        with self.lock:
+            queue = self.queues.get(device)
+            if queue is not None:
+                queue.discard(kind)
+
+    def queued(self):
+        # Number of messages waiting per port
+        with self.lock:
+            return {device: len(queue) for device, queue in self.queues.items()}
+
+    def counters(self):
+        # {device: (bytes read, bytes written, messages dropped from full queue)} since start
+        with self.lock:
+            devices = set(self.bytes_in) | set(self.bytes_out) | set(self.dropped) | set(self.ports)
+            return {device: (self.bytes_in.get(device, 0), self.bytes_out.get(device, 0), self.dropped.get(device, 0))
+                    for device in devices}
+
+    def drain_queues(self):
+        # Writes next queued message to every port whose Arduino took the last one. Returns seconds until some port
+        # can take more or None if all queues are empty. Called from loop thread only
+        timeout = None
+        now = time.monotonic()
+        with self.lock:
+            ports = [(device, self.ports[device], queue) for device, queue in self.queues.items() if queue]
+        for device, serial_port, queue in ports:
+            with self.lock:
+                wait = self.busy_until.get(device, 0.0) - now
+                if wait > 0 or not queue:
+                    if queue:
+                        timeout = wait if timeout is None else min(timeout, wait)
+                    continue
+                key, data = queue.get()
+                self.busy_until[device] = now + REPLY_WAIT
+                if queue:
+                    timeout = REPLY_WAIT if timeout is None else min(timeout, REPLY_WAIT)
+            try:
+                serial_port.write(data)
+            except (OSError, ValueError):
+                self.lose_port(device)
+                continue
+            with self.lock:
+                self.bytes_out[device] = self.bytes_out.get(device, 0) + len(data)
+            if self.on_written is not None:
+                self.on_written(device, key, time.monotonic())
+        return timeout
+
+    def flush(self, timeout):
+        # Runs loop until every queue is handed to ports or timeout passed. Used before loop thread is started
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            drain_timeout = self.poll(0)
+            if drain_timeout is None or remaining <= 0:
+                return drain_timeout is None
+            self.poll(min(drain_timeout, remaining))
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write, b"x")
+        except BlockingIOError:
+            # Pipe is full, loop is going to wake up anyway
+            pass
+
+    def apply_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        for action, device, serial_port in pending:
+            if action == "add":
+                self.buffers[device] = bytearray()
+                self.selector.register(serial_port.fileno(), selectors.EVENT_READ, device)
+            else:
+                self.buffers.pop(device, None)
+                try:
+                    self.selector.unregister(serial_port.fileno())
+                except (KeyError, ValueError, OSError):
+                    pass
+                try:
+                    serial_port.close()
+                except (OSError, ValueError):
+                    pass
+
+    def read_port(self, device):
+        with self.lock:
+            serial_port = self.ports.get(device)
+        if serial_port is None:
+            return
+        try:
+            data = serial_port.read(max(serial_port.in_waiting, 1))
+        except (OSError, ValueError):
+            self.lose_port(device)
+            return
+        if not data:
+            return
+        with self.lock:
+            self.bytes_in[device] = self.bytes_in.get(device, 0) + len(data)
+            # Arduino answers only after it read a message, so port may take next one. Caller drains queues after reads
+            if FRAME_END in data:
+                self.busy_until.pop(device, None)
+
+        buffer = self.buffers[device]
+        buffer += data
+        while True:
+            end = buffer.find(FRAME_END)
+            if end == -1:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            line = line.decode(errors="replace").rstrip()
+            if line:
+                try:
+                    self.on_frame(device, line)
+                except Exception as e:
+                    print(f"Error when handling frame from {device}: {e}")
+        if len(buffer) > MAX_BUFFER_SIZE:
+            buffer.clear()
+
+    def fileno(self):
+        # Selector itself becomes readable when any port has data, so an outer event loop can watch just this one
+        return self.selector.fileno()
+
+    def poll(self, timeout=None):
+        # Returns seconds until queued messages can be written or None if nothing is queued
+        self.apply_pending()
+        drain_timeout = self.drain_queues()
+        if drain_timeout is not None:
+            timeout = drain_timeout if timeout is None else min(timeout, drain_timeout)
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                try:
+                    while os.read(self.wakeup_read, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            self.read_port(key.data)
+        return self.drain_queues()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.poll()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
@@ -0,0 +1,241 @@
+import json
+import os
+import threading
+import time
+from worker import Worker
+
+# Journal is folded into snapshot after this many records
+COMPACT_AFTER = 500
+# Records are written to journal right away but synced to disk by the store's worker this long after the first unsynced
+# one, so a scene or a burst of commands costs one fsync instead of one per record. Records of the last moment before
+# power loss may be lost, PI then restores the state just before them
+SYNC_DELAY = 0.5
+
+SNAPSHOT_NAME = "state.json"
+JOURNAL_NAME = "state.journal"
+
+
+class StateStore(Worker):
+    # Schedules and last applied setpoints of every panel, kept on disk so PI can restore them after crash or reboot
+    # without PC pushing everything again. Every change is appended to a journal (one JSON line per record), journal is
+    # synced by poll() in groups and folded into a snapshot in background once it grows. Loading is snapshot plus
+    # journal replay
+    def __init__(self, directory):
+        super().__init__()
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+        self.journal_path = os.path.join(directory, JOURNAL_NAME)
+        self.old_journal_path = self.journal_path + ".old"
+
+        # panel -> {"version": int, "slots": {start: [start, stop, fir, nir, vis, uv]}}
+        self.schedules = {}
+        # panel -> [fir, nir, vis, uv]
+        self.setpoints = {}
+        self.sequence = 0
+
+        self.journal = None
+        # Time first record not yet synced to disk was written, None if journal is synced
+        self.unsynced_since = None
+        self.records_since_compaction = 0
+        self.compacting = False
+
+    # Loading -------------------------------------------------------------
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as file:
+                snapshot = json.load(file)
+            self.sequence = snapshot["sequence"]
+            self.setpoints = {int(panel): values for panel, values in snapshot["setpoints"].items()}
+            self.schedules = {int(panel): {"version": schedule["version"],
+                                           "slots": {slot[0]: slot for slot in schedule["slots"]}}
+                              for panel, schedule in snapshot["schedules"].items()}
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            pass
+
+        # Old journal exists only if we crashed during compaction. Records already in snapshot are skipped by sequence
+        for path in (self.old_journal_path, self.journal_path):
+            self.replay(path)
+
+        # Finish interrupted compaction before old journal could be overwritten by next one
+        if os.path.exists(self.old_journal_path):
+            try:
+                self.write_snapshot(self.make_snapshot())
+                os.remove(self.old_journal_path)
+            except OSError as e:
+                print(f"Could not finish compaction of state store: {e}")
+
+        self.journal = open(self.journal_path, "a")
+        return self
+
+    def replay(self, path):
+        try:
+            with open(path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be torn by power loss
+                        break
+                    if record["sequence"] > self.sequence:
+                        self.apply(record)
+                        self.sequence = record["sequence"]
+                        self.records_since_compaction += 1
+        except OSError:
+            pass
+
+    # Recording -----------------------------------------------------------
+
+    def record_schedule(self, panel_number, version, slots):
+        self.append({"op": "schedule", "panel": panel_number, "version": version,
+                     "slots": [[int(value) for value in slot] for slot in slots]})
+
+    def record_update(self, panel_number, version, remove_start=None, slot=None):
+        self.append({"op": "update", "panel": panel_number, "version": version, "remove": remove_start,
+                     "slot": [int(value) for value in slot] if slot is not None else None})
+
+    def record_slot_done(self, panel_number, start):
+        self.append({"op": "done", "panel": panel_number, "start": start})
+
+    def record_setpoint(self, panel_number, values):
+        values = [int(value) for value in values]
+        with self.condition:
+            # Same values again (e.g. scheduler re-applying) do not need to be written
+            if self.setpoints.get(panel_number) == values:
+                return
+        self.append({"op": "setpoint", "panel": panel_number, "values": values})
+
+    def append(self, record):
+        # Called on MQTT, serial and schedule threads, so nothing here waits on the disk
+        wake = False
+        with self.condition:
+            self.sequence += 1
+            record["sequence"] = self.sequence
+            self.apply(record)
+            if self.journal is not None:
+                self.journal.write(json.dumps(record) + "\n")
+                if self.unsynced_since is None:
+                    self.unsynced_since = time.monotonic()
+                    wake = True
+            self.records_since_compaction += 1
+            compact = self.records_since_compaction >= COMPACT_AFTER and not self.compacting
+            if compact:
+                self.compacting = True
+        if wake:
+            self.wake()
+        if compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def apply(self, record):
+        # Caller must hold the condition (or be loading)
+        panel_number = record["panel"]
+        op = record["op"]
+        if op == "setpoint":
+            self.setpoints[panel_number] = record["values"]
+            return
+
+        schedule = self.schedules.setdefault(panel_number, {"version": 0, "slots": {}})
+        if op == "schedule":
+            schedule["version"] = record["version"]
+            schedule["slots"] = {slot[0]: slot for slot in record["slots"]}
+        elif op == "update":
+            schedule["version"] = record["version"]
+            if record["remove"] is not None:
+                schedule["slots"].pop(record["remove"], None)
+            if record["slot"] is not None:
+                schedule["slots"][record["slot"][0]] = record["slot"]
+        elif op == "done":
+            schedule["slots"].pop(record["start"], None)
+
+    # Syncing -------------------------------------------------------------
+
+    def poll(self):
+        # Syncs journal if its oldest unsynced record waited SYNC_DELAY. Returns seconds until next sync or None
+        with self.condition:
+            if self.unsynced_since is None or time.monotonic() - self.unsynced_since < SYNC_DELAY:
+                return self.next_timeout()
+            self.unsynced_since = None
+            try:
+                self.journal.flush()
+                # Synced on a duplicate so appending goes on meanwhile and compaction may close journal under it
+                descriptor = os.dup(self.journal.fileno())
+            except OSError as e:
+                print(f"Could not write state journal: {e}")
+                return self.next_timeout()
+        try:
+            os.fsync(descriptor)
+        except OSError as e:
+            print(f"Could not sync state journal: {e}")
+        finally:
+            os.close(descriptor)
+        return self.next_timeout()
+
+    def next_timeout(self):
+        with self.condition:
+            if self.unsynced_since is None:
+                return None
+            return max(self.unsynced_since + SYNC_DELAY - time.monotonic(), 0.0)
+
+    def sync(self):
+        # Caller must hold the condition
+        if self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        self.unsynced_since = None
+
+    # Compaction ----------------------------------------------------------
+
+    def compact(self):
+        # New records go to a fresh journal while snapshot is written, so nothing waits on the disk
+        with self.condition:
+            snapshot = self.make_snapshot()
+            # Old journal must be on disk until snapshot replaces it
+            self.sync()
+            self.journal.close()
+            os.replace(self.journal_path, self.old_journal_path)
+            self.journal = open(self.journal_path, "a")
+            self.records_since_compaction = 0
+
+        try:
+            self.write_snapshot(snapshot)
+            os.remove(self.old_journal_path)
+        except OSError as e:
+            print(f"Could not compact state store: {e}")
+        finally:
+            with self.condition:
+                self.compacting = False
+
+    def make_snapshot(self):
+        # Caller must hold the condition (or be loading)
+        return {
+            "sequence": self.sequence,
+            "setpoints": {panel: list(values) for panel, values in self.setpoints.items()},
+            "schedules": {panel: {"version": schedule["version"], "slots": list(schedule["slots"].values())}
+                          for panel, schedule in self.schedules.items()},
+        }
+
+    def write_snapshot(self, snapshot):
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(snapshot, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+    # Reading -------------------------------------------------------------
+
+    def get_schedules(self):
+        # {panel: (version, [slot, ...])}
+        with self.condition:
+            return {panel: (schedule["version"], sorted(schedule["slots"].values()))
+                    for panel, schedule in self.schedules.items()}
+
+    def get_setpoints(self):
+        with self.condition:
+            return {panel: list(values) for panel, values in self.setpoints.items()}
+
+    def close(self):
+        with self.condition:
+            if self.journal is not None:
+                self.sync()
+                self.journal.close()
+                self.journal = None
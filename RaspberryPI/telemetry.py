@@ -0,0 +1,176 @@
+import threading
+import time
+from array import array
+
+# Every status line of Arduino: fir, nir, vis, uv, temp1, temp2, temp3
+CHANNELS = ("fir", "nir", "vis", "uv", "temp1", "temp2", "temp3")
+
+# Raw samples kept per panel (about an hour at one sample per second)
+RAW_CAPACITY = 4096
+# Pre-aggregated tiers: (bucket length in seconds, number of buckets). 6 hours, 2 days and 4 weeks
+TIERS = ((10, 2160), (60, 2880), (600, 4032))
+# Longest answer to one history query, resolution is made coarser to stay below it
+MAX_HISTORY_ROWS = 500
+
+
+def empty_array(typecode, length, value=0):
+    return array(typecode, [value]) * length
+
+
+class SampleRing:
+    # Last raw samples of one panel. Fixed size arrays, oldest sample is overwritten
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = empty_array("d", capacity)
+        self.values = [empty_array("h", capacity) for _ in CHANNELS]
+        self.head = 0
+        self.size = 0
+
+    def add(self, timestamp, values):
+        for channel, value in enumerate(values):
+            self.values[channel][self.head] = value
+        self.times[self.head] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def oldest(self):
+        return self.times[(self.head - self.size) % self.capacity]
+
+    def samples(self, start, stop):
+        # Yields (time, values) of samples in [start, stop) from oldest to newest
+        for offset in range(self.size):
+            index = (self.head - self.size + offset) % self.capacity
+            timestamp = self.times[index]
+            if start <= timestamp < stop:
+                yield timestamp, [channel[index] for channel in self.values]
+
+
+class AggregateTier:
+    # Min, max, sum and count of every channel per time bucket. Slot of a bucket is bucket number modulo capacity, slot
+    # still holding an older bucket is cleared when it is reused
+    def __init__(self, bucket_seconds, capacity):
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+        self.buckets = empty_array("q", capacity, -1)
+        self.counts = empty_array("I", capacity)
+        self.minimum = [empty_array("h", capacity) for _ in CHANNELS]
+        self.maximum = [empty_array("h", capacity) for _ in CHANNELS]
+        self.total = [empty_array("i", capacity) for _ in CHANNELS]
+        self.newest = -1
+        self.first_sample = 0.0
+
+    def add(self, timestamp, values):
+        bucket = int(timestamp // self.bucket_seconds)
+        slot = bucket % self.capacity
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.counts[slot] = 0
+            for channel, value in enumerate(values):
+                self.minimum[channel][slot] = value
+                self.maximum[channel][slot] = value
+                self.total[channel][slot] = 0
+        self.counts[slot] += 1
+        for channel, value in enumerate(values):
+            if value < self.minimum[channel][slot]:
+                self.minimum[channel][slot] = value
+            elif value > self.maximum[channel][slot]:
+                self.maximum[channel][slot] = value
+            self.total[channel][slot] += value
+        if self.newest < 0:
+            self.first_sample = timestamp
+        self.newest = max(self.newest, bucket)
+
+    def oldest(self):
+        # Time of oldest sample this tier still covers
+        return max(self.first_sample, (self.newest - self.capacity + 1) * self.bucket_seconds)
+
+    def buckets_in(self, start, stop):
+        # Yields (time, count, minimums, maximums, totals) of filled buckets starting in [start, stop) from oldest to
+        # newest
+        first = max(int(-(-start // self.bucket_seconds)), self.newest - self.capacity + 1)
+        last = min(int((stop - 1) // self.bucket_seconds), self.newest)
+        for bucket in range(first, last + 1):
+            slot = bucket % self.capacity
+            if self.buckets[slot] != bucket:
+                continue
+            yield (bucket * self.bucket_seconds, self.counts[slot], [channel[slot] for channel in self.minimum],
+                   [channel[slot] for channel in self.maximum], [channel[slot] for channel in self.total])
+
+
+class PanelHistory:
+    def __init__(self):
+        self.raw = SampleRing(RAW_CAPACITY)
+        self.tiers = [AggregateTier(bucket_seconds, capacity) for bucket_seconds, capacity in TIERS]
+
+    def add(self, timestamp, values):
+        self.raw.add(timestamp, values)
+        for tier in self.tiers:
+            tier.add(timestamp, values)
+
+    def source_for(self, start, resolution):
+        # Coarsest data still fine enough for resolution that reaches back to start (or to first sample ever kept).
+        # If every such source is too fine, finest one reaching back is used
+        sources = [(0, self.raw)] + [(tier.bucket_seconds, tier) for tier in self.tiers]
+        earliest = min(source.oldest() for _, source in sources)
+        covering = [(bucket_seconds, source) for bucket_seconds, source in sources
+                    if source.oldest() <= max(start, earliest)]
+        for bucket_seconds, source in reversed(covering):
+            if bucket_seconds <= resolution:
+                return source
+        return covering[0][1]
+
+    def query(self, start, stop, resolution):
+        # Returns rows (time, count, (min, max, mean) for every channel) of resolution long buckets in [start, stop).
+        # Rows are aligned to multiples of resolution
+        source = self.source_for(start, resolution)
+        if source is self.raw:
+            buckets = ((timestamp, 1, values, values, values) for timestamp, values in self.raw.samples(start, stop))
+        else:
+            buckets = source.buckets_in(start, stop)
+
+        rows = []
+        current = None
+        for timestamp, count, minimums, maximums, totals in buckets:
+            row_time = int(timestamp // resolution * resolution)
+            if current is None or current[0] != row_time:
+                current = [row_time, 0, list(minimums), list(maximums), [0] * len(CHANNELS)]
+                rows.append(current)
+            current[1] += count
+            for channel in range(len(CHANNELS)):
+                current[2][channel] = min(current[2][channel], minimums[channel])
+                current[3][channel] = max(current[3][channel], maximums[channel])
+                current[4][channel] += totals[channel]
+
+        result = []
+        for row_time, count, minimums, maximums, totals in rows:
+            row = [row_time, count]
+            for channel in range(len(CHANNELS)):
+                row += [minimums[channel], maximums[channel], round(totals[channel] / count)]
+            result.append(tuple(row))
+        return result
+
+
+class TelemetryStore:
+    # History of every panel's status lines at bounded memory: raw samples for the last hour or so and min/max/mean
+    # tiers for days. All numbers live in typed arrays, not Python objects
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.panels = {}
+
+    def add(self, panel_number, values, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            history = self.panels.get(panel_number)
+            if history is None:
+                history = self.panels[panel_number] = PanelHistory()
+            history.add(timestamp, values[:len(CHANNELS)])
+
+    def query(self, panel_number, start, stop, resolution):
+        # Returns (resolution actually used, rows). Resolution is in whole seconds, rows of 1 s hold raw samples
+        resolution = max(resolution, (stop - start + MAX_HISTORY_ROWS - 1) // MAX_HISTORY_ROWS, 1)
+        with self.lock:
+            history = self.panels.get(panel_number)
+            if history is None or stop <= start:
+                return resolution, []
+            return resolution, history.query(start, stop, resolution)[-MAX_HISTORY_ROWS:]
@@ -0,0 +1,77 @@
+import time
+from serial_mux import ARDUINO_LOOP_TIME
+from worker import Worker
+
+# Arduino reads one message per loop, so a panel can't answer more often than this (see serial_mux). Shorter intervals
+# are raised to it
+MIN_STREAM_INTERVAL = ARDUINO_LOOP_TIME
+# Status values are fir, nir, vis, uv and then temperatures
+FIRST_TEMP_CHANNEL = 4
+
+
+class TelemetryStreamer(Worker):
+    # Asks all panels for their status at configured rate and publishes panel's status on its own topic only when some
+    # value moved by more than threshold since it was last published. Interval 0 stops streaming
+    def __init__(self, request_samples, publish):
+        super().__init__()
+        self.request_samples = request_samples
+        self.publish = publish
+
+        self.interval = 0.0
+        self.pwm_threshold = 0
+        self.temp_threshold = 0
+        self.next_sample = 0.0
+        self.last_published = {}
+
+    def configure(self, interval, pwm_threshold, temp_threshold):
+        with self.condition:
+            self.interval = max(interval, MIN_STREAM_INTERVAL) if interval > 0 else 0.0
+            self.pwm_threshold = pwm_threshold
+            self.temp_threshold = temp_threshold
+            self.next_sample = time.monotonic()
+            # Everything is published once more so new subscribers start from full state
+            self.last_published = {}
+        self.wake()
+
+    def is_streaming(self):
+        with self.condition:
+            return self.interval > 0
+
+    def on_sample(self, panel_number, values):
+        # Called with every status line of Arduino. Returns True if it was published
+        with self.condition:
+            if self.interval == 0:
+                return False
+            last = self.last_published.get(panel_number)
+            if last is not None and not self.changed(last, values):
+                return False
+            self.last_published[panel_number] = list(values)
+        self.publish(panel_number, values)
+        return True
+
+    def changed(self, last, values):
+        for channel, (old, new) in enumerate(zip(last, values)):
+            threshold = self.pwm_threshold if channel < FIRST_TEMP_CHANNEL else self.temp_threshold
+            if abs(new - old) > threshold:
+                return True
+        return False
+
+    def poll(self):
+        # Requests samples if they are due. Returns seconds until next sample or None if not streaming
+        with self.condition:
+            if self.interval == 0:
+                return None
+            now = time.monotonic()
+            due = now >= self.next_sample
+            if due:
+                # Samples that were missed (busy PI) are skipped, not sent in a burst
+                self.next_sample = max(self.next_sample + self.interval, now)
+        if due:
+            self.request_samples()
+        return self.next_timeout()
+
+    def next_timeout(self):
+        with self.condition:
+            if self.interval == 0:
+                return None
+            return max(self.next_sample - time.monotonic(), 0.0)
@@ -0,0 +1,125 @@
+import threading
+import time
+from worker import Worker
+
+# Supervisor levels, also sent to PC in alarm message
+THERMAL_OK = 0
+THERMAL_DERATE = 1
+THERMAL_CUTOFF = 2
+
+# PWM is scaled to this fraction while panel is derated
+DERATE_FACTOR = 0.5
+# Panel must cool this many degrees below derate temperature before it is released
+HYSTERESIS = 5
+# Panel stays limited at least this long after it tripped, so scheduler can't raise it right away again
+LOCKOUT_SECONDS = 120.0
+# DS18B20 reports this when sensor is not connected
+SENSOR_DISCONNECTED = -127
+
+
+class ThermalSupervisor:
+    # Watches temperatures of every status line as soon as it is read from serial port. Above derate_temp PWM of panel
+    # is scaled down, above max_temp it is cut. Until panel cooled down and lockout passed every set (PC, scenes,
+    # scheduler) is limited the same way
+    def __init__(self, max_temp, derate_temp, lockout_seconds=LOCKOUT_SECONDS):
+        self.max_temp = max_temp
+        self.derate_temp = derate_temp
+        self.lockout_seconds = lockout_seconds
+
+        self.lock = threading.Lock()
+        self.levels = {}
+        self.tripped_at = {}
+        # Time last status line of every panel was checked
+        self.checked_at = {}
+        # PWM values last asked for, restored when panel is released
+        self.requested = {}
+
+    def limited(self, level, values):
+        if level == THERMAL_CUTOFF:
+            return [0] * len(values)
+        if level == THERMAL_DERATE:
+            return [int(value * DERATE_FACTOR) for value in values]
+        return list(values)
+
+    def limit(self, panel_number, values):
+        # Returns PWM values that may be sent to panel right now
+        with self.lock:
+            self.requested[panel_number] = list(values)
+            return self.limited(self.levels.get(panel_number, THERMAL_OK), values)
+
+    def unchecked_panels(self, panels, age):
+        # Panels out of given ones whose temperature was not checked in last age seconds
+        now = time.monotonic()
+        with self.lock:
+            return [panel_number for panel_number in panels if now - self.checked_at.get(panel_number, 0.0) >= age]
+
+    def check(self, panel_number, values):
+        # values: fir, nir, vis, uv, temp1, temp2, temp3 as reported by Arduino. Returns None if nothing has to be done
+        # or (level, temperature, PWM values to send or None, True if level changed)
+        pwm = list(values[:4])
+        temperatures = [temp for temp in values[4:] if temp != SENSOR_DISCONNECTED]
+        now = time.monotonic()
+        with self.lock:
+            self.checked_at[panel_number] = now
+            level = self.levels.get(panel_number, THERMAL_OK)
+            temperature = max(temperatures) if temperatures else None
+
+            new_level = level
+            if temperature is not None:
+                if temperature >= self.max_temp:
+                    new_level = max(level, THERMAL_CUTOFF)
+                elif temperature >= self.derate_temp:
+                    new_level = max(level, THERMAL_DERATE)
+                elif level != THERMAL_OK and temperature < self.derate_temp - HYSTERESIS and \
+                        now - self.tripped_at[panel_number] >= self.lockout_seconds:
+                    new_level = THERMAL_OK
+
+            if new_level > level:
+                self.tripped_at[panel_number] = now
+                self.requested.setdefault(panel_number, pwm)
+            self.levels[panel_number] = new_level
+
+            send = None
+            if new_level == THERMAL_OK:
+                if level != THERMAL_OK:
+                    # Released, go back to what was asked for in the meantime
+                    send = self.requested.get(panel_number)
+            else:
+                allowed = self.limited(new_level, self.requested.get(panel_number, pwm))
+                # Sent on every status line that shows more than allowed, so a set that raced the trip is undone too
+                if any(actual > limit for actual, limit in zip(pwm, allowed)):
+                    send = allowed
+
+            if send is None and new_level == level:
+                return None
+            return new_level, temperature if temperature is not None else SENSOR_DISCONNECTED, send, new_level != level
+
+
+class TemperaturePoller(Worker):
+    # Supervisor only sees temperatures in status lines. Streaming is off by default and PC asks for status only now and
+    # then, so every interval seconds each panel that sent no status line in the meantime is asked for one. Otherwise
+    # a panel heating up under a constant setpoint would never be derated or cut
+    def __init__(self, supervisor, list_panels, request_status, interval):
+        # list_panels() returns panels of connected Arduinos, request_status(panel_number) asks panel for status line
+        super().__init__()
+        self.supervisor = supervisor
+        self.list_panels = list_panels
+        self.request_status = request_status
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+
+    def poll(self):
+        # Asks unheard panels for status if due. Returns seconds until next poll
+        with self.condition:
+            now = time.monotonic()
+            due = now >= self.next_poll
+            if due:
+                self.next_poll = max(self.next_poll + self.interval, now)
+        if due:
+            for panel_number in self.supervisor.unchecked_panels(self.list_panels(), self.interval):
+                self.request_status(panel_number)
+        return self.next_timeout()
+
+    def next_timeout(self):
+        with self.condition:
+            return max(self.next_poll - time.monotonic(), 0.0)
@@ -0,0 +1,40 @@
+import threading
+
+
+class Worker:
+    # Part of PI script that wakes up on its own schedule (streamer, fade engine, schedule engine...). Subclass does
+    # whatever is due in poll() and tells in next_timeout() how many seconds until it is due again (None while idle),
+    # both under self.condition. run() drives it on its own thread, asyncio runtime calls poll() from its loop instead
+    def __init__(self):
+        # Condition uses RLock, so next_timeout can take it again while run() computes timeout atomically with the wait
+        self.condition = threading.Condition(threading.RLock())
+        self.running = False
+        # Called by wake() so whoever drives poll without waiting on condition (asyncio runtime) can wake up too
+        self.on_change = None
+
+    def poll(self):
+        raise NotImplementedError
+
+    def next_timeout(self):
+        raise NotImplementedError
+
+    def wake(self):
+        # Called after work was added or configuration changed from another thread, so timeout is computed again
+        with self.condition:
+            self.condition.notify()
+        if self.on_change is not None:
+            self.on_change()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.poll()
+            with self.condition:
+                timeout = self.next_timeout()
+                if self.running and timeout != 0:
+                    self.condition.wait(timeout)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,280 @@
+import hashlib
+import struct
+import zlib
+# Used by PC and PI. PC imports it from this directory, PI_handler uploads it next to PI script
+
+# Two wire formats are supported:
+#  - text: "command,field,field," followed by SHA-256 hex of everything before it (original protocol). Sequence number,
+#    if any, is appended to command as "command#sequence"
+#  - binary: header, fixed width fields and CRC-32. About 5x smaller and much cheaper to check
+# Receivers detect format from the first byte, senders choose one with protocol argument
+
+PROTOCOL_TEXT = "text"
+PROTOCOL_BINARY = "binary"
+
+PC_TO_PI = "pc_to_pi"
+PI_TO_PC = "pi_to_pc"
+# Streamed status of one panel (retained), same commands as PI_TO_PC. Format with panel number
+PANEL_TOPIC = PI_TO_PC + "/panel/{}"
+# Periodic runtime metrics of PI, same commands as PI_TO_PC
+METRICS_TOPIC = PI_TO_PC + "/metrics"
+
+# Binary frame: magic, version, opcode, sequence number | fields | CRC-32 of everything before it
+# Magic byte 0xC1 never appears in UTF-8 text, so binary and text frames can't be confused
+FRAME_MAGIC = 0xC1
+# Version 2: slots carry ramp in and ramp out. Version 3: history row sample count is 32 bit
+FRAME_VERSION = 3
+HEADER = struct.Struct("!BBBH")
+CHECKSUM = struct.Struct("!I")
+SEQUENCE_MODULO = 1 << 16
+
+# Variable length tail after fixed fields, made of these parts (in order)
+#  - name: short text (length prefixed in binary, one field in text), e.g. scene name
+#  - slots / entries: list of records, must be last
+#  - data / text: raw bytes / text until end of message, must be last
+TAIL_NAME = "name"
+TAIL_SLOTS = "slots"
+TAIL_ENTRIES = "entries"
+TAIL_HISTORY = "history"
+TAIL_DATA = "data"
+TAIL_TEXT = "text"
+
+# Records: slot is start minute, stop minute, fir, nir, vis, uv, ramp in and ramp out in seconds. Entry (one panel of a scene) is panel, fir, nir, vis, uv
+# History row is time, number of samples, then min, max and mean of fir, nir, vis, uv, temp1, temp2 and temp3. Sample
+# count is 32 bit, a long bucket of one second samples does not fit a short
+RECORDS = {
+    TAIL_SLOTS: struct.Struct("!HHBBBBHH"),
+    TAIL_ENTRIES: struct.Struct("!BBBBB"),
+    TAIL_HISTORY: struct.Struct("!II21h"),
+}
+RECORD_COUNT = struct.Struct("!H")
+NAME_LENGTH = struct.Struct("!B")
+
+# command: (opcode, struct format of fixed fields, tail parts)
+COMMANDS = {
+    PC_TO_PI: {
+        "status": (0x01, "!B", ()),                         # panel
+        "set": (0x02, "!BBBBB", ()),                        # panel, fir, nir, vis, uv
+        "ON": (0x03, "!B", (TAIL_SLOTS,)),                  # panel, slots...
+        "OFF": (0x04, "!B", ()),                            # panel
+        "scene": (0x05, "!", (TAIL_ENTRIES,)),              # entries... applied at once
+        "scene_save": (0x06, "!", (TAIL_NAME, TAIL_ENTRIES)),   # name, entries...
+        "scene_recall": (0x07, "!", (TAIL_NAME,)),          # name
+        "scene_delete": (0x08, "!", (TAIL_NAME,)),          # name
+        "slot_add": (0x09, "!BI", (TAIL_SLOTS,)),           # panel, schedule version, slot
+        "slot_remove": (0x0A, "!BIH", ()),                  # panel, schedule version, start of slot
+        "slot_replace": (0x0B, "!BIH", (TAIL_SLOTS,)),      # panel, schedule version, start of old slot, new slot
+        "history": (0x0C, "!BIIH", ()),                     # panel, start time, stop time, resolution in seconds
+        "stream": (0x0D, "!HBB", ()),                       # interval in ms (0 stops), PWM and temperature thresholds
+        "profile": (0x0E, "!BH", ()),                       # 1 starts, 0 stops profiling, stack sampling interval in ms
+    },
+    PI_TO_PC: {
+        "status": (0x81, "!BBBBBhhhI", ()),                 # panel, fir, nir, vis, uv, temp1-3, age in ms
+        "check": (0x82, "!", ()),
+        "error": (0x83, "!B", ()),                          # error code
+        "echo": (0x84, "!", (TAIL_DATA,)),                  # original message
+        "text": (0x85, "!", (TAIL_TEXT,)),                  # free text for humans
+        "scene_ack": (0x86, "!BB", (TAIL_NAME,)),           # result code, number of panels set, scene name
+        "schedule_ack": (0x87, "!BBI", ()),                 # panel, result code, current schedule version
+        "ack": (0x88, "!HB", ()),                           # sequence number of acknowledged message, result code
+        "trace": (0x89, "!HBIII", ()),                      # sequence number, answered from cache, us spent on PI
+                                                            # before serial write, on serial link, before publish
+        "history": (0x8A, "!BH", (TAIL_HISTORY,)),          # panel, resolution in seconds, rows...
+        "alarm": (0x8B, "!BBh", ()),                        # panel, thermal level (0 ok, 1 derated, 2 cut), temperature
+        "metrics": (0x8C, "!", (TAIL_TEXT,)),               # JSON of counters, gauges and histograms
+    },
+}
+
+# Result codes of ack. Anything but ACK_OK is a nack
+ACK_OK = 0
+ACK_FAILED = 1      # command was understood but could not be carried out (bad fields, invalid schedule...)
+ACK_UNKNOWN = 2     # command is not known to receiver
+
+FIELD_FORMATS = {topic: {command: struct.Struct(fmt) for command, (_, fmt, _) in commands.items()}
+                 for topic, commands in COMMANDS.items()}
+# Formats above use one character per field
+FIELD_COUNTS = {topic: {command: len(fmt) - 1 for command, (_, fmt, _) in commands.items()}
+                for topic, commands in COMMANDS.items()}
+COMMANDS_BY_OPCODE = {topic: {opcode: command for command, (opcode, _, _) in commands.items()}
+                      for topic, commands in COMMANDS.items()}
+
+
+class CodecError(ValueError):
+    pass
+
+
+def device_topic(namespace, topic):
+    # Topic of one PI when several PIs share a broker (fleet), e.g. "room1/pc_to_pi". Empty namespace keeps topics as
+    # they are, so single PI setups do not change
+    return f"{namespace}/{topic}" if namespace else topic
+
+
+def generate_hash(message_to_hash):
+    hash_object = hashlib.sha256(message_to_hash.encode())
+    return hash_object.hexdigest()
+
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] == FRAME_MAGIC
+
+
+def to_log_string(payload):
+    if is_binary(payload):
+        return payload.hex()
+    return payload.decode(errors="replace")
+
+
+def encode(topic, command, fields, protocol=PROTOCOL_TEXT, sequence=None):
+    if protocol == PROTOCOL_BINARY:
+        return encode_binary(topic, command, fields, sequence or 0)
+    return encode_text(command, fields, sequence).encode()
+
+
+def decode(topic, payload):
+    # Returns (command, fields, sequence). Sequence is None for text messages sent without one. Raises CodecError if
+    # message is damaged
+    if is_binary(payload):
+        return decode_binary(topic, payload)
+    return decode_text(topic, payload)
+
+
+# Binary ------------------------------------------------------------------
+
+def encode_binary(topic, command, fields, sequence):
+    try:
+        opcode, _, tail = COMMANDS[topic][command]
+    except KeyError:
+        raise CodecError(f"Command {command} can't be sent on {topic}")
+    field_format = FIELD_FORMATS[topic][command]
+    fixed_count = FIELD_COUNTS[topic][command]
+
+    try:
+        frame = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, opcode, sequence % SEQUENCE_MODULO)
+        frame += field_format.pack(*(int(field) for field in fields[:fixed_count]))
+        rest = list(fields[fixed_count:])
+        for part in tail:
+            if part == TAIL_NAME:
+                name = str(rest.pop(0)).encode() if rest else b""
+                frame += NAME_LENGTH.pack(len(name)) + name
+            elif part in RECORDS:
+                record = RECORDS[part]
+                frame += RECORD_COUNT.pack(len(rest))
+                frame += b"".join(record.pack(*(int(value) for value in item)) for item in rest)
+            else:
+                data = rest[0] if rest else b""
+                frame += data.encode() if isinstance(data, str) else bytes(data)
+    except (struct.error, TypeError, ValueError) as e:
+        raise CodecError(f"Can't encode {command}: {e}")
+    return frame + CHECKSUM.pack(zlib.crc32(frame))
+
+
+def decode_binary(topic, payload):
+    if len(payload) < HEADER.size + CHECKSUM.size:
+        raise CodecError("Frame too short")
+    body = payload[:-CHECKSUM.size]
+    (checksum,) = CHECKSUM.unpack_from(payload, len(body))
+    if zlib.crc32(body) != checksum:
+        raise CodecError("Checksum mismatch")
+
+    _, version, opcode, sequence = HEADER.unpack_from(body)
+    if version != FRAME_VERSION:
+        raise CodecError(f"Unsupported frame version {version}")
+    command = COMMANDS_BY_OPCODE[topic].get(opcode)
+    if command is None:
+        raise CodecError(f"Unknown opcode {opcode}")
+    _, _, tail = COMMANDS[topic][command]
+    field_format = FIELD_FORMATS[topic][command]
+
+    try:
+        fields = list(field_format.unpack_from(body, HEADER.size))
+        offset = HEADER.size + field_format.size
+        for part in tail:
+            if part == TAIL_NAME:
+                (length,) = NAME_LENGTH.unpack_from(body, offset)
+                offset += NAME_LENGTH.size
+                fields.append(bytes(body[offset:offset + length]).decode(errors="replace"))
+                offset += length
+            elif part in RECORDS:
+                record = RECORDS[part]
+                (count,) = RECORD_COUNT.unpack_from(body, offset)
+                offset += RECORD_COUNT.size
+                if len(body) < offset + count * record.size:
+                    raise CodecError("Record count does not match frame length")
+                fields += [record.unpack_from(body, offset + i * record.size) for i in range(count)]
+                offset += count * record.size
+            elif part == TAIL_DATA:
+                fields.append(bytes(body[offset:]))
+                offset = len(body)
+            else:
+                fields.append(bytes(body[offset:]).decode(errors="replace"))
+                offset = len(body)
+        if len(body) != offset:
+            raise CodecError("Unexpected bytes after fields")
+    except struct.error as e:
+        raise CodecError(f"Malformed {command}: {e}")
+    return command, fields, sequence
+
+
+# Text (compatibility mode) -----------------------------------------------
+
+def encode_text(command, fields, sequence=None):
+    # All messages must end with comma and must be separated by comma and no whitespaces
+    parts = [command if sequence is None else f"{command}#{sequence % SEQUENCE_MODULO}"]
+    for field in fields:
+        if isinstance(field, (tuple, list)):
+            parts.append(";".join(str(value) for value in field))
+        elif isinstance(field, bytes):
+            parts.append(field.decode(errors="replace"))
+        else:
+            parts.append(str(field))
+    message = ",".join(parts) + ","
+    return message + generate_hash(message)
+
+
+def decode_text(topic, payload):
+    message = payload.decode(errors="replace")
+    components = message.split(",")
+    command, _, sequence = components[0].partition("#")
+
+    # Echo carries whole original message including its hash, nothing to check
+    if command == "echo":
+        return command, [message[len(components[0]) + 1:]], None
+
+    # Recreate sent message and compare hashes
+    received_hash = components[-1]
+    original_message = ','.join(components[:-1]) + ','
+    if received_hash != generate_hash(original_message):
+        raise CodecError("Hash mismatch")
+
+    try:
+        sequence = int(sequence) if sequence else None
+    except ValueError:
+        raise CodecError(f"Malformed sequence number of {command}")
+
+    content = components[1:-1]
+    schema = COMMANDS.get(topic, {}).get(command)
+    if schema is None:
+        # Unknown command, leave content as is and let receiver decide
+        return command, content, sequence
+
+    _, _, tail = schema
+    fixed_count = FIELD_COUNTS[topic][command]
+    try:
+        if not tail:
+            # Older senders may send fewer or more trailing fields, keep whatever is there
+            fields = [int(c) for c in content]
+        else:
+            fields = [int(c) for c in content[:fixed_count]]
+            rest = content[fixed_count:]
+            for part in tail:
+                if part == TAIL_NAME:
+                    fields.append(rest.pop(0) if rest else "")
+                elif part in RECORDS:
+                    fields += [tuple(int(value) for value in item.split(";")) for item in rest if item]
+                else:
+                    fields.append(",".join(rest))
+    except ValueError as e:
+        raise CodecError(f"Malformed {command}: {e}")
+    if len(fields) < fixed_count:
+        raise CodecError(f"Not enough fields for {command}")
+    return command, fields, sequence
@@ -0,0 +1,92 @@
+from array import array
+from bisect import bisect_right
+# Used by PC and PI. PC imports it from this directory, PI_handler uploads it next to PI script
+
+
+class IntervalIndex:
+    # Sorted, non overlapping slots (start, stop, values) in minutes of the day. Starts and stops are kept in arrays so
+    # lookups are a bisect and a whole day at minute resolution (1440 slots) stays small
+    # Two slots may touch (stop of one equals start of next) but may not share start, stop or any minute in between
+
+    def __init__(self, slots=()):
+        self.starts = array('H')
+        self.stops = array('H')
+        self.values = []
+        self.insert_many(slots)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield self.starts[i], self.stops[i], self.values[i]
+
+    def __getitem__(self, i):
+        return self.starts[i], self.stops[i], self.values[i]
+
+    def find_overlap(self, start, stop):
+        # Returns position of slot overlapping [start, stop] or -1. Only neighbours of insertion point can overlap
+        i = bisect_right(self.starts, start) - 1
+        if i >= 0 and (self.starts[i] == start or self.stops[i] > start):
+            return i
+        if i + 1 < len(self.starts) and self.starts[i + 1] < stop:
+            return i + 1
+        return -1
+
+    def overlaps(self, start, stop):
+        return self.find_overlap(start, stop) != -1
+
+    def insert(self, start, stop, values):
+        if stop < start:
+            raise ValueError(f"Slot ends before it starts: {start}-{stop}")
+        if self.overlaps(start, stop):
+            raise ValueError(f"Slot {start}-{stop} overlaps existing slot")
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.stops.insert(i, stop)
+        self.values.insert(i, values)
+
+    def insert_many(self, slots):
+        # Bulk insert: one sort and one pass over neighbours instead of a search per slot. Nothing is changed if
+        # any slot overlaps
+        merged = list(self) + [(int(slot[0]), int(slot[1]), slot[2]) for slot in slots]
+        if not merged:
+            return
+        merged.sort(key=lambda slot: slot[0])
+        for i, slot in enumerate(merged):
+            if slot[1] < slot[0]:
+                raise ValueError(f"Slot ends before it starts: {slot[0]}-{slot[1]}")
+            if i > 0 and (merged[i - 1][0] == slot[0] or merged[i - 1][1] > slot[0]):
+                raise ValueError(f"Slot {slot[0]}-{slot[1]} overlaps existing slot")
+        self.starts = array('H', (slot[0] for slot in merged))
+        self.stops = array('H', (slot[1] for slot in merged))
+        self.values = [slot[2] for slot in merged]
+
+    def index_of(self, start):
+        i = bisect_right(self.starts, start) - 1
+        if i >= 0 and self.starts[i] == start:
+            return i
+        return -1
+
+    def remove(self, start):
+        # Remove slot starting at given minute. Returns removed slot or None
+        i = self.index_of(start)
+        if i == -1:
+            return None
+        slot = self[i]
+        del self.starts[i]
+        del self.stops[i]
+        del self.values[i]
+        return slot
+
+    def active_at(self, minute):
+        # Slot containing given minute (both ends inclusive). When two slots touch the later one wins
+        i = bisect_right(self.starts, minute) - 1
+        if i >= 0 and minute <= self.stops[i]:
+            return self[i]
+        return None
+
+    def clear(self):
+        self.starts = array('H')
+        self.stops = array('H')
+        self.values = []
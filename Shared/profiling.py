@@ -0,0 +1,118 @@
+import collections
+import os
+import sys
+import threading
+import time
+# Used by PC and PI. PC imports it from this directory, PI_handler uploads it next to PI script
+
+# Stacks of all threads are sampled this often while profiling (seconds)
+SAMPLE_INTERVAL = 0.01
+# Deeper stacks are cut, recursion would make lines huge
+MAX_STACK_DEPTH = 64
+
+
+class Profiler:
+    # Off by default and then wrapped handlers cost one flag check. While on, every call of a wrapped handler is timed
+    # and a thread samples stacks of all threads. Stop writes samples as collapsed stacks (one "thread;outer;...;inner
+    # count" line per stack, input of flamegraph.pl and speedscope)
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+
+        self.enabled = False
+        self.lock = threading.Lock()
+        # handler -> [calls, total seconds, longest call]
+        self.timings = {}
+        self.stacks = collections.Counter()
+        self.started = 0.0
+        self.stopped = 0.0
+        self.sampler = None
+        self.stop_sampling = threading.Event()
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+        return timed
+
+    def record(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def start(self, sample_interval=SAMPLE_INTERVAL):
+        # Returns False if profiler is already running
+        with self.lock:
+            if self.enabled:
+                return False
+            self.timings = {}
+            self.stacks = collections.Counter()
+            self.started = time.monotonic()
+            self.stop_sampling.clear()
+            self.sampler = threading.Thread(target=self.sample, args=(sample_interval,), daemon=True)
+            self.enabled = True
+        self.sampler.start()
+        return True
+
+    def stop(self):
+        # Returns path of collapsed stacks file or None if profiler was not running. Raises OSError if file can't be
+        # written, timings are kept for report either way
+        with self.lock:
+            if not self.enabled:
+                return None
+            self.enabled = False
+            self.stopped = time.monotonic()
+        self.stop_sampling.set()
+        self.sampler.join()
+        return self.write_stacks()
+
+    def is_running(self):
+        return self.enabled
+
+    def sample(self, interval):
+        sampler = threading.get_ident()
+        while not self.stop_sampling.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == sampler:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(stack)))
+            with self.lock:
+                self.stacks.update(stacks)
+
+    def write_stacks(self):
+        path = os.path.join(self.directory, f"{self.name}_{time.strftime('%Y%m%d_%H%M%S')}.folded")
+        with self.lock:
+            lines = [f"{stack} {count}\n" for stack, count in self.stacks.most_common()]
+        with open(path, "w") as file:
+            file.writelines(lines)
+        return path
+
+    def report(self):
+        # Timings of wrapped handlers as text table, busy is share of profiled time spent in handler
+        with self.lock:
+            elapsed = (time.monotonic() if self.enabled else self.stopped) - self.started
+            timings = sorted(self.timings.items(), key=lambda item: item[1][1], reverse=True)
+            samples = sum(self.stacks.values())
+        lines = [f"Profiled {elapsed:.1f} s, {samples} stack samples",
+                 f"{'handler':<32}{'calls':>8}{'mean ms':>10}{'max ms':>10}{'busy %':>8}"]
+        for name, (calls, total, longest) in timings:
+            lines.append(f"{name:<32}{calls:>8}{total / calls * 1000:>10.3f}{longest * 1000:>10.3f}"
+                         f"{total / elapsed * 100 if elapsed > 0 else 0:>8.2f}")
+        return "\n".join(lines)
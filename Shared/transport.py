@@ -0,0 +1,290 @@
+import itertools
+import queue
+import threading
+import time
+# Used by PC and PI. PC imports it from this directory, PI_handler uploads it next to PI script
+
+# Transports clients can be created with:
+#  - mqtt: paho client talking to a real broker (mosquitto on PI)
+#  - loopback: in-process broker, no sockets. PC and PI logic can run in one process for tests and microbenchmarks
+# Both are used through the same subset of paho's API: connect, subscribe, publish, message_callback_add, loop_start,
+# loop_forever... with callbacks called from the client's network loop, never from the publishing thread
+TRANSPORT_MQTT = "mqtt"
+TRANSPORT_LOOPBACK = "loopback"
+TRANSPORTS = (TRANSPORT_MQTT, TRANSPORT_LOOPBACK)
+
+# Same values as paho
+MQTT_ERR_SUCCESS = 0
+MQTT_ERR_NO_CONN = 4
+CONNACK_ACCEPTED = 0
+
+# Events in loopback client's inbox
+EVENT_CONNECT = "connect"
+EVENT_DISCONNECT = "disconnect"
+EVENT_MESSAGE = "message"
+EVENT_STOP = "stop"
+
+
+def create_client(client_id, transport=TRANSPORT_MQTT, broker=None):
+    # broker is LoopbackBroker to use with loopback transport, process wide one if None
+    if transport == TRANSPORT_LOOPBACK:
+        return LoopbackClient(client_id, broker)
+    if transport != TRANSPORT_MQTT:
+        raise ValueError(f"Unknown transport {transport}")
+    # Imported here so loopback transport works without paho installed
+    import paho.mqtt.client as mqtt
+    return mqtt.Client(client_id)
+
+
+def topic_matches(subscription, topic):
+    # Same rules as paho's topic_matches_sub: + matches one level, # the rest
+    subscription_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(subscription_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or (level != "+" and level != topic_levels[index]):
+            return False
+    return len(subscription_levels) == len(topic_levels)
+
+
+def to_payload(payload):
+    # paho sends str as UTF-8 and numbers as their text
+    if payload is None:
+        return b""
+    if isinstance(payload, str):
+        return payload.encode()
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, (int, float)):
+        return str(payload).encode()
+    raise TypeError("payload must be a string, bytearray, int, float or None.")
+
+
+class LoopbackMessage:
+    # Fields of paho's MQTTMessage that handlers use
+    def __init__(self, topic, payload, qos, retain, mid):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.mid = mid
+        self.timestamp = time.monotonic()
+
+
+class LoopbackMessageInfo:
+    # Publish is done once publish() returns, nothing to wait for
+    def __init__(self, mid, rc):
+        self.mid = mid
+        self.rc = rc
+
+    def is_published(self):
+        return self.rc == MQTT_ERR_SUCCESS
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+
+class LoopbackBroker:
+    # Routes messages between loopback clients of one process, keeps retained messages like a real broker
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.retained = {}
+        self.mid = itertools.count(1)
+
+    def connect(self, client):
+        with self.lock:
+            self.clients.add(client)
+
+    def disconnect(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def publish(self, topic, payload, qos, retain):
+        mid = next(self.mid)
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = LoopbackMessage(topic, payload, qos, True, mid)
+                else:
+                    self.retained.pop(topic, None)
+            clients = list(self.clients)
+        for client in clients:
+            if client.is_subscribed(topic):
+                client.deliver(LoopbackMessage(topic, payload, qos, False, mid))
+        return mid
+
+    def retained_for(self, subscription):
+        with self.lock:
+            return [message for topic, message in self.retained.items() if topic_matches(subscription, topic)]
+
+
+# Shared by all loopback clients created without a broker
+LOOPBACK = LoopbackBroker()
+
+
+class LoopbackClient:
+    # Drop-in for paho client on a LoopbackBroker. Incoming messages wait in an inbox until the client's loop (loop,
+    # loop_start or loop_forever) hands them to callbacks, so callbacks run in the same thread as with paho
+    def __init__(self, client_id="", broker=None):
+        self.client_id = client_id
+        self.broker = broker if broker is not None else LOOPBACK
+
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        # Called from publishing thread whenever something is put in inbox, so an outer event loop (asyncio) knows
+        # to call loop(0). Loopback has no socket to watch
+        self.on_message_queued = None
+
+        self.userdata = None
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+        self.callbacks = []
+        self.inbox = queue.Queue()
+        self.connected = False
+        self.thread = None
+        self.mid = itertools.count(1)
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def username_pw_set(self, username, password=None):
+        # Loopback broker lets everyone in
+        pass
+
+    # Connection
+
+    def connect(self, host="localhost", port=1883, keepalive=60):
+        self.broker.connect(self)
+        self.connected = True
+        self.put(EVENT_CONNECT, None)
+        return MQTT_ERR_SUCCESS
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        self.broker.disconnect(self)
+        self.connected = False
+        self.put(EVENT_DISCONNECT, None)
+        return MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self.connected
+
+    # Subscriptions
+
+    def subscribe(self, topic, qos=0):
+        # Topic can also be list of (topic, qos) like with paho. Returns (result, mid)
+        topics = [topic] if isinstance(topic, str) else [subscription for subscription, _ in topic]
+        with self.lock:
+            self.subscriptions.update(topics)
+        for subscription in topics:
+            for message in self.broker.retained_for(subscription):
+                self.deliver(message)
+        return MQTT_ERR_SUCCESS, next(self.mid)
+
+    def unsubscribe(self, topic):
+        topics = [topic] if isinstance(topic, str) else list(topic)
+        with self.lock:
+            self.subscriptions.difference_update(topics)
+        return MQTT_ERR_SUCCESS, next(self.mid)
+
+    def is_subscribed(self, topic):
+        with self.lock:
+            return any(topic_matches(subscription, topic) for subscription in self.subscriptions)
+
+    def message_callback_add(self, subscription, callback):
+        with self.lock:
+            self.callbacks = [(sub, cb) for sub, cb in self.callbacks if sub != subscription]
+            self.callbacks.append((subscription, callback))
+
+    def message_callback_remove(self, subscription):
+        with self.lock:
+            self.callbacks = [(sub, cb) for sub, cb in self.callbacks if sub != subscription]
+
+    # Messages
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        payload = to_payload(payload)
+        if not self.connected:
+            return LoopbackMessageInfo(0, MQTT_ERR_NO_CONN)
+        return LoopbackMessageInfo(self.broker.publish(topic, payload, qos, retain), MQTT_ERR_SUCCESS)
+
+    def deliver(self, message):
+        self.put(EVENT_MESSAGE, message)
+
+    def put(self, event, message):
+        self.inbox.put((event, message))
+        if self.on_message_queued is not None:
+            self.on_message_queued()
+
+    def dispatch(self, event, message):
+        # Returns False if loop_forever should stop
+        if event == EVENT_CONNECT:
+            if self.on_connect is not None:
+                self.on_connect(self, self.userdata, {"session present": 0}, CONNACK_ACCEPTED)
+        elif event == EVENT_DISCONNECT:
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, self.userdata, MQTT_ERR_SUCCESS)
+            return False
+        elif event == EVENT_STOP:
+            return False
+        else:
+            with self.lock:
+                callbacks = [cb for sub, cb in self.callbacks if topic_matches(sub, message.topic)]
+            if not callbacks and self.on_message is not None:
+                callbacks = [self.on_message]
+            for callback in callbacks:
+                callback(self, self.userdata, message)
+        return True
+
+    # Network loop
+
+    def loop(self, timeout=1.0):
+        # Hands everything in inbox to callbacks, waits up to timeout for the first event
+        try:
+            event, message = self.inbox.get(timeout=timeout) if timeout > 0 else self.inbox.get_nowait()
+        except queue.Empty:
+            return MQTT_ERR_SUCCESS
+        while True:
+            self.dispatch(event, message)
+            try:
+                event, message = self.inbox.get_nowait()
+            except queue.Empty:
+                return MQTT_ERR_SUCCESS
+
+    def loop_forever(self):
+        # Returns once disconnect() was called or loop_stop() asked loop thread to stop
+        while self.dispatch(*self.inbox.get()):
+            pass
+        return MQTT_ERR_SUCCESS
+
+    def loop_thread(self):
+        # Thread of loop_start keeps running across disconnects until loop_stop()
+        while True:
+            event, message = self.inbox.get()
+            if event == EVENT_STOP:
+                return
+            self.dispatch(event, message)
+
+    def loop_misc(self):
+        return MQTT_ERR_SUCCESS if self.connected else MQTT_ERR_NO_CONN
+
+    def loop_start(self):
+        if self.thread is not None:
+            return MQTT_ERR_SUCCESS
+        self.thread = threading.Thread(target=self.loop_thread, daemon=True)
+        self.thread.start()
+        return MQTT_ERR_SUCCESS
+
+    def loop_stop(self):
+        if self.thread is None:
+            return MQTT_ERR_SUCCESS
+        self.inbox.put((EVENT_STOP, None))
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        return MQTT_ERR_SUCCESS